@@ -31,5 +31,98 @@ def reset_locations():
     # db.session.query(Location).delete()
     db.session.commit()
 
+
+@manager.option('-t', '--type', dest='type', default='gene',
+                help="Type of images to decode (e.g., 'gene' or 'location')")
+@manager.option('-s', '--set', dest='ds_name', default='terms_20k',
+                help="Name of the DecodingSet to decode against")
+def decode_images(type, ds_name):
+    ''' Re-decode all images of the given type, in batches. '''
+    from nsweb.models.images import Image
+    from nsweb.api.decode import decode_analysis_images
+    from nsweb.initializers import settings
+    ids = [i for (i,) in db.session.query(Image.id).filter_by(type=type)]
+    batch_size = settings.DECODING_BATCH_SIZE
+    for start in range(0, len(ids), batch_size):
+        print("Decoding images %d - %d of %d..." % (
+            start + 1, min(start + batch_size, len(ids)), len(ids)))
+        decode_analysis_images(ids[start:start + batch_size], ds_name,
+                               overwrite=True)
+
+
+@manager.option('-i', '--include', dest='include',
+                default='terms,topics,genes',
+                help="Comma-separated image sets to update")
+@manager.option('-j', '--jobs', dest='n_jobs', type=int, default=None,
+                help="Number of processes used to load images")
+def update_memmaps(include, n_jobs):
+    ''' Add new and changed images to the existing decoder memmaps. '''
+    from nsweb.initializers import settings
+    from nsweb.initializers.database_builder import DatabaseBuilder
+    builder = DatabaseBuilder(db, dataset=settings.PICKLE_DATABASE)
+    builder.memory_map_images(include=include.split(','), update=True,
+                              n_jobs=n_jobs)
+
+
+@manager.option('-j', '--jobs', dest='n_jobs', type=int, default=1,
+                help="Number of processes")
+@manager.option('-s', '--shard', dest='shard', default='0/1',
+                help="Only compute every n-th chunk starting at the i-th, "
+                "given as 'i/n', to split the work across machines")
+def precompute_coactivation(n_jobs, shard):
+    ''' Compute coactivation maps for all locations. Chunks that are already
+    done are skipped, so the command can be interrupted and rerun. '''
+    from os.path import join
+    from neurosynth.base.dataset import Dataset
+    from nsweb.initializers import settings
+    from nsweb.tasks.coactivation import precompute_coactivation_maps
+    dataset = Dataset.load(settings.PICKLE_DATABASE)
+    directory = join(settings.SEED_STORE_DIR, 'coactivation')
+    shard = tuple(int(s) for s in shard.split('/'))
+    precompute_coactivation_maps(dataset, directory, n_jobs=n_jobs,
+                                 shard=shard)
+
+
+@manager.option('-k', '--kind', dest='kind', default='fcmri',
+                help="Kind of location image, which names the store")
+@manager.option('-p', '--pattern', dest='pattern', default=None,
+                help="Path of the images, with %d placeholders for x, y and "
+                "z. Defaults to the functional connectivity maps.")
+@manager.option('-j', '--jobs', dest='n_jobs', type=int, default=1,
+                help="Number of processes")
+def import_seed_images(kind, pattern, n_jobs):
+    ''' Import per-location NIfTI images into a seed store. Chunks that
+    are already done are skipped, so the command can be interrupted and
+    rerun. '''
+    import nibabel as nb
+    from os.path import join
+    from nsweb.initializers import settings
+    from nsweb.tasks.seed_store import import_images
+    if pattern is None:
+        pattern = join(settings.IMAGE_DIR, 'fcmri',
+                       'functional_connectivity_%d_%d_%d.nii.gz')
+    mask = nb.load(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
+    import_images(join(settings.SEED_STORE_DIR, kind), pattern, mask,
+                  n_jobs=n_jobs)
+
+
+@manager.option('-n', '--number', dest='n_urls', type=int, default=1000,
+                help="Number of URLs to request")
+@manager.option('-l', '--logs', dest='logs', default=None,
+                help="Glob pattern of the nginx access logs to rank URLs by. "
+                "Defaults to ACCESS_LOG_FILES in settings.")
+@manager.option('-j', '--jobs', dest='n_jobs', type=int, default=4,
+                help="Number of requests to make at a time")
+def warm_cache(n_urls, logs, n_jobs):
+    ''' Request the most popular URLs, to fill the response cache, the
+    decodings and the coactivation maps before the site gets traffic. '''
+    from nsweb.initializers import settings
+    from nsweb.initializers.cache_warmer import hot_urls, warm_urls
+    urls = hot_urls(logs or settings.ACCESS_LOG_FILES, limit=n_urls)
+    statuses = warm_urls(urls, n_threads=n_jobs)
+    failed = len([s for s in statuses if s != 200])
+    print("Requested %d URLs, %d failed." % (len(urls), failed))
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
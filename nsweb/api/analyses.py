@@ -1,18 +1,25 @@
 from flask import Blueprint, url_for, request, jsonify, redirect
 from nsweb.models.analyses import (Analysis, AnalysisSet, TopicAnalysis,
                                    TermAnalysis, CustomAnalysis)
+from nsweb.models.frequencies import Frequency
+from nsweb.models.studies import Study
 from .schemas import AnalysisSchema
 from nsweb.api import images
-from nsweb.core import cache
-from .utils import make_cache_key
+from nsweb.core import cache, db
+from .utils import cache_key
 import re
 
 
 bp = Blueprint('api_analyses', __name__, url_prefix='/api/analyses')
 
+# Maximum number of results per page
+MAX_LIMIT = 100
+
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'limit': 25, 'page': 1, 'type': 'term', 'id': None, 'name': None},
+    limits={'limit': MAX_LIMIT}))
 def get_analyses():
     """
     Retrieve meta-analysis data
@@ -58,7 +65,6 @@ def get_analyses():
             type: integer
     """
     DEFAULT_LIMIT = 25
-    MAX_LIMIT = 100
     limit = int(request.args.get('limit', DEFAULT_LIMIT))
     limit = min(limit, MAX_LIMIT)
     page = int(request.args.get('page', 1))
@@ -137,23 +143,34 @@ def get_image_file(analysis, image):
     return images.download(img.id, unthresholded)
 
 
+def _study_frequencies(analysis_id, *columns):
+    """ Return a query for the given Study columns plus the frequency of the
+    analysis in each of its studies, without loading any models. """
+    return db.session.query(Study.pmid, *(columns + (Frequency.frequency,))) \
+        .join(Frequency, Frequency.pmid == Study.pmid) \
+        .filter(Frequency.analysis_id == analysis_id)
+
+
 @bp.route('/<string:val>/studies/')
 def get_studies(val):
     analysis = find_analysis(val)
     if 'dt' in request.args:  # DataTables
-        data = []
-        for f in analysis.frequencies:
-            s = f.study
-            link = '<a href={0}>{1}</a>'.format(
-                url_for('studies.show', val=s.pmid), s.title)
-            data.append([link, s.authors, s.journal, round(f.frequency, 3)])
+        rows = _study_frequencies(analysis.id, Study.title, Study.authors,
+                                  Study.journal)
+        data = [['<a href={0}>{1}</a>'.format(
+                    url_for('studies.show', val=pmid), title),
+                 authors, journal, round(freq, 3)]
+                for (pmid, title, authors, journal, freq) in rows]
         data = jsonify(data=data)
     else:
-        data = jsonify(studies=[s.pmid for s in analysis.studies])
+        pmids = db.session.query(Frequency.pmid).filter_by(
+            analysis_id=analysis.id)
+        data = jsonify(studies=[pmid for (pmid,) in pmids])
     return data
 
 
 @bp.route('/term_names/')
+@cache.cached(timeout=3600, key_prefix=cache_key({}))
 def get_term_names():
     # optimize this later--select only names
     names = [f.name for f in TermAnalysis.query.all()]
@@ -243,14 +260,13 @@ def find_api_analysis(name):
 
 @bp.route('/analyses/<int:val>/')
 def analyses_api(val):
-    data = Analysis.query.get(val)
-# data=Frequency.query.filter_by(analysis_id=int(val))#attempted
-# optimization. Join causes slower performance however
-    data = [['<a href={0}>{1}</a>'.format(url_for('studies.show', val=f.pmid),
-                                          f.study.title),
-             f.study.authors,
-             f.study.journal,
-             f.study.year,
-             round(f.frequency, 3),
-             ] for f in data.frequencies]
+    rows = _study_frequencies(val, Study.title, Study.authors, Study.journal,
+                              Study.year)
+    data = [['<a href={0}>{1}</a>'.format(url_for('studies.show', val=pmid),
+                                          title),
+             authors,
+             journal,
+             year,
+             round(freq, 3),
+             ] for (pmid, title, authors, journal, year, freq) in rows]
     return jsonify(aaData=data)
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, request, jsonify, abort, url_for
 from nsweb.models.analyses import CustomAnalysis
 from nsweb.models.images import CustomAnalysisImage
 from nsweb.models.studies import Study
@@ -6,6 +6,8 @@ from nsweb.models.frequencies import Frequency
 from nsweb.core import db
 from nsweb.initializers import settings
 from nsweb import tasks
+from nsweb.api.jobs import wants_async, submit, job_succeeded
+from nsweb.tasks.single_flight import delay_once
 from flask_login import current_user
 from flask_user import login_required
 import datetime as dt
@@ -177,7 +179,16 @@ def run_custom_analysis(uid):
             not custom.images:
 
         ids = [s.pmid for s in custom.studies]
-        if tasks.run_metaanalysis.delay(ids, custom.uuid).wait():
+        # When run in the background, the job redirects back here once done
+        done = job_succeeded(request.args.get('job'), tasks.run_metaanalysis,
+                             (ids, custom.uuid))
+        if wants_async() and not done:
+            return submit(tasks.run_metaanalysis, (ids, custom.uuid),
+                          next_url=lambda job: url_for(
+                              'api_custom.run_custom_analysis', uid=uid,
+                              job=job))
+        if done or \
+                delay_once(tasks.run_metaanalysis, (ids, custom.uuid)).wait():
             # Update analysis record
             rev_inf = '%s_association-test_z_FDR_0.01.nii.gz' % custom.uuid
             rev_inf = join(settings.IMAGE_DIR, 'custom', rev_inf)
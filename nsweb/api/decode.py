@@ -1,29 +1,36 @@
-from flask import jsonify, request, Blueprint, abort, send_file
+from flask import jsonify, request, Blueprint, abort, send_file, url_for
 from nsweb.api.schemas import DecodingSchema
 from nsweb.models.decodings import Decoding, DecodingSet
 from nsweb.core import cache, db
 from nsweb.models.images import Image
 from nsweb.initializers import settings
 from nsweb import tasks
+from nsweb.tasks.results import load_decoding
+from nsweb.tasks.decoding import top_k
 from .utils import send_nifti
 import json
 import re
 import uuid
 import requests
+import traceback
 from os.path import join, basename, exists
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.utils import parsedate
 from nsweb.controllers import error_page
 import pandas as pd
-from .utils import make_cache_key
+from .utils import cache_key
+from .jobs import wants_async, submit, accepted, get_status
+from nsweb.tasks.single_flight import delay_once, make_key
 
 
 bp = Blueprint('api_decode', __name__, url_prefix='/api/decode')
 
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'uuid': None, 'image': None, 'neurovault': None, 'url': None,
+     'set': 'terms_20k'}), unless=wants_async)
 def get_decoding():
     """
     Retrieve decoding data for a single image
@@ -56,8 +63,19 @@ def get_decoding():
           description: URL of Nifti image to decode
           type: string
           required: false
+        - in: query
+          name: async
+          description: If true, new decodings run in the background, and a 202 response with a job to poll is returned (see /api/jobs/)
+          type: boolean
+          required: false
     """
     dec = _get_decoding_object()
+    if dec is None:
+        abort(404)  # Not cached, so failed decodings can be retried
+    if getattr(dec, 'job_id', None) is not None:
+        # Raised rather than returned, so the response isn't cached
+        abort(accepted(dec.job_id,
+                       url_for('api_decode.get_decoding', uuid=dec.uuid)))
     schema = DecodingSchema()
     return jsonify(data=schema.dump(dec).data)
 
@@ -67,7 +85,15 @@ def _get_decoding_object(filter_display=True):
     dec = None
 
     if 'uuid' in request.args:
-        dec = dec.filter_by(uuid=request.args['uuid']).first()
+        dec = Decoding.query.filter_by(uuid=request.args['uuid']).first()
+        if dec is not None:
+            done = _mark_decoded(dec)
+            if done is None:
+                dec = None
+            elif not done:
+                # Still running; point to its job (whose ID is the decoding's
+                # UUID) rather than blocking on it
+                dec.job_id = dec.uuid
 
     elif 'image' in request.args:
         dec = decode_analysis_image(request.args['image'])
@@ -106,11 +132,47 @@ def get_voxel_data(x, y, z, reference='terms', get_json=True, get_pp=True):
     return result if get_json else pd.read_json(result)
 
 
+def _mark_decoded(dec):
+    """ Check on a Decoding run in the background: mark it as decoded if its
+    results exist, and delete it if its job failed or is lost (i.e., still
+    pending after SINGLE_FLIGHT_TIMEOUT seconds), so later requests don't
+    wait for it. Returns True if the decoding is done, False if it's still
+    running, and None if it was deleted. """
+    if dec.image_decoded_at is not None:
+        return True
+    status = get_status(dec.uuid)
+    if load_decoding(dec.decoding_set.name, dec.uuid) is not None:
+        dec.image_decoded_at = datetime.utcnow()
+        db.session.add(dec)
+        db.session.commit()
+        return True
+    lost = status == 'pending' and dec.created_at is not None and \
+        datetime.utcnow() - dec.created_at > timedelta(
+            seconds=settings.SINGLE_FLIGHT_TIMEOUT)
+    if status in ['failure', 'success'] or lost:
+        # Finished without results
+        db.session.delete(dec)
+        db.session.commit()
+        return None
+    return False
+
+
 def _get_decoding(**kwargs):
-    """ Check if a Decoding matching the passed criteria already exists. """
+    """ Check if a finished Decoding matching the passed criteria already
+    exists. Decodings that are still running are left out, so requests for
+    them attach to the running job (see _run_decoder) instead of getting a
+    record without results. """
     name = request.args.get('set', 'terms_20k')
-    return Decoding.query.filter_by(**kwargs).join(DecodingSet) \
-        .filter(DecodingSet.name == name).first()
+    query = Decoding.query.filter_by(**kwargs).join(DecodingSet) \
+        .filter(DecodingSet.name == name)
+    dec = query.filter(Decoding.image_decoded_at.isnot(None)).first()
+    if dec is None:
+        # Background decodings are only marked as decoded when polled
+        for pending in query.filter(
+                Decoding.image_decoded_at.is_(None)).all():
+            if _mark_decoded(pending):
+                return pending
+    return dec
 
 
 def _run_decoder(**kwargs):
@@ -118,35 +180,218 @@ def _run_decoder(**kwargs):
     kwargs['uuid'] = kwargs.get('uuid', uuid.uuid4().hex)
     # Default to reduced term reference set. Also allow
     # 'terms' or 'topics' shorthand.
-    ds_name = request.args.get('set', 'terms_20k')
-    if ds_name in ['terms', 'topics']:
-        ds_name += '_20k'
+    ds_name = _normalize_set_name(request.args.get('set', 'terms_20k'))
     reference = DecodingSet.query.filter_by(name=ds_name).first()
+    # Set decoding_set_id rather than decoding_set, so the record doesn't
+    # join the session (through the backref) unless it is saved below
     dec = Decoding(display=True, download=False, ip=request.remote_addr,
-                   decoding_set=reference, **kwargs)
-
-    # run decoder and wait for it to terminate
-    result = tasks.decode_image.delay(dec.filename, reference.name,
-                                      dec.uuid).wait()
-
-    if result:
+                   decoding_set_id=reference.id, **kwargs)
+
+    # Concurrent requests to decode the same image share one job, whose ID
+    # is the UUID of the decoding that the first request creates
+    key = make_key(tasks.decode_image, (reference.name,
+                                        kwargs.get('image_id'),
+                                        kwargs.get('url')))
+    job = delay_once(tasks.decode_image,
+                     (dec.filename, reference.name, dec.uuid), key=key,
+                     task_id=dec.uuid)
+    if job.id != dec.uuid:
+        if not wants_async() and not job.wait():
+            return None  # The shared job failed
+        leader = Decoding.query.filter_by(uuid=job.id).first()
+        if leader is not None:
+            if wants_async():
+                leader.job_id = job.id
+            elif not _mark_decoded(leader):
+                return None
+            return leader
+        # The other request's decoding failed (or isn't saved yet)
+        job = tasks.decode_image.apply_async(
+            (dec.filename, reference.name, dec.uuid), task_id=dec.uuid)
+
+    # Save the record before the job can finish, so requests attached to it
+    # find the record once it has
+    db.session.add(dec)
+    db.session.commit()
+
+    if wants_async():
+        # Attach the (unsaved) job ID, so the caller can respond right away;
+        # the record is marked as decoded once results exist
+        dec.job_id = job.id
+        return dec
+
+    # wait for the decoder to terminate
+    if job.wait():
         dec.image_decoded_at = datetime.utcnow()
         db.session.add(dec)
-        db.session.commit()
+    else:
+        db.session.delete(dec)
+        dec = None
+    db.session.commit()
 
     return dec
 
 
+@bp.route('/batch/', methods=['GET', 'POST'])
+def decode_batch():
+    """
+    Decode several images in a single pass over the reference set
+    ---
+    tags:
+        - decode
+    responses:
+        200:
+            description: UUIDs of the decodings of all requested images
+        default:
+            description: Decoding set not found
+    parameters:
+        - in: query
+          name: image
+          description: IDs of images to decode (max = 100)
+          required: true
+          collectionFormat: csv
+          type: array
+          items:
+            type: integer
+        - in: query
+          name: set
+          description: Name of the reference set to decode against (default = terms_20k)
+          required: false
+          type: string
+    """
+    MAX_IMAGES = 100
+    ids = re.split('[\s,]+', request.values.get('image', '').strip(' ,'))
+    try:
+        ids = [int(x) for x in ids if x][:MAX_IMAGES]
+    except ValueError:
+        abort(400)
+    ds_name = request.values.get('set', 'terms_20k')
+    if DecodingSet.query.filter_by(name=_normalize_set_name(ds_name)) \
+            .first() is None:
+        abort(404)
+    decodings = decode_analysis_images(ids, ds_name, ip=request.remote_addr)
+    data = [{'image': dec.image_id, 'uuid': dec.uuid} for dec in decodings]
+    return jsonify(data=data)
+
+
+def _normalize_set_name(name):
+    """ Allow 'terms' or 'topics' shorthand for the reduced reference sets. """
+    if name in ['terms', 'topics']:
+        name += '_20k'
+    return name
+
+
 @bp.route('/<string:uuid>/data/')
 def get_data(uuid):
     dec = Decoding.query.filter_by(uuid=uuid).first()
     if dec is None:
         abort(404)
-    data = open(join(settings.DECODING_RESULTS_DIR,
-                     dec.uuid + '.txt')).read().splitlines()
-    data = [x.split('\t') for x in data]
-    data = [{'analysis': f, 'r': round(float(v), 3)}
-            for (f, v) in data if v.strip()]
+    data = load_decoding(dec.decoding_set.name, dec.uuid)
+    if data is None:
+        abort(404)
+    data = data.dropna().round(3)
+    data = [{'analysis': f, 'r': float(v)} for (f, v) in data.items()]
+    return jsonify(data=data)
+
+
+@bp.route('/<string:uuid>/top/')
+def get_top(uuid):
+    """
+    Retrieve the strongest associations of a decoded image
+    ---
+    tags:
+        - decode
+    responses:
+        200:
+            description: The k strongest correlations, strongest first
+        default:
+            description: Decoding not found
+    parameters:
+        - in: path
+          name: uuid
+          description: UUID of the decoding
+          required: true
+          type: string
+        - in: query
+          name: k
+          description: Number of associations to return (default = 10)
+          required: false
+          type: integer
+        - in: query
+          name: sign
+          description: Return the most positive ('pos'), most negative ('neg'), or largest absolute ('both') correlations (default = 'both')
+          required: false
+          type: string
+    """
+    dec = Decoding.query.filter_by(uuid=uuid).first()
+    if dec is None:
+        abort(404)
+    data = load_decoding(dec.decoding_set.name, dec.uuid)
+    if data is None:
+        abort(404)
+    k = _get_k(len(data))
+    sign = request.args.get('sign', 'both')
+    if sign not in ['pos', 'neg', 'both']:
+        sign = 'both'
+    inds = top_k(data.values, k, sign)
+    data = [{'analysis': data.index[i], 'r': round(float(data.iloc[i]), 3)}
+            for i in inds]
+    return jsonify(data=data)
+
+
+def _get_k(n, default=10):
+    """ Return the number of results requested in the k query argument,
+    bounded to 1..n. Aborts with a 400 if k isn't an integer. """
+    try:
+        k = int(request.args.get('k', default))
+    except ValueError:
+        abort(400)
+    return max(1, min(k, n))
+
+
+@bp.route('/<string:uuid>/similar/')
+@cache.cached(timeout=3600, key_prefix=cache_key({'k': 10}),
+              unless=wants_async)
+def get_similar(uuid):
+    """
+    Retrieve the term, topic and gene maps most similar to a decoded image
+    ---
+    tags:
+        - decode
+    responses:
+        200:
+            description: The k most correlated reference maps, most similar first
+        default:
+            description: Decoding not found
+    parameters:
+        - in: path
+          name: uuid
+          description: UUID of the decoding
+          required: true
+          type: string
+        - in: query
+          name: k
+          description: Number of maps to return (default = 10, max = 100)
+          required: false
+          type: integer
+        - in: query
+          name: async
+          description: If true, returns a 202 response with a job to poll (see /api/jobs/); the job's result holds [set, analysis, r] lists
+          required: false
+          type: boolean
+    """
+    dec = Decoding.query.filter_by(uuid=uuid).first()
+    if dec is None:
+        abort(404)
+    k = _get_k(100)
+    if wants_async():
+        return submit(tasks.find_similar_images, (dec.filename,), {'k': k})
+    result = delay_once(tasks.find_similar_images, (dec.filename,),
+                        {'k': k}).wait()
+    if result is False:
+        abort(404)
+    data = [{'set': s, 'analysis': f, 'r': round(r, 3)}
+            for (s, f, r) in result]
     return jsonify(data=data)
 
 
@@ -173,9 +418,11 @@ def get_scatter(uuid, analysis):
         dec = Decoding.query.filter_by(uuid=uuid).first()
         if dec is None:
             abort(404)
-        result = tasks.make_scatterplot.delay(
-            dec.filename, analysis, dec.uuid, outfile=outfile,
-            x_lab=dec.name).wait()
+        args = (dec.filename, analysis, dec.uuid)
+        kwargs = {'outfile': outfile, 'x_lab': dec.name}
+        if wants_async():
+            return submit(tasks.make_scatterplot, args, kwargs, request.path)
+        delay_once(tasks.make_scatterplot, args, kwargs).wait()
         if not exists(outfile):
             abort(404)
     return send_file(
@@ -291,3 +538,59 @@ def decode_analysis_image(image):
         dec = _run_decoder(**kwargs)
 
     return dec
+
+
+def decode_analysis_images(images, ds_name='terms_20k', ip=None,
+                           overwrite=False):
+    """ Decode several analysis images against the same DecodingSet. All
+    images without an existing decoding are passed to the decoder together,
+    so the reference memmap is read once per batch instead of once per image.
+    Args:
+        images (list): IDs of the images to decode
+        ds_name (str): name of the DecodingSet to decode against
+        ip (str): optional IP address to record on new Decoding records
+        overwrite (bool): if True, re-decode images even if a cached decoding
+            exists.
+    Returns: A list of Decoding instances for all successfully decoded images.
+    """
+    reference = DecodingSet.query.filter_by(
+        name=_normalize_set_name(ds_name)).first()
+    if reference is None:
+        return []
+
+    decodings, pending = [], []
+    for image in Image.query.filter(Image.id.in_(images)):
+        old = Decoding.query.filter_by(
+            image_id=image.id, decoding_set_id=reference.id).filter(
+            Decoding.image_decoded_at.isnot(None)).first()
+        if old is not None and not overwrite and settings.CACHE_DECODINGS:
+            decodings.append(old)
+            continue
+        # Set decoding_set_id rather than decoding_set, so the record doesn't
+        # join the session (through the backref) before it has results
+        dec = Decoding(display=True, download=False, ip=ip,
+                       decoding_set_id=reference.id, uuid=uuid.uuid4().hex,
+                       name=image.name, filename=image.image_file,
+                       image_id=image.id)
+        pending.append((dec, old))
+
+    if pending:
+        # run decoder and wait for it to terminate
+        try:
+            results = tasks.decode_images.delay(
+                [dec.filename for (dec, old) in pending], reference.name,
+                [dec.uuid for (dec, old) in pending]).wait()
+        except Exception:
+            print(traceback.format_exc())
+            results = [False] * len(pending)
+        # Only save decodings with results, replacing the old records
+        for (dec, old), result in zip(pending, results):
+            if result:
+                if old is not None:
+                    db.session.delete(old)
+                dec.image_decoded_at = datetime.utcnow()
+                db.session.add(dec)
+                decodings.append(dec)
+        db.session.commit()
+
+    return decodings
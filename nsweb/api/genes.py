@@ -1,5 +1,7 @@
 from flask import jsonify, request, Blueprint, abort, send_file, url_for
-from .utils import make_cache_key
+from .utils import cache_key
+from .jobs import wants_async, submit
+from nsweb.tasks.single_flight import delay_once
 from nsweb.api.schemas import GeneSchema
 from nsweb.models.genes import Gene
 from nsweb.core import cache
@@ -11,9 +13,14 @@ from nsweb.initializers import settings
 
 bp = Blueprint('api_genes', __name__, url_prefix='/api/genes')
 
+# Maximum number of results per page
+MAX_LIMIT = 100
+
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'limit': 25, 'page': 1, 'id': None, 'symbol': None},
+    limits={'limit': MAX_LIMIT}))
 def get_genes():
     """
     Retrieve gene data
@@ -54,7 +61,6 @@ def get_genes():
             type: integer
     """
     DEFAULT_LIMIT = 25
-    MAX_LIMIT = 100
     limit = int(request.args.get('limit', DEFAULT_LIMIT))
     limit = min(limit, MAX_LIMIT)
     page = int(request.args.get('page', 1))
@@ -119,9 +125,11 @@ def get_scatter(val, analysis):
         gene = Gene.query.filter_by(symbol=val).first()
         if gene is None:
             abort(404)
-        make_scatterplot.delay(
-            gene.images[0].image_file, analysis, gene.symbol,
-            x_lab='%s expression level' % gene.symbol, outfile=outfile,
-            gene_masks=True).wait()
+        args = (gene.images[0].image_file, analysis, gene.symbol)
+        kwargs = {'x_lab': '%s expression level' % gene.symbol,
+                  'outfile': outfile, 'gene_masks': True}
+        if wants_async():
+            return submit(make_scatterplot, args, kwargs, request.path)
+        delay_once(make_scatterplot, args, kwargs).wait()
     return send_file(outfile, as_attachment=False,
                      attachment_filename=basename(outfile))
@@ -3,7 +3,7 @@ from nsweb.models.images import Image
 from nsweb.models.downloads import Download
 from .schemas import ImageSchema
 from nsweb.core import cache
-from .utils import make_cache_key
+from .utils import cache_key
 import re
 from nsweb.core import db
 from .utils import send_nifti
@@ -11,14 +11,20 @@ from nsweb.initializers import settings
 from nsweb.initializers.settings import IMAGE_DIR
 from nsweb.controllers import error_page
 from nsweb.api.decode import decode_analysis_image
+from nsweb.tasks.results import load_decoding
 import os
 
 
 bp = Blueprint('api_images', __name__, url_prefix='/api/images')
 
+# Maximum number of results per page
+MAX_LIMIT = 100
+
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'limit': 25, 'page': 1, 'type': None, 'id': None, 'search': None},
+    limits={'limit': MAX_LIMIT}))
 def get_images():
     """
     Retrieve image data
@@ -61,7 +67,6 @@ def get_images():
           required: false
     """
     DEFAULT_LIMIT = 25
-    MAX_LIMIT = 100
     limit = int(request.args.get('limit', DEFAULT_LIMIT))
     limit = min(limit, MAX_LIMIT)
     page = int(request.args.get('page', 1))
@@ -118,12 +123,12 @@ def get_decoding_data(image, get_json=True):
                           " to make sure there is a valid image with id=%d." %
                           image)
     dec = decode_analysis_image(image)
-    df = os.path.join(settings.DECODING_RESULTS_DIR, dec.uuid + '.txt')
-    if not os.path.exists(df):
+    if dec is not None:
+        data = load_decoding(dec.decoding_set.name, dec.uuid)
+    if dec is None or data is None:
         return error_page("An unspecified error occurred during decoding.")
-    data = open(df).read().splitlines()
-    data = [x.split('\t') for x in data]
-    data = [[f, round(float(v or '0'), 3)] for (f, v) in data]
+    data = data.fillna(0).round(3)
+    data = [[f, float(v)] for (f, v) in data.items()]
     return jsonify(data=data) if get_json else data
 
 
@@ -0,0 +1,118 @@
+from flask import jsonify, request, Blueprint, abort, redirect, url_for
+from celery.result import AsyncResult
+from nsweb.core import celery
+from nsweb.tasks.single_flight import delay_once, current_job
+
+
+bp = Blueprint('api_jobs', __name__, url_prefix='/api/jobs')
+
+
+def wants_async():
+    """ Whether the client asked for long-running tasks to run in the
+    background, either with an 'async' query parameter or a
+    'Prefer: respond-async' header (RFC 7240). Endpoints that support this
+    respond with 202 Accepted and a job to poll instead of blocking until the
+    task finishes. """
+    if request.args.get('async', '0').lower() not in ['0', 'false', '']:
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def submit(task, args=(), kwargs=None, next_url=None, key=None):
+    """ Enqueue a Celery task and return a 202 Accepted response for it. If
+    an identical task is already running, the response refers to that job
+    instead (see nsweb.tasks.single_flight).
+    Args:
+        task: the task to run (e.g., tasks.make_coactivation_map).
+        args, kwargs: arguments to the task.
+        next_url: the (local) URL clients are redirected to from the job
+            status endpoint once the task succeeds, or a function that takes
+            the job ID and returns that URL.
+        key: optional single-flight key (see delay_once).
+    """
+    result = delay_once(task, args, kwargs, key=key)
+    if callable(next_url):
+        next_url = next_url(result.id)
+    return accepted(result.id, next_url)
+
+
+def accepted(job_id, next_url=None):
+    """ Return a 202 Accepted response pointing to the status of a job. """
+    status_url = url_for('api_jobs.get_job', job_id=job_id, next=next_url)
+    resp = jsonify(data={'id': job_id, 'status': 'pending',
+                         'url': status_url})
+    resp.status_code = 202
+    resp.headers['Location'] = status_url
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+
+def get_status(job_id):
+    """ Return the status of a job: 'pending', 'running', 'success' or
+    'failure'. Tasks that catch their own errors return False, which counts
+    as a failure; tasks with nothing to produce (e.g., no coactivation map for
+    a location) return None, which counts as a success. """
+    result = AsyncResult(job_id, app=celery)
+    if result.state == 'SUCCESS':
+        return 'failure' if result.result is False else 'success'
+    if result.state in ['FAILURE', 'REVOKED']:
+        return 'failure'
+    if result.state == 'STARTED':
+        return 'running'
+    return 'pending'
+
+
+def job_succeeded(job_id, task, args=(), kwargs=None):
+    """ Whether the job with the given ID (e.g., passed back to an endpoint
+    through next_url) has finished successfully. Job IDs come from clients,
+    so the job must also be the last one submitted for the given task and
+    arguments; otherwise this returns False. """
+    if job_id is None or current_job(task, args, kwargs) != job_id:
+        return False
+    return get_status(job_id) == 'success'
+
+
+@bp.route('/<string:job_id>/')
+def get_job(job_id):
+    """
+    Retrieve the status of a background job
+    ---
+    tags:
+        - jobs
+    responses:
+        200:
+            description: Status of the job ('pending', 'running', 'success' or 'failure'), plus its result when the job has succeeded
+        303:
+            description: The job has succeeded; redirects to its result
+        default:
+            description: The job failed
+    parameters:
+        - in: path
+          name: job_id
+          description: ID of the job, as returned by the endpoint that started it
+          required: true
+          type: string
+        - in: query
+          name: next
+          description: URL to redirect to once the job has succeeded
+          required: false
+          type: string
+    """
+    status = get_status(job_id)
+    data = {'id': job_id, 'status': status}
+    if status == 'failure':
+        resp = jsonify(data=data)
+        resp.status_code = 500
+        return resp
+    if status == 'success':
+        next_url = request.args.get('next')
+        # Only redirect within the site
+        if next_url and next_url.startswith('/') and \
+                not next_url.startswith('//'):
+            return redirect(next_url, 303)
+        result = AsyncResult(job_id, app=celery).result
+        if result is not True:
+            data['result'] = result
+    else:
+        data['url'] = request.full_path
+    return jsonify(data=data)
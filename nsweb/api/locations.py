@@ -1,12 +1,14 @@
-from flask import jsonify, request, Blueprint, url_for, redirect
-from .utils import make_cache_key
+from flask import jsonify, request, Blueprint, url_for, redirect, abort
+from .utils import cache_key
+from .jobs import wants_async, submit, job_succeeded
+from nsweb.tasks.single_flight import delay_once
+from nsweb.tasks.seed_store import has_seed_image, seed_image_file
 from nsweb.api.schemas import (LocationSchema)
 from nsweb.api.images import get_decoding_data
 from nsweb.models.locations import Location
 from nsweb.models.peaks import Peak
+from nsweb.models.studies import Study
 from nsweb.core import cache
-from sqlalchemy import func
-from flask_user import current_user
 from nsweb.models.images import LocationImage
 from nsweb.initializers import settings
 from os.path import join, exists
@@ -15,14 +17,22 @@ from nsweb.core import db, app
 from nsweb.api.decode import decode_analysis_image, get_voxel_data
 import pandas as pd
 import numpy as np
-from collections import defaultdict
 
 
 bp = Blueprint('api_locations', __name__, url_prefix='/api/locations')
 
+# Arguments of location requests, with the defaults used by get_params
+# Cache key parameters: coordinates are required, and radii are clamped to
+# MAX_RADIUS mm
+MAX_RADIUS = 20
+XYZ = {'x': int, 'y': int, 'z': int}
+XYZR = dict(XYZ, r=6)
+LIMITS = {'r': MAX_RADIUS}
+
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(XYZR, LIMITS),
+              unless=wants_async)
 def get_location():
     """
     Retrieve location data
@@ -55,42 +65,94 @@ def get_location():
           description: Radius of sphere within which to search for study activations, in mm (default = 6, max = 20).
           required: false
           type: integer
+        - in: query
+          name: async
+          description: If true and the location's coactivation map doesn't exist yet, returns a 202 response with a job to poll (see /api/jobs/)
+          required: false
+          type: boolean
     """
     x = int(request.args['x'])
     y = int(request.args['y'])
     z = int(request.args['z'])
     #  Radius: 6 mm by default, max 2 cm
-    r = min(int(request.args.get('r', 6)), 20)
+    r = min(int(request.args.get('r', 6)), MAX_RADIUS)
 
     # Check validity of coordinates and redirect if necessary
     check_xyz(x, y, z)
 
     loc = Location.query.filter_by(x=x, y=y, z=z).first()
     if loc is None:
-        from nsweb.controllers.locations import make_location
+        job = _coactivation_job(x, y, z)
+        if job is not None:
+            return job
         loc = make_location(x, y, z)
 
-    peaks = Peak.closestPeaks(r, x, y, z)
-    peaks = peaks.group_by(Peak.pmid)
-    peaks = peaks.add_columns(func.count(Peak.id))
-
-    loc.studies = [p[0].study for p in peaks]
+    loc.studies = [{'pmid': pmid}
+                   for (pmid, n_peaks) in Peak.closestStudies(r, x, y, z)]
 
     schema = LocationSchema()
     return jsonify(data=schema.dump(loc).data)
 
 
-def make_location(x, y, z):
+def _location_image_file(kind, filename, x, y, z):
+    """ Return the file of a location image of the given kind: the seed image
+    file if the image is in its seed store, or else the NIfTI file it used to
+    be saved as, if that exists. Returns None if there is no image. """
+    if has_seed_image(kind, x, y, z):
+        return seed_image_file(kind, x, y, z)
+    filename = join(settings.IMAGE_DIR, kind, filename)
+    return filename if exists(filename) else None
 
-    location = Location(x, y, z)
 
-    # Add Neurosynth coactivation image if it exists
+def _coactivation_file(x, y, z):
     filename = 'metaanalytic_coactivation_%d_%d_%d_association-test_z_FDR_0.01.nii.gz' % (
         x, y, z)
-    filename = join(settings.IMAGE_DIR, 'coactivation', filename)
-    if not exists(filename):
-        tasks.make_coactivation_map.delay(x, y, z).wait()
-    if exists(filename):
+    return _location_image_file('coactivation', filename, x, y, z)
+
+
+def _fcmri_file(x, y, z):
+    filename = 'functional_connectivity_%d_%d_%d.nii.gz' % (x, y, z)
+    return _location_image_file('fcmri', filename, x, y, z)
+
+
+def _coactivation_done(x, y, z):
+    """ Whether the request was redirected back from a finished coactivation
+    job for the location (see _coactivation_job). If the map still doesn't
+    exist, the location has none. """
+    return job_succeeded(request.args.get('job'), tasks.make_coactivation_map,
+                         (x, y, z))
+
+
+def _coactivation_job(x, y, z):
+    """ If the client asked for an asynchronous response and the coactivation
+    map for a new location doesn't exist yet, start making it and return a 202
+    response that redirects back to the current request once it's done.
+    Returns None otherwise. """
+    if wants_async() and _coactivation_file(x, y, z) is None and \
+            not _coactivation_done(x, y, z):
+        return submit(tasks.make_coactivation_map, (x, y, z),
+                      next_url=_job_url)
+    return None
+
+
+def _job_url(job_id):
+    """ Return the URL of the current request, passing it the given job. """
+    args = dict(request.view_args, **request.args.to_dict())
+    args['job'] = job_id
+    return url_for(request.url_rule.endpoint, **args)
+
+
+def make_location(x, y, z):
+
+    location = Location(x, y, z)
+
+    # Add Neurosynth coactivation image, making it if needed
+    filename = _coactivation_file(x, y, z)
+    if filename is None and not _coactivation_done(x, y, z):
+        # Concurrent requests for a new location share one meta-analysis
+        delay_once(tasks.make_coactivation_map, (x, y, z)).wait()
+        filename = _coactivation_file(x, y, z)
+    if filename is not None:
         ma_image = LocationImage(
             name='Meta-analytic coactivation for seed (%d, %d, %d)' % (
                 x, y, z),
@@ -107,9 +169,8 @@ def make_location(x, y, z):
         location.images.append(ma_image)
 
     # Add Yeo FC image if it exists
-    filename = join(settings.IMAGE_DIR, 'fcmri',
-                    'functional_connectivity_%d_%d_%d.nii.gz' % (x, y, z))
-    if exists(filename):
+    filename = _fcmri_file(x, y, z)
+    if filename is not None:
         fc_image = LocationImage(
             name='YeoBucknerFCMRI for seed (%d, %d, %d)' % (x, y, z),
             image_file=filename,
@@ -156,13 +217,6 @@ def handle_redirected_location(error):
     return redirect(error.url, error.status_code)
 
 
-def make_cache_key():
-    ''' Replace default cache key prefix with a string that also includes
-    query arguments. '''
-    return request.path + request.query_string.decode('utf-8') + \
-        str(current_user.is_authenticated)
-
-
 def get_params(val=None, location=False):
     ''' Extract x/y/z and radius from either URL route or query parameters '''
     if val is None:
@@ -180,8 +234,8 @@ def get_params(val=None, location=False):
     # Check validity and redirect if necessary
     check_xyz(x, y, z)
 
-    if radius > 20:
-        radius = 20
+    if radius > MAX_RADIUS:
+        radius = MAX_RADIUS
     if location:
         return Location.query.filter_by(x=x, y=y, z=z).first()
     return (x, y, z, radius)
@@ -199,11 +253,14 @@ def check_xyz(x, y, z):
 
 @bp.route('/<string:val>/images')
 @bp.route('/images/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(XYZ), unless=wants_async)
 def get_images(val=None):
     location = get_params(val, location=True)
     if location is None:
         x, y, z, r = get_params(val)
+        job = _coactivation_job(x, y, z)
+        if job is not None:
+            return job
         location = make_location(x, y, z)
 
     images = [{
@@ -224,7 +281,8 @@ def get_images(val=None):
 
 @bp.route('/<string:val>/compare/')
 @bp.route('/compare/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(dict(XYZ, set='terms_20k')),
+              unless=wants_async)
 def compare_location(val=None, decimals=2):
     """ Compare this voxel to various image sets using various approaches.
     Currently returns correlations between the coactivation/functional
@@ -232,9 +290,18 @@ def compare_location(val=None, decimals=2):
     plus activation data at this location.
     """
     x, y, z, radius = get_params(val)
-    location = get_params(val, location=True) or make_location(x, y, z)
-    ma = list(zip(*get_decoding_data(location.images[0].id, get_json=False)))
-    fc = list(zip(*get_decoding_data(location.images[1].id, get_json=False)))
+    location = get_params(val, location=True)
+    if location is None:
+        job = _coactivation_job(x, y, z)
+        if job is not None:
+            return job
+        location = make_location(x, y, z)
+    # get_decoding_data returns an error page if an image can't be decoded
+    decodings = [get_decoding_data(img.id, get_json=False)
+                 for img in location.images[:2]]
+    if len(decodings) < 2 or not all(isinstance(d, list) for d in decodings):
+        abort(404)
+    ma, fc = [list(zip(*d)) for d in decodings]
     ma = pd.Series(ma[1], index=ma[0], name='ma')
     fc = pd.Series(fc[1], index=fc[0], name='fc')
     # too many gene maps to slice into, so return NAs
@@ -253,36 +320,42 @@ def compare_location(val=None, decimals=2):
 
 @bp.route('/<string:val>/studies/')
 @bp.route('/studies/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(dict(XYZR, dt=None),
+                                                        LIMITS))
 def get_studies(val=None):
     x, y, z, radius = get_params(val)
-    points = Peak.closestPeaks(radius, x, y, z)
-
-    # Track number of peaks and study details for each found study,
-    # keeping only peaks that haven't been previously seen for current
-    # study/x/y/z combination.
-    seen = {}
-    study_counts = defaultdict(list)
-    for p in points:
-        key = hash((p.pmid, round(p.x, 2), round(p.y, 2), round(p.z, 2)))
-        if key in seen:
-            next
-        study_counts[p.pmid].append(p)
-        seen[key] = 1
+    studies = Peak.closestStudies(radius, x, y, z)
 
     if 'dt' in request.args:
-        data = []
-        for pmid, peaks in study_counts.items():
-            s = peaks[0].study
-            link = '<a href={0}>{1}</a>'.format(url_for('studies.show',
-                                                        val=pmid), s.title)
-            data.append([link, s.authors, s.journal, len(peaks)])
+        data = _study_rows(studies)
     else:
-        data = [{'pmid': pmid, 'peaks': len(peaks)}
-                for pmid, peaks in study_counts.items()]
+        data = [{'pmid': pmid, 'peaks': n_peaks}
+                for (pmid, n_peaks) in studies]
     return jsonify(data=data)
 
 
+def _study_rows(studies):
+    """ Return DataTables rows (link, authors, journal, number of peaks) for
+    a list of (pmid, number of peaks) tuples. """
+    pmids = [pmid for (pmid, n_peaks) in studies]
+    details = {}
+    # Fetch in batches to stay within the bound parameter limits of SQLite
+    for start in range(0, len(pmids), 500):
+        rows = db.session.query(
+            Study.pmid, Study.title, Study.authors, Study.journal).filter(
+            Study.pmid.in_(pmids[start:start + 500]))
+        details.update((r[0], r[1:]) for r in rows)
+    data = []
+    for (pmid, n_peaks) in studies:
+        if pmid not in details:
+            continue
+        title, authors, journal = details[pmid]
+        link = '<a href={0}>{1}</a>'.format(url_for('studies.show',
+                                                    val=pmid), title)
+        data.append([link, authors, journal, n_peaks])
+    return data
+
+
 @bp.route('/<string:val>/')
 def location_api(val):
     args = [int(i) for i in val.split('_')]
@@ -292,12 +365,9 @@ def location_api(val):
 
     ### PEAKS ###
     # Limit search to 20 mm to keep things fast
-    if radius > 20:
-        radius = 20
-    points = Peak.closestPeaks(radius, x, y, z)
-    points = points.group_by(Peak.pmid)  # prevents duplicate studies
-    # counts duplicate peaks
-    points = points.add_columns(func.count(Peak.id))
+    if radius > MAX_RADIUS:
+        radius = MAX_RADIUS
+    studies = Peak.closestStudies(radius, x, y, z)
 
     ### IMAGES ###
     location = Location.query.filter_by(x=x, y=y, z=z).first()
@@ -305,17 +375,11 @@ def location_api(val):
     images = [{'label': i.label, 'id': i.id} for i in images if i.display]
 
     if 'draw' in request.args:
-        data = []
-        for p in points:
-            s = p[0].study
-            link = '<a href={0}>{1}</a>'.format(
-                url_for('studies.show', val=s.pmid), s.title)
-            data.append([link, s.authors, s.journal, p[1]])
-        data = jsonify(data=data)
+        data = jsonify(data=_study_rows(studies))
     else:
         data = {
-            'studies': [{'pmid': p[0].study.pmid, 'peaks':p[1]}
-                        for p in points],
+            'studies': [{'pmid': pmid, 'peaks': n_peaks}
+                        for (pmid, n_peaks) in studies],
             'images': images
         }
         data = jsonify(data=data)
@@ -1,7 +1,6 @@
 from nsweb.core import marshmallow as mm
-from nsweb.initializers import settings
+from nsweb.tasks.results import load_decoding
 from flask import url_for
-from os.path import join
 
 
 class PeakSchema(mm.Schema):
@@ -58,10 +57,11 @@ class LocationSchema(mm.Schema):
 class DecodingSchema(mm.Schema):
 
     def get_values(self, dec):
-        data = open(join(settings.DECODING_RESULTS_DIR,
-                         dec.uuid + '.txt')).read().splitlines()
-        data = [x.split('\t') for x in data]
-        return dict([(f, round(float(v), 3)) for (f, v) in data if v.strip()])
+        data = load_decoding(dec.decoding_set.name, dec.uuid)
+        if data is None:
+            return {}
+        data = data.dropna().round(3)
+        return dict([(f, float(v)) for (f, v) in data.items()])
 
     image = mm.Nested('ImageSchema', allow_null=True)
     reference = mm.Function(lambda obj: obj.decoding_set.name)
@@ -1,9 +1,12 @@
-from .utils import make_cache_key
-from flask import jsonify, request, Blueprint, url_for
+from .utils import cache_key
+from flask import (jsonify, request, Blueprint, url_for, send_file, Response,
+                   stream_with_context)
 from flask_user import login_required
 from nsweb.api.schemas import StudySchema
-from nsweb.models.studies import Study
+from nsweb.models.studies import Study, studies_json_file, iter_studies_json
+from nsweb.initializers.build_version import get_build_version
 from nsweb.core import cache
+from os.path import exists
 import urllib
 import re
 from nsweb import tasks
@@ -11,9 +14,14 @@ from nsweb import tasks
 
 bp = Blueprint('api_studies', __name__, url_prefix='/api/studies')
 
+# Maximum number of results per page
+MAX_LIMIT = 100
+
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'limit': 25, 'page': 1, 'pmid': None, 'id': None, 'search': None},
+    limits={'limit': MAX_LIMIT}))
 def get_studies():
     """
     Retrieve study data
@@ -51,7 +59,6 @@ def get_studies():
             type: integer
     """
     DEFAULT_LIMIT = 25
-    MAX_LIMIT = 100
     limit = int(request.args.get('limit', DEFAULT_LIMIT))
     limit = min(limit, MAX_LIMIT)
     page = int(request.args.get('page', 1))
@@ -97,7 +104,9 @@ def get_tables(val):
 
 
 @bp.route('/dt/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(
+    {'expression': None, 'draw': None, 'length': None, 'start': None,
+     'order[0][column]': None, 'order[0][dir]': None, 'search[value]': None}))
 def get_study_list():
 
     if 'expression' in request.args:
@@ -177,11 +186,19 @@ def get_all_studies():
     """
     :return: JSON object containing all studies
     """
-    key = str(Study.query.count())
-    if request.headers.get('If-None-Match') == key:
+    key = 'studies-' + get_build_version()
+    if request.if_none_match.contains(key):
         return '', 304, {}
-    all_studies = Study.query.all()
-    response = jsonify(dict(studies=[s.serialize() for s in all_studies]))
-    response.headers['ETag'] = key
+    filename = studies_json_file()
+    if 'gzip' in request.accept_encodings and exists(filename):
+        response = send_file(filename, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        # Stream rows from the DB, saving a gzipped copy for later requests
+        chunks = iter_studies_json(save=not exists(filename))
+        response = Response(stream_with_context(chunks),
+                            mimetype='application/json')
+    response.set_etag(key)
+    response.headers['Vary'] = 'Accept-Encoding'
     response.headers['Cache-Control'] = 'max-age=600'
     return response
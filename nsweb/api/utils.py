@@ -1,17 +1,55 @@
 from flask import send_file, abort, request
 from nsweb.initializers.settings import IMAGE_DIR
+from nsweb.tasks.seed_store import write_nifti
+from urllib.parse import urlencode
 import datetime as dt
 import os
 
 
-def make_cache_key():
-    ''' Replace default cache key prefix with a string that also includes
-    query arguments. '''
-    return request.path + request.query_string.decode('utf-8')
+def cache_key(params=None, limits=None):
+    """ Return a function that makes the cache key of a request, for use as
+    the key_prefix of cache.cached. Requests that differ only in the order of
+    their query arguments, in leaving out arguments that have a default, or
+    in exceeding the same limits get the same key.
+    Args:
+        params (dict): the query arguments the response depends on, mapped to
+            their defaults (None if there is none). Other arguments are left
+            out of the key. Values of arguments with an int default are
+            compared as ints; a default of int marks a required int
+            argument, which is never filled in. If None, all arguments are
+            included as given.
+        limits (dict): maximum values of int arguments, which the view clamps
+            them to.
+    """
+    limits = limits or {}
+
+    def make_key():
+        args = request.args
+        names = sorted(args if params is None else params)
+        values = []
+        for name in names:
+            default = None if params is None else params[name]
+            value = args.get(name, None if default is int else default)
+            if value is None:
+                continue
+            if default is int or isinstance(default, int):
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+                else:
+                    if name in limits:
+                        value = min(value, limits[name])
+            values.append((name, str(value)))
+        return request.path + '?' + urlencode(values)
+    return make_key
 
 
 def send_nifti(filename, attachment_filename=None):
     """ Sends back a cache-controlled nifti image to the browser """
+    # Location images are stored compactly and only written out as NIfTI
+    # files when downloaded
+    filename = write_nifti(filename)
     if not os.path.exists(filename) or '..' in filename or \
             '.nii' not in filename:
         abort(404)
@@ -20,6 +20,10 @@ def index():
             template = 'index'
         return render_template('decode/%s.html' % template)
 
+    if getattr(dec, 'job_id', None) is not None:
+        # Still running in the background
+        return render_template('decode/pending.html'), 202
+
     return show(dec, dec.uuid)
 
 
@@ -21,6 +21,9 @@ def show(symbol):
     image = gene.images[0]
     # Run decoder if it hasn't been run before
     dec = decode_analysis_image(image.id)
+    if dec is None:
+        return error_page("An error occurred while decoding the gene '%s'"
+                          % symbol)
     url = url_for('api_images.download', val=image.id)
     images = [{
         'id': image.id,
@@ -1,6 +1,6 @@
 from nsweb.core import cache
-from nsweb.api.utils import make_cache_key
-from nsweb.api.locations import get_params
+from nsweb.api.utils import cache_key
+from nsweb.api.locations import get_params, XYZR, LIMITS
 from flask import Blueprint, render_template
 
 
@@ -9,7 +9,7 @@ bp = Blueprint('locations', __name__, url_prefix='/locations')
 
 @bp.route('/')
 @bp.route('/<string:val>/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=cache_key(XYZR, LIMITS))
 def show(val=None):
     x, y, z, radius = get_params(val)
     return render_template('locations/index.html', radius=radius,
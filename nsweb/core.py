@@ -25,7 +25,13 @@ app = Flask('NSWeb', static_folder=settings.STATIC_FOLDER,
             template_folder=settings.TEMPLATE_FOLDER)
 
 # Caching
-cache = Cache(config={'CACHE_TYPE': 'simple'})
+cache = Cache(config={
+    'CACHE_TYPE': settings.RESPONSE_CACHE_TYPE,
+    'CACHE_REDIS_URL': settings.RESPONSE_CACHE_REDIS_URL,
+    'CACHE_LOCAL_SIZE': settings.RESPONSE_CACHE_LOCAL_SIZE,
+    'CACHE_LOCAL_SIZES': settings.RESPONSE_CACHE_LOCAL_SIZES,
+    'CACHE_LOCAL_TIMEOUT': settings.RESPONSE_CACHE_LOCAL_TIMEOUT
+})
 
 # Initialize celery
 celery = make_celery(app)
@@ -126,6 +132,7 @@ def register_blueprints():
         'nsweb.api.studies',
         'nsweb.api.decode',
         'nsweb.api.genes',
+        'nsweb.api.jobs',
         'nsweb.controllers.home',
         'nsweb.controllers.analyses',
         # 'nsweb.controllers.custom',
@@ -1,5 +1,25 @@
 from celery import Celery, Task
 from nsweb.initializers import settings
+from nsweb.initializers import settings_template
+from os.path import join
+import os
+
+
+def _add_missing_settings():
+    """ Settings files copied from older templates lack newer settings; fall
+    back on the template's values for those. Paths in the template's data
+    directory are moved to the deployment's. """
+    data_dir = settings_template.DATA_DIR + os.sep
+    for name in dir(settings_template):
+        if not name.isupper() or hasattr(settings, name):
+            continue
+        value = getattr(settings_template, name)
+        if isinstance(value, str) and value.startswith(data_dir):
+            value = join(settings.DATA_DIR, value[len(data_dir):])
+        setattr(settings, name, value)
+
+
+_add_missing_settings()
 
 
 def make_celery(app):
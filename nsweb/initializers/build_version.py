@@ -0,0 +1,41 @@
+""" Version of the current database build. The DatabaseBuilder bumps it when
+it (re)loads data, so that processes holding anything derived from the
+database (in-memory indexes, cached responses, etc.) can tell when it is
+stale. The version is kept in a file so all processes of the app share it. """
+from nsweb.initializers import settings
+from datetime import datetime
+import os
+from os.path import dirname, join, exists
+
+
+_version = None
+_stat = None
+
+
+def get_build_version():
+    """ Return the current build version as a string, or '0' if the database
+    has never been built. The file is only re-read when it changes. """
+    global _version, _stat
+    try:
+        st = os.stat(settings.BUILD_VERSION_FILE)
+    except OSError:
+        return '0'
+    stat = (st.st_ino, st.st_mtime, st.st_size)
+    if stat != _stat:
+        with open(settings.BUILD_VERSION_FILE) as f:
+            _version = f.read().strip() or '0'
+        _stat = stat
+    return _version
+
+
+def bump_build_version():
+    """ Mark the data as changed by setting a new build version. """
+    version = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    filename = settings.BUILD_VERSION_FILE
+    if not exists(dirname(filename)):
+        os.makedirs(dirname(filename))
+    tmp = join(dirname(filename), '.%d_build_version' % os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, filename)
+    return version
@@ -0,0 +1,129 @@
+""" Warm up the response cache by requesting the most popular URLs, e.g.,
+after a deploy or after the database has been rebuilt. Popularity is taken
+from the nginx access logs and from the Download table. Requests go through
+the Flask test client, so they fill the same caches (responses, decodings,
+coactivation maps, etc.) real requests would. """
+from nsweb.core import app, db
+from nsweb.models.downloads import Download
+from nsweb.models.images import Image, LocationImage
+from nsweb.models.locations import Location
+from sqlalchemy import func
+from werkzeug.exceptions import HTTPException
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import traceback
+import glob
+import gzip
+import re
+
+
+# URLs to warm up regardless of their popularity
+DEFAULT_URLS = ['/api/analyses/term_names/', '/api/studies/all/']
+
+# Endpoints that are worth requesting without a response cache, as they
+# build their own
+EXTRA_ENDPOINTS = {'api_studies.get_all_studies'}
+
+# Query arguments that would keep a request from being cached
+IGNORED_ARGS = {'async', '_'}
+
+# GET requests with their status in the nginx combined log format
+LOG_REQUEST = re.compile(r'"GET (\S+) HTTP/[\d.]+" (\d{3}) ')
+
+
+def _normalize(url):
+    """ Return the URL with its query arguments sorted and irrelevant ones
+    removed, or None if requesting it wouldn't fill any cache. """
+    parts = urlsplit(url)
+    try:
+        endpoint, _ = app.url_map.bind('').match(unquote(parts.path),
+                                                 method='GET')
+    except HTTPException:
+        return None
+    view = app.view_functions.get(endpoint)
+    if not hasattr(view, 'uncached') and endpoint not in EXTRA_ENDPOINTS:
+        return None
+    args = sorted((k, v) for (k, v) in parse_qsl(parts.query, True)
+                  if k not in IGNORED_ARGS)
+    return parts.path + ('?' + urlencode(args) if args else '')
+
+
+def count_log_urls(filenames):
+    """ Count successful GET requests of each URL in nginx access logs,
+    which may be gzipped. """
+    counts = Counter()
+    for filename in filenames:
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt', errors='replace') as f:
+            for line in f:
+                match = LOG_REQUEST.search(line)
+                if match and match.group(2) in ('200', '304'):
+                    counts[match.group(1)] += 1
+    return counts
+
+
+def count_download_urls(limit=1000):
+    """ Map the most downloaded images to the API requests that decode them
+    (and, for location images, that show their location), weighted by the
+    number of downloads. """
+    n = func.count(Download.id)
+    rows = db.session.query(Download.image_id, n).join(Image).filter_by(
+        display=True).group_by(Download.image_id).order_by(
+        n.desc()).limit(limit).all()
+    counts = Counter({'/api/decode/?image=%d' % image_id: count
+                      for (image_id, count) in rows})
+    ids = [image_id for (image_id, count) in rows]
+    if ids:
+        locations = db.session.query(LocationImage.id, Location.x,
+                                     Location.y, Location.z).join(
+            Location, LocationImage.location_id == Location.id).filter(
+            LocationImage.id.in_(ids))
+        downloads = dict(rows)
+        for (image_id, x, y, z) in locations:
+            url = '/api/locations/?x=%d&y=%d&z=%d' % (x, y, z)
+            counts[url] += downloads[image_id]
+    return counts
+
+
+def hot_urls(log_pattern=None, limit=1000):
+    """ Return the limit most popular URLs worth warming up, most popular
+    first, preceded by the DEFAULT_URLS.
+    Args:
+        log_pattern (str): glob pattern of the nginx access logs to count
+            requests in. If None, logs aren't used.
+        limit (int): maximum number of URLs to return.
+    """
+    counts = count_download_urls(limit)
+    if log_pattern is not None:
+        counts += count_log_urls(sorted(glob.glob(log_pattern)))
+    ranked = Counter()
+    for url, count in counts.items():
+        url = _normalize(url)
+        if url is not None:
+            ranked[url] += count
+    urls = list(DEFAULT_URLS)
+    urls += [url for (url, count) in ranked.most_common()
+             if url not in DEFAULT_URLS]
+    return urls[:limit]
+
+
+def _request(url):
+    try:
+        # Read the whole response, so streamed ones are generated in full
+        return app.test_client().get(url, buffered=True).status_code
+    except Exception:
+        print(traceback.format_exc())
+        return None
+
+
+def warm_urls(urls, n_threads=4):
+    """ Request all URLs, with at most n_threads requests at a time, and
+    return the status code of each (None for requests that raised). """
+    statuses = []
+    with ThreadPoolExecutor(n_threads) as executor:
+        for i, (url, status) in enumerate(
+                zip(urls, executor.map(_request, urls))):
+            print("%d/%d %s %s" % (i + 1, len(urls), status, url))
+            statuses.append(status)
+    return statuses
@@ -1,13 +1,17 @@
 
 from nsweb.models.analyses import TermAnalysis, TopicAnalysis, AnalysisSet
-from nsweb.models.studies import Study
-from nsweb.models.peaks import Peak
+from nsweb.models.studies import Study, iter_studies_json
+from nsweb.models.peaks import Peak, PeakIndex, VoxelStudyIndex
 from nsweb.models.frequencies import Frequency
 from nsweb.models.decodings import DecodingSet
 from nsweb.models.images import (TermAnalysisImage, GeneImage,
                                  TopicAnalysisImage)
 from nsweb.models.genes import Gene
 from nsweb.initializers import settings
+from nsweb.initializers.build_version import bump_build_version
+from nsweb.tasks.decoding import quantize, dequantize, chunk_rows
+from nsweb.tasks.similarity import SketchIndex
+from nsweb.tasks.image_cache import cached_mask
 import os
 from os.path import join, basename, exists
 from neurosynth import Masker
@@ -15,14 +19,267 @@ from neurosynth.base.dataset import Dataset
 from neurosynth.analysis import meta
 import neurosynth as ns
 import numpy as np
+import nibabel as nb
 import pandas as pd
 import random
 from glob import glob
+from collections import OrderedDict
 import json
+import multiprocessing
 import re
 import shutil
 import urllib
 import traceback
+from datetime import datetime
+
+
+def _tmp_file(filename):
+    """ Return the name of a temporary file to write filename's new contents
+    to before swapping it in. """
+    return join(os.path.dirname(filename),
+                '.%d_%s' % (os.getpid(), basename(filename)))
+
+
+def _copy_memmap(mm_file, out_file, dtype, n_rows, n_cols, n_new,
+                 chunk_size=64):
+    """ Copy a voxels x images memmap file to out_file, adding n_new empty
+    columns, in blocks of at most chunk_size MB. """
+    old = np.memmap(mm_file, dtype=dtype, mode='r', shape=(n_rows, n_cols))
+    new = np.memmap(out_file, dtype=dtype, mode='w+',
+                    shape=(n_rows, n_cols + n_new))
+    step = chunk_rows(n_cols + n_new, chunk_size, np.dtype(dtype).itemsize)
+    for start in range(0, n_rows, step):
+        new[start:start + step, :n_cols] = old[start:start + step]
+    new.flush()
+    del old, new
+
+
+# Masker used to load images in each ingestion process (see _mask_image)
+_masker = None
+_mask_file = None
+
+
+def _init_masker(mask_file):
+    global _masker, _mask_file
+    _masker = Masker(mask_file)
+    _mask_file = mask_file
+
+
+def _mask_image(img_file):
+    """ Load an image within the brain mask, as float32 to halve the cost of
+    sending it back from a worker process. """
+    data = cached_mask(_mask_file, img_file, _masker.mask)
+    return np.asarray(data, dtype='float32')
+
+
+class _MemmapWriter(object):
+    """ Writes standardized images into one memory-mapped reference set,
+    either creating it or updating an existing one (see
+    DatabaseBuilder.memory_map_images). Images are passed to write() in
+    blocks, as full-mask vectors, so that several memmaps can be filled from a
+    single pass over the source files.
+    Args:
+        name: name of the memmap.
+        images: list of image files.
+        labels: list of image labels.
+        sources: list of (file, mtime) tuples identifying the data loaded for
+            each image.
+        voxels: voxels to keep; None for all voxels in the mask, an int to
+            randomly select that many voxels, or an array of voxel indices.
+        mask_voxels: number of voxels in the mask.
+        update, transpose, dtype: see DatabaseBuilder.memory_map_images.
+    """
+
+    def __init__(self, name, images, labels, sources, voxels, mask_voxels,
+                 update=False, transpose=False, dtype='float32'):
+
+        mm_dir = settings.MEMMAP_DIR
+        self.name = name
+        self.md_file = join(mm_dir, '%s_metadata.json' % name)
+        self.lab_file = join(mm_dir, '%s_labels.txt' % name)
+        self.stat_file = join(mm_dir, '%s_stats.txt' % name)
+        self.mom_file = join(mm_dir, '%s_moments.txt' % name)
+        self.mm_file = join(mm_dir, '%s_images.dat' % name)
+        self.mm_T_file = join(mm_dir, '%s_images_T.dat' % name)
+        self.sketch_file = join(mm_dir, '%s_sketch.npz' % name)
+
+        metadata = json.load(open(self.md_file)) \
+            if exists(self.md_file) else None
+        # Versions keep increasing across rebuilds, so workers always notice
+        # new data
+        version = metadata.get('version', 0) if metadata is not None else 0
+        # Memmaps without a version predate incremental updates
+        if not update or metadata is None or 'version' not in metadata:
+            metadata = None
+
+        if metadata is None:
+            sampled_vox = np.arange(mask_voxels)
+            is_subsampled = (voxels is not None)
+            if voxels is not None:
+                # Either randomly select voxels, or use what was passed
+                # TODO: downsample image instead of randomly selecting voxels
+                if isinstance(voxels, int):
+                    sampled_vox = np.random.choice(sampled_vox, voxels,
+                                                   replace=False)
+                else:
+                    sampled_vox = voxels
+                np.save(join(mm_dir, '%s_voxels.npy' % name), sampled_vox)
+
+            metadata = {
+                'name': name,
+                'n_voxels': len(sampled_vox),
+                'n_images': 0,
+                'is_subsampled': is_subsampled,
+                'layouts': ['voxel', 'image'] if transpose else ['voxel'],
+                'dtype': dtype,
+                'version': version,
+                'sources': {}
+            }
+            old_labels = []
+            # Any existing sketch index no longer matches the data
+            if exists(self.sketch_file):
+                os.unlink(self.sketch_file)
+        else:
+            # The same voxels must be sampled as in the original build
+            sampled_vox = np.arange(mask_voxels)
+            if metadata['is_subsampled']:
+                sampled_vox = np.load(join(mm_dir, '%s_voxels.npy' % name))
+            old_labels = open(self.lab_file).read().splitlines()
+
+        # Images to write, as (column, image, source) tuples. Images with new
+        # labels are appended; others are only written if their source file
+        # has changed since the last build.
+        columns = dict(zip(old_labels, range(len(old_labels))))
+        new_labels = [l for l in labels if l not in columns]
+        self.labels = old_labels + new_labels
+        columns.update(zip(new_labels, range(len(old_labels),
+                                             len(self.labels))))
+        self.targets = [(columns[l], img, src) for (l, img, src)
+                        in zip(labels, images, sources)
+                        if metadata['sources'].get(l) != list(src)]
+        self.metadata = metadata
+        self.sampled_vox = sampled_vox
+        self.n_old = len(old_labels)
+        self.n_new = len(new_labels)
+
+    def open(self):
+        """ Initialize or grow the memmaps and load the per-image stats.
+        Running workers map the current files, and hold on to their stats, so
+        all data are written to new copies that close() swaps in. The
+        voxel-major copy is written in blocks of rows. """
+        n_voxels, n_old = len(self.sampled_vox), self.n_old
+        n_images = len(self.labels)
+        dtype = self.metadata['dtype']
+
+        if n_old == 0:
+            self.mm = np.memmap(_tmp_file(self.mm_file), dtype=dtype,
+                                mode='w+', shape=(n_voxels, n_images))
+        else:
+            _copy_memmap(self.mm_file, _tmp_file(self.mm_file), dtype,
+                         n_voxels, n_old, n_images - n_old)
+            self.mm = np.memmap(_tmp_file(self.mm_file), dtype=dtype,
+                                mode='r+', shape=(n_voxels, n_images))
+        self.mm_T = None
+        if 'image' in self.metadata['layouts']:
+            mm_T_file = _tmp_file(self.mm_T_file)
+            if n_old == 0:
+                open(mm_T_file, 'wb').close()
+            else:
+                shutil.copyfile(self.mm_T_file, mm_T_file)
+            with open(mm_T_file, 'r+b') as f:
+                f.truncate(n_images * n_voxels * np.dtype(dtype).itemsize)
+            self.mm_T = np.memmap(mm_T_file, dtype=dtype, mode='r+',
+                                  shape=(n_images, n_voxels))
+
+        # Key image stats--will need these to reconstruct raw values--and the
+        # column sums and sums of squares of the standardized data, which
+        # allow sparse input images to be decoded from their non-zero voxels
+        # only
+        self.stats = np.zeros((n_images, 7))
+        self.moments = np.zeros((n_images, 2))
+        if n_old:
+            self.stats[:n_old] = pd.read_csv(self.stat_file, sep='\t',
+                                             index_col=0).values
+            self.moments[:n_old] = pd.read_csv(self.mom_file, sep='\t',
+                                               index_col=0).values
+
+        # Keep an existing sketch index in sync with the data
+        self.sketch = None
+        if n_old and exists(self.sketch_file):
+            self.sketch = SketchIndex.load(self.sketch_file)
+            n_dims = self.sketch.sketches.shape[1]
+            self.sketch.sketches = np.vstack((
+                self.sketch.sketches,
+                np.zeros((n_images - n_old, n_dims), dtype='float32')))
+
+    def write(self, targets, images):
+        """ Standardize and store a block of images.
+        Args:
+            targets: the (column, image, source) tuples of the block.
+            images: the corresponding full-mask image vectors.
+        """
+        inds = [i for (i, img, src) in targets]
+        data = np.zeros((len(self.sampled_vox), len(inds)), dtype='float32')
+        for j, (i, raw) in enumerate(zip(inds, images)):
+            raw = raw[self.sampled_vox]
+            std, mean = raw.std(dtype='float64'), raw.mean(dtype='float64')
+            data[:, j] = (raw - mean) / std
+            self.stats[i, :4] = [raw.min(), raw.max(), mean, std]
+
+        # Quantize if needed, keeping scale/offset to dequantize later
+        data, scale, offset, error = quantize(data, self.metadata['dtype'])
+        self.stats[inds, 4:] = np.column_stack((scale, offset, error))
+        values = dequantize(data, scale, offset)
+        self.moments[inds, 0] = values.sum(0, dtype='float64')
+        self.moments[inds, 1] = np.square(values, dtype='float64').sum(0)
+        if self.sketch is not None:
+            self.sketch.sketches[inds] = self.sketch.projection.dot(values).T
+
+        self.mm[:, inds] = data
+        if self.mm_T is not None:
+            self.mm_T[inds] = data.T
+
+    def close(self):
+        """ Flush all data, write the labels, stats and metadata, and swap
+        the new files in. """
+        print("Flushing %s..." % self.name)
+        files = [self.mm_file]
+        self.mm.flush()
+        del self.mm
+        if self.mm_T is not None:
+            files.append(self.mm_T_file)
+            self.mm_T.flush()
+            del self.mm_T
+
+        dtype = self.metadata['dtype']
+        if dtype != 'float32':
+            print("Max. decoding error due to %s storage: %.2g" % (
+                dtype, self.stats[:, -1].max()))
+
+        files += [self.lab_file, self.stat_file, self.mom_file]
+        open(_tmp_file(self.lab_file), 'w').write('\n'.join(self.labels))
+        pd.DataFrame(self.stats, index=self.labels,
+                     columns=['min', 'max', 'mean', 'std', 'scale', 'offset',
+                              'max_error']).to_csv(
+            _tmp_file(self.stat_file), sep='\t')
+        pd.DataFrame(self.moments, index=self.labels,
+                     columns=['sum', 'sum_sq']).to_csv(
+            _tmp_file(self.mom_file), sep='\t')
+        if self.sketch is not None:
+            files.append(self.sketch_file)
+            self.sketch.save(_tmp_file(self.sketch_file))
+
+        # Write metadata last, so readers only pick up the new version once
+        # all data are in place (see nsweb.tasks.references.get_references)
+        for (i, img, src) in self.targets:
+            self.metadata['sources'][self.labels[i]] = list(src)
+        self.metadata['n_images'] = len(self.labels)
+        self.metadata['version'] += 1
+        self.metadata['updated_at'] = datetime.utcnow().isoformat()
+        files.append(self.md_file)
+        open(_tmp_file(self.md_file), 'w').write(json.dumps(self.metadata))
+        for f in files:
+            os.replace(_tmp_file(f), f)
 
 
 class DatabaseBuilder:
@@ -85,6 +342,7 @@ class DatabaseBuilder:
             join(settings.IMAGE_DIR, 'analyses'),
             join(settings.IMAGE_DIR, 'coactivation'),
             join(settings.IMAGE_DIR, 'custom'),
+            settings.SEED_STORE_DIR,
             settings.DECODING_RESULTS_DIR,
             settings.DECODING_SCATTERPLOTS_DIR,
             settings.DECODED_IMAGE_DIR,
@@ -157,6 +415,7 @@ class DatabaseBuilder:
         ''' Drop and re-create all tables. '''
         self.db.drop_all()
         self.db.create_all()
+        bump_build_version()
 
     def add_term_analyses(self, analyses=None, add_images=False,
                           image_dir=None, reset=False):
@@ -365,6 +624,33 @@ class DatabaseBuilder:
         # Update all analysis counts
         self._update_analysis_counts()
 
+        # Peaks have changed
+        bump_build_version()
+
+    def export_studies(self):
+        """ Save the gzipped JSON of all studies served by
+        /api/studies/all/. Call after the final bump of the build version. """
+        for chunk in iter_studies_json():
+            pass
+
+    def build_voxel_study_index(self, radii=None):
+        """ Precompute the studies with peaks near every in-brain voxel of the
+        anatomical template, so that location queries at the default radii
+        are single lookups.
+        Args:
+            radii: list of radii (in mm) to precompute. Defaults to
+                settings.VOXEL_STUDY_INDEX_RADII.
+        """
+        if radii is None:
+            radii = settings.VOXEL_STUDY_INDEX_RADII
+        if not exists(settings.MEMMAP_DIR):
+            os.makedirs(settings.MEMMAP_DIR)
+        anatomical = nb.load(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
+        mask = anatomical.get_data()
+        mask = mask.reshape(mask.shape[:3]) != 0
+        VoxelStudyIndex.build(PeakIndex.load(), settings.MEMMAP_DIR, mask,
+                              anatomical.get_affine(), radii)
+
     def _map_analysis_to_studies(self, analysis):
         pass
 
@@ -600,9 +886,33 @@ class DatabaseBuilder:
         self.db.session.commit()
 
     def memory_map_images(self, include=['terms', 'topics', 'genes'],
-                          reset=False):
+                          reset=False, transpose=False, dtype='float32',
+                          update=False, block_size=100, n_jobs=None):
         """ Create memory-mapped arrays containing all image data for one or
         more AnalysisSets.
+        Args:
+            include: list of image sets to memory-map.
+            reset: if True, deletes existing DecodingSet records.
+            transpose: if True, also saves an image-major (images x voxels)
+                copy of each memmap alongside the default voxel-major one.
+                Reading a single image from the image-major copy touches
+                contiguous pages, at the cost of twice the disk space.
+            dtype: storage type of the memmaps. One of 'float32', 'float16'
+                (half the size) or 'int16' (half the size, with a per-image
+                scale and offset stored in the stats file). The maximum
+                dequantization error of each image, which bounds the error in
+                its decoder correlations, is saved in the stats file as well.
+            update: if True, existing memmaps are updated in place rather than
+                rebuilt: images whose labels are new are appended as new
+                columns, and images whose source file has changed since the
+                last build are overwritten. All other images are left
+                untouched. The layouts and dtype of existing memmaps are kept,
+                and reset and transpose only apply to memmaps that don't exist
+                yet (or were built by a version without update support).
+            block_size: number of images to load into memory before writing
+                them to the memmaps.
+            n_jobs: number of processes used to load images. Defaults to the
+                number of CPUs; pass 1 to load images in this process.
         """
 
         mm_dir = settings.MEMMAP_DIR
@@ -610,150 +920,198 @@ class DatabaseBuilder:
             os.makedirs(mm_dir)
 
         # Get mask
-        masker = Masker(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
+        mask_file = join(settings.IMAGE_DIR, 'anatomical.nii.gz')
+        masker = Masker(mask_file)
         mask_voxels = np.sum(masker.current_mask)
 
-        def save_memmap(name, analysis_set, images, labels, voxels=None):
-
-            # Delete old versions
-            if reset:
-                dec = DecodingSet.query.filter_by(name=name).all()
-                for ds in dec:
-                    self.db.session.delete(ds)
-
-            # print term_labels
-            open(join(mm_dir, '%s_labels.txt' % name), 'w') \
-                .write('\n'.join(labels))
-
-            sampled_vox = np.arange(mask_voxels)
-            is_subsampled = (voxels is not None)
-            if voxels is not None:
-                # Either randomly select voxels, or use what was passed
-                # TODO: downsample image instead of randomly selecting voxels
-                if isinstance(voxels, int):
-                    sampled_vox = np.random.choice(sampled_vox, voxels,
-                                                   replace=False)
-                else:
-                    sampled_vox = voxels
-                np.save(join(mm_dir, '%s_voxels.npy' % name), sampled_vox)
-
-            # Initialize memmap
-            n_images = len(images)
-            mm_file = join(mm_dir, '%s_images.dat' % name)
-            temp_map = np.zeros((len(sampled_vox), n_images), dtype='float32')
-
-            # Save key image stats--will need these to reconstruct raw values
-            stats = np.zeros((n_images, 4))
-
-            # Populate with standardized image data
-            for i, img in enumerate(images):
-                if not i % 100:
-                    print("Processing image %i..." % i)
-                # Use unthresholded maps when possible
-                img_file = re.sub('_FDR_*nii.gz', '.nii.gz', img)
-                data = masker.mask(img_file)[sampled_vox]
-                std, mean = data.std(), data.mean()
-                temp_map[:, i] = (data - mean) / std
-                stats[i, :] = [data.min(), data.max(), mean, std]
-
-            stats = pd.DataFrame(stats, index=labels,
-                                 columns=['min', 'max', 'mean', 'std'])
-            stats.to_csv(join(mm_dir, '%s_stats.txt' % name), sep='\t')
-
-            # Write metadata
-            metadata = {
-                'name': name,
-                'n_voxels': len(sampled_vox),
-                'n_images': n_images,
-                'is_subsampled': is_subsampled
-            }
-            md_file = join(mm_dir, '%s_metadata.json' % name)
-            open(md_file, 'w').write(json.dumps(metadata))
-
-            # Copy to memmap
-            print("Initializing memmap...")
-            mm = np.memmap(mm_file, dtype='float32', mode='w+',
-                           shape=(len(sampled_vox), n_images))
-            print("Storing data...")
-            mm[:] = temp_map[:]
-            print("Flushing...")
-            del mm
-
-            # Create DB record
-            self.db.session.add(
-                DecodingSet(name=name, n_images=n_images,
-                            n_voxels=len(sampled_vox),
-                            is_subsampled=is_subsampled,
-                            analysis_set=analysis_set))
-            self.db.session.commit()
+        # Loading (decompressing and masking) images dominates the build
+        # time, so images are loaded by a pool of processes
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs, _init_masker, (mask_file,))
+            load_images = pool.map
+        else:
+            pool = None
+            _init_masker(mask_file)
+            load_images = map
+
+        def get_source(img):
+            # Use unthresholded maps when possible
+            img_file = re.sub('_FDR_*nii.gz', '.nii.gz', img)
+            return img_file, os.path.getmtime(img_file)
+
+        def save_memmaps(memmaps, analysis_set, images, labels):
+            """ Save one or more memmaps of the same images, given as a list
+            of (name, voxels) tuples. Each image is loaded only once. """
+            sources = [get_source(img) for img in images]
+            writers = [_MemmapWriter(name, images, labels, sources, voxels,
+                                     mask_voxels, update, transpose, dtype)
+                       for (name, voxels) in memmaps]
+
+            for w in writers:
+                if not w.targets:
+                    print("Memmap %s is up to date." % w.name)
+                    continue
+                print("Writing %d images (%d new) to memmap %s..." % (
+                    len(w.targets), w.n_new, w.name))
+                # Delete old versions
+                if reset and w.n_old == 0:
+                    dec = DecodingSet.query.filter_by(name=w.name).all()
+                    for ds in dec:
+                        self.db.session.delete(ds)
+                w.open()
+            writers = [w for w in writers if w.targets]
+
+            # Load each source file needed by any memmap once, in blocks,
+            # and pass each block on to every memmap that needs it
+            needed = set(src for w in writers for (i, img, src) in w.targets)
+            needed = list(OrderedDict.fromkeys(
+                src for src in sources if src in needed))
+            for start in range(0, len(needed), block_size):
+                print("Processing image %i of %i..." % (start, len(needed)))
+                block = needed[start:start + block_size]
+                data = dict(zip(block, load_images(
+                    _mask_image, [f for (f, mtime) in block])))
+                for w in writers:
+                    targets = [t for t in w.targets if t[2] in data]
+                    if targets:
+                        w.write(targets, [data[t[2]] for t in targets])
+
+            for w in writers:
+                w.close()
+                # Create or update DB record
+                ds = DecodingSet.query.filter_by(name=w.name).first()
+                if w.n_old == 0 or ds is None:
+                    ds = DecodingSet(
+                        name=w.name, n_voxels=len(w.sampled_vox),
+                        is_subsampled=w.metadata['is_subsampled'],
+                        analysis_set=analysis_set)
+                ds.n_images = len(w.labels)
+                self.db.session.add(ds)
+                self.db.session.commit()
 
-        ### TERMS ###
-        if 'terms' in include:
-
-            print("\tCreating memmap of term image data...")
-
-            analysis_set = AnalysisSet.query \
-                .filter_by(type='terms').first()
-
-            # Get all images and save labels
-            images = [a.images[1].image_file for a in analysis_set.analyses]
-            labels = [a.name for a in analysis_set.analyses]
-
-            print("\t\tFound %d images." % len(images))
-
-            # save both full and 20k voxel arrays
-            save_memmap('terms_full', analysis_set, images, labels)
-            save_memmap('terms_20k', analysis_set, images, labels, 20000)
-            # also save posterior probability images
-            images = [img.replace('_association-test_z_FDR_0.01',
-                                  '_pFgA_given_pF=0.50')
-                      for img in images]
-            save_memmap('terms_pp_unif', analysis_set, images, labels)
-            images = [img.replace('_association-test_z_FDR_0.01', '_pFgA')
-                      for img in images]
-            save_memmap('terms_pp_emp', analysis_set, images, labels)
-
-        ### TOPICS ###
-        if 'topics' in include:
-
-            print("\tCreating memmap of topic image data...")
-
-            analysis_set = AnalysisSet.query \
-                .filter_by(name='v4-topics-100').first()
-
-            # Get all images and save labels
-            images = [a.images[1].image_file for a in analysis_set.analyses]
-            labels = [a.name for a in analysis_set.analyses]
-
-            print("\t\tFound %d images." % len(images))
-
-            # save both full and 20k voxel arrays
-            save_memmap('topics_full', analysis_set, images, labels)
-            save_memmap('topics_20k', analysis_set, images, labels, 20000)
-            # also save posterior probability images
-            images = [img.replace('_association-test_z_FDR_0.01',
-                                  '_pFgA_given_pF=0.50')
-                      for img in images]
-            save_memmap('topics_pp_unif', analysis_set, images, labels)
-            images = [img.replace('_association-test_z_FDR_0.01', '_pFgA')
-                      for img in images]
-            save_memmap('topics_pp_emp', analysis_set, images, labels)
-
-        ### GENES ###
-        if 'genes' in include:
-
-            print("\tCreating memmap of gene image data...")
-
-            # Get all images and save labels
-            genes = Gene.query.all()
-            images = [g.images[0].image_file for g in genes]
-            labels = [g.symbol for g in genes]
-
-            # save only voxels where there were originally microarrays
-            sample_img = join(settings.IMAGE_DIR, 'sample_locations.nii.gz')
-            voxels = masker.mask(sample_img)
-            voxels = np.nonzero(voxels)[0]
-            save_memmap('genes', None, images, labels, voxels)
+        try:
+            ### TERMS ###
+            if 'terms' in include:
+
+                print("\tCreating memmap of term image data...")
+
+                analysis_set = AnalysisSet.query \
+                    .filter_by(type='terms').first()
+
+                # Get all images and save labels
+                images = [a.images[1].image_file
+                          for a in analysis_set.analyses]
+                labels = [a.name for a in analysis_set.analyses]
+
+                print("\t\tFound %d images." % len(images))
+
+                # save both full and 20k voxel arrays
+                save_memmaps([('terms_full', None), ('terms_20k', 20000)],
+                             analysis_set, images, labels)
+                # also save posterior probability images
+                images = [img.replace('_association-test_z_FDR_0.01',
+                                      '_pFgA_given_pF=0.50')
+                          for img in images]
+                save_memmaps([('terms_pp_unif', None)], analysis_set, images,
+                             labels)
+                images = [img.replace('_association-test_z_FDR_0.01',
+                                      '_pFgA')
+                          for img in images]
+                save_memmaps([('terms_pp_emp', None)], analysis_set, images,
+                             labels)
+
+            ### TOPICS ###
+            if 'topics' in include:
+
+                print("\tCreating memmap of topic image data...")
+
+                analysis_set = AnalysisSet.query \
+                    .filter_by(name='v4-topics-100').first()
+
+                # Get all images and save labels
+                images = [a.images[1].image_file
+                          for a in analysis_set.analyses]
+                labels = [a.name for a in analysis_set.analyses]
+
+                print("\t\tFound %d images." % len(images))
+
+                # save both full and 20k voxel arrays
+                save_memmaps([('topics_full', None), ('topics_20k', 20000)],
+                             analysis_set, images, labels)
+                # also save posterior probability images
+                images = [img.replace('_association-test_z_FDR_0.01',
+                                      '_pFgA_given_pF=0.50')
+                          for img in images]
+                save_memmaps([('topics_pp_unif', None)], analysis_set, images,
+                             labels)
+                images = [img.replace('_association-test_z_FDR_0.01',
+                                      '_pFgA')
+                          for img in images]
+                save_memmaps([('topics_pp_emp', None)], analysis_set, images,
+                             labels)
+
+            ### GENES ###
+            if 'genes' in include:
+
+                print("\tCreating memmap of gene image data...")
+
+                # Get all images and save labels
+                genes = Gene.query.all()
+                images = [g.images[0].image_file for g in genes]
+                labels = [g.symbol for g in genes]
+
+                # save only voxels where there were originally microarrays
+                sample_img = join(settings.IMAGE_DIR,
+                                  'sample_locations.nii.gz')
+                voxels = masker.mask(sample_img)
+                voxels = np.nonzero(voxels)[0]
+                save_memmaps([('genes', voxels)], None, images, labels)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Decoder data have changed
+        bump_build_version()
+
+    def build_similarity_indexes(self, names=None, n_dims=512):
+        """ Build sketch indexes for approximate nearest-image search from
+        existing memmaps (see memory_map_images).
+        Args:
+            names: list of memmap names to index. If None, uses
+                SIMILARITY_REFERENCES from settings.
+            n_dims: number of dimensions of each image sketch. More dimensions
+                give better candidates at the cost of slower queries.
+        """
+        from nsweb.tasks.references import load_references
+
+        if names is None:
+            names = settings.SIMILARITY_REFERENCES
+        references = load_references()
+        for name in names:
+            if name not in references:
+                print("No memmap found for %s; skipping." % name)
+                continue
+            print("\tBuilding similarity index for %s..." % name)
+            ref = references[name]
+            index = SketchIndex.build(ref.data, n_dims,
+                                      chunk_size=settings.DECODING_CHUNK_SIZE,
+                                      scale=ref.scale, offset=ref.offset)
+            sketch_file = join(settings.MEMMAP_DIR, '%s_sketch.npz' % name)
+            index.save(_tmp_file(sketch_file))
+            os.replace(_tmp_file(sketch_file), sketch_file)
+
+            # Bump the set's version, so workers reload it with the index
+            md_file = join(settings.MEMMAP_DIR, '%s_metadata.json' % name)
+            metadata = json.load(open(md_file))
+            metadata['version'] = metadata.get('version', 0) + 1
+            open(_tmp_file(md_file), 'w').write(json.dumps(metadata))
+            os.replace(_tmp_file(md_file), md_file)
+
+        # Decoder data have changed
+        bump_build_version()
 
     def _filter_analyses(self, analyses):
         """ Remove any invalid analysis names """
@@ -0,0 +1,187 @@
+""" Backend for Flask-Caching that shares cached responses between all
+worker processes. Entries are stored in Redis, with a small LRU cache in each
+process in front of it, so hot pages are served without a round trip. All
+keys are namespaced by the database build version (see build_version), so
+rebuilding the database invalidates every entry at once.
+
+Enable with CACHE_TYPE = 'nsweb.initializers.response_cache.tiered'. """
+from nsweb.initializers.build_version import get_build_version
+from flask import has_request_context, request
+from collections import OrderedDict
+from threading import Lock
+import pickle
+import time
+import redis
+
+try:
+    from flask_caching.backends.base import BaseCache
+except ImportError:  # Flask-Caching < 1.10
+    from flask_caching.backends.cache import BaseCache
+from flask_caching.backends import RedisCache
+
+
+class _LRU(object):
+    """ Dict of at most size (expiry time, value) pairs, evicting the least
+    recently used entry first. """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, expires):
+        self.items[key] = (expires, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class TieredCache(BaseCache):
+    """ Cache with a local LRU tier in front of a shared Redis tier.
+    Args:
+        redis_url (str): URL of the Redis database.
+        default_timeout (int): default timeout of entries, in seconds.
+        local_size (int): maximum number of entries cached locally for each
+            blueprint.
+        local_sizes (dict): maximum number of local entries for specific
+            blueprints, by blueprint name; overrides local_size. A size of 0
+            disables the local tier for a blueprint.
+        local_timeout (int): maximum time, in seconds, entries are cached
+            locally. Bounds how long a process can serve an entry that was
+            deleted or replaced by another process.
+        key_prefix (str): prefix of all keys in Redis.
+    """
+
+    def __init__(self, redis_url, default_timeout=300, local_size=500,
+                 local_sizes=None, local_timeout=60,
+                 key_prefix='nsweb:cache:'):
+        super(TieredCache, self).__init__(default_timeout)
+        self.shared = RedisCache(host=redis.StrictRedis.from_url(redis_url),
+                                 default_timeout=default_timeout,
+                                 key_prefix=key_prefix)
+        self.local_size = local_size
+        self.local_sizes = local_sizes or {}
+        self.local_timeout = local_timeout
+        self._local = {}
+        self._version = None
+        self._lock = Lock()
+
+    def _key(self, key):
+        version = get_build_version()
+        if version != self._version:
+            # Entries of older builds can never be hit again
+            with self._lock:
+                self._local = {}
+                self._version = version
+        return version + ':' + key
+
+    def _local_tier(self):
+        """ Return the LRU of the current blueprint, or None if it has no
+        local tier. """
+        name = request.blueprint if has_request_context() else None
+        lru = self._local.get(name)
+        if lru is None:
+            size = self.local_sizes.get(name, self.local_size)
+            if not size:
+                return None
+            lru = self._local.setdefault(name, _LRU(size))
+        return lru
+
+    def _set_local(self, key, value, timeout):
+        lru = self._local_tier()
+        if lru is None:
+            return
+        timeout = self._normalize_timeout(timeout)
+        if timeout <= 0 or timeout > self.local_timeout:
+            timeout = self.local_timeout
+        with self._lock:
+            lru.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                    time.time() + timeout)
+
+    def _normalize_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return timeout
+
+    def get(self, key):
+        key = self._key(key)
+        lru = self._local_tier()
+        if lru is not None:
+            with self._lock:
+                value = lru.get(key)
+            if value is not None:
+                return pickle.loads(value)
+        try:
+            value = self.shared.get(key)
+        except redis.RedisError:
+            return None
+        if value is not None:
+            self._set_local(key, value, self.local_timeout)
+        return value
+
+    def set(self, key, value, timeout=None):
+        key = self._key(key)
+        self._set_local(key, value, timeout)
+        try:
+            return self.shared.set(key, value, timeout)
+        except redis.RedisError:
+            return False
+
+    def add(self, key, value, timeout=None):
+        try:
+            added = self.shared.add(self._key(key), value, timeout)
+        except redis.RedisError:
+            return False
+        if added:
+            self._set_local(self._key(key), value, timeout)
+        return added
+
+    def delete(self, key):
+        key = self._key(key)
+        with self._lock:
+            for lru in self._local.values():
+                lru.items.pop(key, None)
+        try:
+            return self.shared.delete(key)
+        except redis.RedisError:
+            return False
+
+    def has(self, key):
+        key = self._key(key)
+        lru = self._local_tier()
+        if lru is not None:
+            with self._lock:
+                if lru.get(key) is not None:
+                    return True
+        try:
+            return self.shared.has(key)
+        except redis.RedisError:
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._local = {}
+        try:
+            return self.shared.clear()
+        except redis.RedisError:
+            return False
+
+
+def tiered(app, config, args, kwargs):
+    """ Flask-Caching factory for a TieredCache configured with
+    CACHE_REDIS_URL, CACHE_LOCAL_SIZE, CACHE_LOCAL_SIZES and
+    CACHE_LOCAL_TIMEOUT. """
+    return TieredCache(redis_url=config['CACHE_REDIS_URL'],
+                       default_timeout=kwargs.get('default_timeout', 300),
+                       local_size=config.get('CACHE_LOCAL_SIZE', 500),
+                       local_sizes=config.get('CACHE_LOCAL_SIZES'),
+                       local_timeout=config.get('CACHE_LOCAL_TIMEOUT', 60))
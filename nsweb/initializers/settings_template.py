@@ -23,6 +23,19 @@ PICKLE_DATABASE = join(ASSET_DIR, 'neurosynth_dataset.pkl')
 # Main image folder
 IMAGE_DIR = join(DATA_DIR, 'images')
 
+# Chunked stores of per-location images (see nsweb.tasks.seed_store), with one
+# subdirectory per kind of image (e.g., 'coactivation')
+SEED_STORE_DIR = join(IMAGE_DIR, 'seeds')
+
+# Maximum total size, in MB, of the NIfTI files written for downloads of each
+# kind of location image. Least recently downloaded files are deleted first
+# (they are rewritten from the store when needed). Set to None for no limit.
+SEED_NIFTI_CACHE_SIZE = 1024
+
+# File holding the version of the current database build, which changes
+# whenever the builder reloads data (see nsweb.initializers.build_version)
+BUILD_VERSION_FILE = join(DATA_DIR, 'build_version.txt')
+
 # Path to analysis/location flat filies
 LOCATION_ANALYSIS_DIR = join(DATA_DIR, 'locations', 'analyses')
 
@@ -40,6 +53,15 @@ TEMPLATE_FOLDER = join(ROOT_DIR, 'nsweb', 'templates')
 # column (named 'keep'). If None, all analyses are loaded into the DB.
 ANALYSIS_FILTER_FILE = None
 
+# Directory for the gzipped JSON of all studies served by /api/studies/all/,
+# which is regenerated for every build of the database
+STUDIES_JSON_DIR = join(DATA_DIR, 'cache', 'studies')
+
+# Radii (in mm) for which the studies near every voxel are precomputed (see
+# DatabaseBuilder.build_voxel_study_index). Location queries with other radii
+# are answered from an in-memory index of all peaks instead.
+VOXEL_STUDY_INDEX_RADII = [6]
+
 ### DECODER-RELATED PATHS ###
 # Path to decoded images
 DECODED_IMAGE_DIR = join(DATA_DIR, 'images', 'decoded')
@@ -58,12 +80,51 @@ DECODING_SCATTERPLOTS_DIR = join(DATA_DIR, 'decoding', 'scatterplots')
 # last decoding; when False, will re-run the decoder every time.
 CACHE_DECODINGS = True
 
+# Maximum number of images stacked into a single matrix product when decoding
+# several images at once. Larger batches mean fewer passes over the reference
+# memmap, at the cost of holding more input images in memory.
+DECODING_BATCH_SIZE = 100
+
+# Size (in MB) of the blocks of reference data read from a memmap at a time
+# during decoding. Bounds the peak memory used by each worker.
+DECODING_CHUNK_SIZE = 64
+
+# Minimum proportion of zero voxels in an input image for the decoder to use
+# sparse decoding, which only reads reference data at non-zero voxels.
+SPARSE_DECODING_THRESHOLD = 0.8
+
+# Reference sets searched for images similar to an input image. Only sets
+# with a sketch index (see DatabaseBuilder.build_similarity_indexes) are used.
+SIMILARITY_REFERENCES = ['terms_full', 'topics_full', 'genes']
+
 # Path to memory-mapped arrays of image data.
 # Note: when running a development build inside a docker container or other VM,
 # memmapping may fail. In such a case, this shoudl point to a directory on the
 # local disk image rather than the host.
 MEMMAP_DIR = join(DATA_DIR, 'memmaps')
 
+# Whether Celery workers load all memmapped reference sets (and fault in their
+# pages) once at startup, so every pool process shares them.
+PRELOAD_REFERENCES = True
+
+# Optional shared memory directory (e.g., '/dev/shm/neurosynth') to copy the
+# memmapped data into at worker startup. Requires enough RAM to hold all
+# reference sets. If None, data are mapped from MEMMAP_DIR.
+REFERENCE_SHM_DIR = None
+
+# Directory to cache masked image data in, so repeated loads of the same image
+# skip decompression and masking. Set to None to disable caching.
+MASKED_IMAGE_CACHE_DIR = join(DATA_DIR, 'cache', 'masked_images')
+
+# Maximum size of the masked image cache, in MB. Least recently used images
+# are evicted first. Set to None for no limit.
+MASKED_IMAGE_CACHE_SIZE = 4096
+
+# Directory to save resampled copies of images that aren't in MNI space in.
+# Uploads are replaced by their resampled version, but other images (analyses,
+# genes, masks, etc.) are never modified. Set to None to not save copies.
+RESAMPLED_IMAGE_DIR = join(DATA_DIR, 'cache', 'resampled_images')
+
 
 ### CONTENT-SPECIFIC DIRECTORIES ###
 MASK_DIR = join(IMAGE_DIR, 'masks')
@@ -95,6 +156,28 @@ LOGGING_LEVEL = 'DEBUG'
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
+# Redis database used to coalesce identical tasks submitted concurrently, and
+# how long (in seconds) a running task can be attached to
+SINGLE_FLIGHT_REDIS_URL = CELERY_BROKER_URL
+SINGLE_FLIGHT_TIMEOUT = 600
+
+# Cache of API responses. With 'nsweb.initializers.response_cache.tiered',
+# responses are shared by all processes through Redis, and each process also
+# keeps the most recently used ones in memory: up to RESPONSE_CACHE_LOCAL_SIZE
+# per blueprint (or the number in RESPONSE_CACHE_LOCAL_SIZES for the blueprint)
+# for at most RESPONSE_CACHE_LOCAL_TIMEOUT seconds. Entries are invalidated
+# when the database is rebuilt. Set to 'simple' to cache in each process only.
+RESPONSE_CACHE_TYPE = 'nsweb.initializers.response_cache.tiered'
+RESPONSE_CACHE_REDIS_URL = 'redis://redis:6379/1'
+RESPONSE_CACHE_LOCAL_SIZE = 500
+RESPONSE_CACHE_LOCAL_SIZES = {'api_locations': 2000, 'api_decode': 1000,
+                              'locations': 1000}
+RESPONSE_CACHE_LOCAL_TIMEOUT = 60
+
+# nginx access logs (a glob pattern, which may match gzipped logs) used to
+# find the most popular URLs to request when warming up the cache
+ACCESS_LOG_FILES = '/var/log/nginx/access.log*'
+
 ### Flask-Mail settings ###
 MAIL_ENABLE = True
 MAIL_USERNAME = os.getenv('MAIL_USERNAME', 'email@example.com')
@@ -1,4 +1,12 @@
 from nsweb.core import db
+from nsweb.initializers import settings
+from nsweb.initializers.build_version import get_build_version
+from scipy.spatial import cKDTree
+import numpy as np
+import hashlib
+import json
+import os
+from os.path import join, exists
 
 
 class Peak(db.Model):
@@ -22,3 +30,193 @@ class Peak(db.Model):
                          cls.y <= y+radius, cls.y >= y-radius,
                          cls.z <= z+radius, cls.z >= z-radius,
                          (x-cls.x)*(x-cls.x)+(y-cls.y)*(y-cls.y)+(z-cls.z)*(z-cls.z) <= radius**2)
+
+    @classmethod
+    def closestStudies(cls, radius, x, y, z):
+        '''
+        Returns a list of (pmid, number of peaks) tuples, sorted by pmid, for
+        all studies with peaks within a radius of x, y, z. Same peaks as
+        closestPeaks, but looked up in an in-memory index.
+        '''
+        return get_peak_index().studies(radius, x, y, z)
+
+
+class PeakIndex(object):
+    ''' KD-tree over the coordinates of all peaks. Queries on the grid of a
+    VoxelStudyIndex are looked up there instead. '''
+
+    def __init__(self, pmids, coords, version=None):
+        self.pmids = np.asarray(pmids, dtype='int64')
+        self.coords = np.asarray(coords, dtype='float64').reshape(-1, 3)
+        self.tree = cKDTree(self.coords) if len(self.coords) else None
+        self.version = version
+        self.fingerprint = hashlib.md5(
+            self.pmids.tobytes() + self.coords.tobytes()).hexdigest()
+        self.voxels = None
+
+    @classmethod
+    def load(cls):
+        ''' Build the index from the peak table, and use the precomputed
+        VoxelStudyIndex if it was built from the same peaks. '''
+        version = get_build_version()
+        rows = db.session.query(Peak.pmid, Peak.x, Peak.y, Peak.z).filter(
+            Peak.pmid.isnot(None)).order_by(Peak.id).all()
+        rows = np.array(rows, dtype='float64').reshape(-1, 4)
+        index = cls(rows[:, 0], rows[:, 1:], version)
+        voxels = VoxelStudyIndex.load(settings.MEMMAP_DIR)
+        if voxels is not None and voxels.fingerprint == index.fingerprint:
+            index.voxels = voxels
+        return index
+
+    def query(self, xyz, radius):
+        ''' Return the indices of all peaks within radius of each point in
+        xyz (an n x 3 array), using the same test as closestPeaks so both
+        agree on peaks at the boundary. '''
+        xyz = np.asarray(xyz, dtype='float64').reshape(-1, 3)
+        result = []
+        for point, inds in zip(xyz, self.tree.query_ball_point(xyz, radius)):
+            inds = np.asarray(inds, dtype=int)
+            dists = np.square(point - self.coords[inds]).sum(1)
+            result.append(inds[dists <= radius ** 2])
+        return result
+
+    def studies(self, radius, x, y, z):
+        if self.voxels is not None:
+            studies = self.voxels.studies(radius, x, y, z)
+            if studies is not None:
+                return studies
+        if self.tree is None:
+            return []
+        inds = self.query([x, y, z], radius)[0]
+        pmids, counts = np.unique(self.pmids[inds], return_counts=True)
+        return list(zip(pmids.tolist(), counts.tolist()))
+
+
+class VoxelStudyIndex(object):
+    ''' The studies with peaks near every in-mask voxel of a grid,
+    precomputed for a few fixed radii. For each radius, the (pmid, number of
+    peaks) lists of all in-mask voxels are stored in CSR form--row pointers
+    plus flat pmid and count arrays--in a compressed .npz file. The mask maps
+    voxels to their rows. '''
+
+    def __init__(self, directory, affine, radii, fingerprint):
+        self.affine = np.asarray(affine, dtype='float64')
+        self.fingerprint = fingerprint
+        mask = np.load(join(directory, 'voxel_studies_mask.npz'))['mask']
+        self.shape = mask.shape
+        # Row of each voxel, or -1 for voxels outside the mask
+        self.rows = np.full(mask.size, -1, dtype='int32')
+        self.rows[mask.ravel()] = np.arange(mask.sum(), dtype='int32')
+        self.radii = {}
+        for r in radii:
+            with np.load(self._file(directory, r)) as f:
+                self.radii[r] = [f[name]
+                                 for name in ['indptr', 'pmids', 'counts']]
+
+    @staticmethod
+    def _file(directory, radius):
+        return join(directory, 'voxel_studies_r%d.npz' % radius)
+
+    @staticmethod
+    def _save(filename, **arrays):
+        tmp = join(os.path.dirname(filename),
+                   '.%d_%s' % (os.getpid(), os.path.basename(filename)))
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def build(cls, peaks, directory, mask, affine, radii, batch_size=10000):
+        ''' Build the index for all in-mask voxels of a grid.
+        Args:
+            peaks (PeakIndex): index of the peaks to look up.
+            directory (str): where to save the index.
+            mask: boolean array of the voxels of the grid to index; queries
+                are answered from the index when they fall exactly on one of
+                them.
+            affine: the affine of the grid.
+            radii (list): integer radii, in mm, to precompute.
+            batch_size (int): number of voxels to look up at a time.
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        ijk = np.array(np.nonzero(mask))
+        xyz = (affine[:3, :3].dot(ijk) + affine[:3, 3:]).T
+        cls._save(join(directory, 'voxel_studies_mask.npz'), mask=mask)
+        for r in radii:
+            # Number of studies near each voxel, then row pointers. Pmids and
+            # counts are streamed to disk rather than collected in memory.
+            indptr = np.zeros(len(xyz) + 1, dtype='int64')
+            raw = [join(directory, '.%d_voxel_studies_%s.dat' % (
+                os.getpid(), name)) for name in ['pmids', 'counts']]
+            with open(raw[0], 'wb') as pmids, open(raw[1], 'wb') as counts:
+                for start in range(0, len(xyz), batch_size):
+                    if peaks.tree is None:
+                        break
+                    batch = peaks.query(xyz[start:start + batch_size], r)
+                    for i, inds in enumerate(batch):
+                        if len(inds):
+                            p, n = np.unique(peaks.pmids[inds],
+                                             return_counts=True)
+                            pmids.write(p.astype('int32').tobytes())
+                            counts.write(n.astype('uint16').tobytes())
+                            indptr[start + i + 1] = len(p)
+            indptr = np.cumsum(indptr)
+            arrays = [np.memmap(f, dtype=dtype, mode='r', shape=(indptr[-1],))
+                      if indptr[-1] else np.zeros(0, dtype=dtype)
+                      for (f, dtype) in zip(raw, ['int32', 'uint16'])]
+            cls._save(cls._file(directory, r), indptr=indptr,
+                      pmids=arrays[0], counts=arrays[1])
+            del arrays
+            for f in raw:
+                os.remove(f)
+
+        # Write the metadata last, as it marks the index as complete
+        meta = {'affine': np.asarray(affine).tolist(),
+                'radii': list(radii), 'fingerprint': peaks.fingerprint}
+        tmp = join(directory, '.%d_voxel_studies.json' % os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, join(directory, 'voxel_studies.json'))
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory):
+        ''' Load the index, or return None if it hasn't been built. '''
+        filename = join(directory, 'voxel_studies.json')
+        if not exists(filename) or \
+                not exists(join(directory, 'voxel_studies_mask.npz')):
+            return None
+        with open(filename) as f:
+            meta = json.load(f)
+        return cls(directory, meta['affine'], meta['radii'],
+                   meta['fingerprint'])
+
+    def studies(self, radius, x, y, z):
+        ''' Return the (pmid, number of peaks) tuples for an in-mask voxel of
+        the grid, or None if the radius or the point isn't in the index. '''
+        if radius not in self.radii:
+            return None
+        ijk = np.linalg.solve(self.affine, [x, y, z, 1])[:3]
+        if not np.allclose(ijk, np.round(ijk)):
+            return None
+        ijk = np.round(ijk).astype(int)
+        if np.any(ijk < 0) or np.any(ijk >= self.shape):
+            return None
+        row = self.rows[np.ravel_multi_index(tuple(ijk), self.shape)]
+        if row < 0:
+            return None
+        indptr, pmids, counts = self.radii[radius]
+        start, end = indptr[row], indptr[row + 1]
+        return list(zip(pmids[start:end].tolist(),
+                        counts[start:end].tolist()))
+
+
+_peak_index = None
+
+
+def get_peak_index():
+    ''' Return the process-wide PeakIndex, (re)building it if the database
+    has been rebuilt since it was loaded. '''
+    global _peak_index
+    if _peak_index is None or _peak_index.version != get_build_version():
+        _peak_index = PeakIndex.load()
+    return _peak_index
@@ -1,5 +1,13 @@
 from nsweb.core import db
+from nsweb.initializers import settings
+from nsweb.initializers.build_version import get_build_version
 from sqlalchemy.ext.associationproxy import association_proxy
+from glob import glob
+from os.path import join, exists
+import gzip
+import json
+import os
+import uuid
 
 
 class Study(db.Model):
@@ -17,8 +25,71 @@ class Study(db.Model):
     # analyses = association_proxy('inclusions', 'analysis')
 
     def serialize(self):
-        return {'pmid': self.pmid, 'authors': self.authors,
-                'journal': self.journal,
-                'year': self.year,
+        return Study.serialize_columns(self.pmid, self.authors, self.journal,
+                                       self.year, self.title)
+
+    @staticmethod
+    def serialize_columns(pmid, authors, journal, year, title):
+        return {'pmid': pmid, 'authors': authors,
+                'journal': journal,
+                'year': year,
                 'title': '<a href="/studies/%s">%s</a>'
-                % (self.pmid, self.title)}
+                % (pmid, title)}
+
+    @classmethod
+    def iter_json(cls, chunk_size=1000):
+        ''' Yield the JSON of all serialized studies, {"studies": [...]}, in
+        chunks of chunk_size studies. Rows are read with a server-side cursor
+        where the DB supports it, and no Study models are created. '''
+        query = db.session.query(cls.pmid, cls.authors, cls.journal,
+                                 cls.year, cls.title).order_by(cls.pmid)
+        yield '{"studies": ['
+        rows, sep = [], ''
+        for row in query.yield_per(chunk_size):
+            rows.append(json.dumps(cls.serialize_columns(*row)))
+            if len(rows) == chunk_size:
+                yield sep + ', '.join(rows)
+                rows, sep = [], ', '
+        if rows:
+            yield sep + ', '.join(rows)
+        yield ']}'
+
+
+def studies_json_file():
+    ''' Return the path of the gzipped JSON of all studies for the current
+    build of the database. '''
+    return join(settings.STUDIES_JSON_DIR,
+                'studies_%s.json.gz' % get_build_version())
+
+
+def iter_studies_json(save=True, chunk_size=1000):
+    ''' Yield the JSON of all studies in chunks (see Study.iter_json). If
+    save is True, a gzipped copy is also saved to studies_json_file() once
+    all chunks have been yielded, replacing copies from older builds. '''
+    filename = studies_json_file()
+    out = None
+    if save:
+        if not exists(settings.STUDIES_JSON_DIR):
+            os.makedirs(settings.STUDIES_JSON_DIR, exist_ok=True)
+        tmp = join(settings.STUDIES_JSON_DIR, '.%s.json.gz' % uuid.uuid4().hex)
+        out = gzip.open(tmp, 'wb')
+    try:
+        for chunk in Study.iter_json(chunk_size):
+            if out is not None:
+                out.write(chunk.encode('utf-8'))
+            yield chunk
+        if out is not None:
+            out.close()
+            out = None
+            os.replace(tmp, filename)
+            for old in glob(join(settings.STUDIES_JSON_DIR, 'studies_*')):
+                if old != filename:
+                    try:
+                        os.remove(old)
+                    except OSError:
+                        pass  # Removed by a concurrent request
+    finally:
+        # Incomplete, e.g., because the client disconnected
+        if out is not None:
+            out.close()
+            os.remove(tmp)
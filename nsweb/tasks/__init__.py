@@ -7,15 +7,23 @@ from celery.utils import cached_property
 import numpy as np
 import pandas as pd
 import nibabel as nb
-from nilearn.image import resample_img
 from nsweb.core import celery
-from os import unlink
-from os.path import join, exists
+from os.path import join, exists, dirname, basename, abspath
 from nsweb.tasks.scatterplot import scatter
+from nsweb.tasks.decoding import (standardize, standardize_nonzero, correlate,
+                                  correlate_sparse, dot_rows, is_sparse)
+from nsweb.tasks.references import (Reference, get_references,
+                                    preload_references)
+from nsweb.tasks.results import save_decoding
+from nsweb.tasks.similarity import find_similar
+from nsweb.tasks.image_cache import cached_mask
+from nsweb.tasks.resampling import get_resampler
+from nsweb.tasks.coactivation import CoactivationEngine
+from nsweb.tasks.seed_store import SeedStore, get_store, load_seed_image
+from celery.signals import worker_init
 import traceback
-from glob import glob
-import json
-from collections import OrderedDict
+import hashlib
+import os
 
 
 MASK_FILES = {
@@ -29,18 +37,64 @@ MASK_FILES = {
 }
 
 
+def _is_upload(filename):
+    """ Whether an image file was uploaded, i.e., is in DECODED_IMAGE_DIR. """
+    return abspath(filename).startswith(
+        abspath(settings.DECODED_IMAGE_DIR) + os.sep)
+
+
+def _resampled_copy(filename):
+    """ Return the path of the resampled copy of an image file in
+    RESAMPLED_IMAGE_DIR, keyed by the path, size and modification time of the
+    file, or None if copies aren't saved. """
+    directory = settings.RESAMPLED_IMAGE_DIR
+    if directory is None:
+        return None
+    st = os.stat(filename)
+    key = '%s\t%d\t%f' % (abspath(filename), st.st_size, st.st_mtime)
+    key = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return join(directory, '%s_%s' % (key, basename(filename)))
+
+
+def _save_image(img, filename):
+    """ Save an image atomically, so concurrent readers see either the old
+    file or the new one. """
+    os.makedirs(dirname(filename), exist_ok=True)
+    tmp = join(dirname(filename), '.%d_%s' % (os.getpid(), basename(filename)))
+    img.to_filename(tmp)
+    os.replace(tmp, filename)
+
+
 def load_image(masker, filename, save_resampled=True):
-    """ Load an image, resampling into MNI space if needed. """
+    """ Load an image, resampling into MNI space if needed. Masked data are
+    cached on disk, so repeated loads of the same file skip both. Location
+    images are read from their seed store instead. With save_resampled,
+    uploads are replaced by their resampled version, and resampled copies of
+    other images are saved to RESAMPLED_IMAGE_DIR. """
+    img = load_seed_image(filename)
+    if img is not None:
+        return masker.mask(img)
+
     filename = join(settings.DECODED_IMAGE_DIR, filename)
-    img = nb.load(filename)
-    if img.shape[:3] != (91, 109, 91):
-        img = resample_img(
-            img, target_affine=decode_image.anatomical.get_affine(),
-            target_shape=(91, 109, 91), interpolation='nearest')
-        if save_resampled:
-            unlink(filename)
-            img.to_filename(filename)
-    return masker.mask(img)
+
+    def _load(filename):
+        upload = _is_upload(filename)
+        copy = None if upload else _resampled_copy(filename)
+        if copy is not None and exists(copy):
+            return masker.mask(nb.load(copy))
+        img = nb.load(filename)
+        resampler = get_resampler()
+        if img.shape[:3] != resampler.target_shape or not np.allclose(
+                img.get_affine(), resampler.target_affine):
+            img = resampler.resample(img)
+            if save_resampled and upload:
+                _save_image(img, filename)
+            elif save_resampled and copy is not None:
+                _save_image(img, copy)
+        return masker.mask(img)
+
+    mask_file = join(settings.IMAGE_DIR, 'anatomical.nii.gz')
+    return cached_mask(mask_file, filename, _load)
 
 
 def xyz_to_mat(foci):
@@ -51,47 +105,26 @@ def xyz_to_mat(foci):
     return np.round_(result).astype(int)  # need to round indices to ints
 
 
-class Reference(object):
-
-    def __init__(self, name, n_voxels, n_images, is_subsampled):
-
-        self.name = name
-        self.n_voxels = n_voxels
-        self.n_images = n_images
-        self.is_subsampled = is_subsampled
-
-        # Link to memmap data
-        mm_file = join(settings.MEMMAP_DIR, name + '_images.dat')
-        self.data = np.memmap(mm_file, dtype='float32', mode='r',
-                              shape=(n_voxels, n_images))
-        # Link to labels
-        lab_file = join(settings.MEMMAP_DIR, name + '_labels.txt')
-        _labels = open(lab_file).read().splitlines()
-        self.labels = OrderedDict(zip(_labels, range(len(_labels))))
-
-        # Image stats
-        stat_file = join(settings.MEMMAP_DIR, name + '_stats.txt')
-        self.stats = pd.read_csv(stat_file, sep='\t')
-
-
 class NeurosynthTask(Task):
 
     @cached_property
     def dataset(self):
         return Dataset.load(settings.PICKLE_DATABASE)
 
+    @cached_property
+    def coactivation(self):
+        """ Engine for coactivation maps, holding the study x voxel
+        activation matrix in memory. """
+        return CoactivationEngine.from_dataset(self.dataset)
+
     @cached_property
     def masker(self):
         return Masker(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
 
-    @cached_property
+    @property
     def references(self):
-        """ For efficiency, cache indices of all labels in all memmaps."""
-        memmaps = {}
-        for f in glob(join(settings.MEMMAP_DIR, '*_metadata.json')):
-            md = json.load(open(f))
-            memmaps[md['name']] = Reference(**md)
-        return memmaps
+        """ All memmapped reference sets, reloaded when rewritten. """
+        return get_references()
 
     @cached_property
     def anatomical(self):
@@ -112,11 +145,72 @@ class NeurosynthTask(Task):
         return maps
 
 
+@worker_init.connect
+def load_shared_references(**kwargs):
+    """ Load all reference sets in the main worker process before the pool
+    starts, so every (re)forked pool process shares the same mapped pages
+    instead of building and warming its own. """
+    if settings.PRELOAD_REFERENCES:
+        preload_references(settings.REFERENCE_SHM_DIR)
+
+
 @celery.task(base=NeurosynthTask)
 def save_uploaded_image(filename, **kwargs):
     pass
 
 
+def _load_reference_image(task, ref, filename):
+    """ Load an image and select the voxels used by the reference set. """
+    data = load_image(task.masker, filename)
+    # Select voxels in sampling mask if it exists
+    if ref.is_subsampled:
+        index_file = join(settings.MEMMAP_DIR, ref.name + '_voxels.npy')
+        if exists(index_file):
+            voxels = np.load(index_file)
+            data = data[voxels]
+    return data
+
+
+def _standardize_image(data, drop_zeros=False):
+    """ Standardize an image for decoding. When drop_zeros is True, voxels
+    with zeros or NaN in the input image are zeroed out after standardizing
+    the remaining voxels, so they don't contribute to the correlation.
+    Returns: A tuple of (data, voxels), where voxels is a boolean mask of the
+        retained voxels (or None if all voxels are used).
+    """
+    if drop_zeros:
+        return standardize_nonzero(data)
+    # Otherwise we still need to replace NaNs or bad things happen
+    return standardize(np.nan_to_num(data)), None
+
+
+def _correlate_image(ref, data, drop_zeros=False):
+    """ Correlate a single image with all images in a reference set. When most
+    voxels in the image are zero (e.g., thresholded maps), only the reference
+    rows at non-zero voxels are read; otherwise the whole reference is streamed
+    in row chunks to bound memory use. Both paths give identical results. """
+    chunk_size = settings.DECODING_CHUNK_SIZE
+    quant = {'scale': ref.scale, 'offset': ref.offset}
+    if is_sparse(data, settings.SPARSE_DECODING_THRESHOLD):
+        if drop_zeros:
+            data, voxels = standardize_nonzero(data)
+            rows = np.flatnonzero(voxels)
+            return dot_rows(ref.data, data, rows, chunk_size,
+                            **quant) / ref.n_voxels
+        if ref.moments is not None:
+            return correlate_sparse(ref.data, np.nan_to_num(data),
+                                    ref.n_voxels, ref.moments['sum'].values,
+                                    chunk_size, **quant)
+    data, voxels = _standardize_image(data, drop_zeros)
+    return correlate(ref.data, data, ref.n_voxels, mask=voxels,
+                     chunk_size=chunk_size, **quant)
+
+
+def _save_decoding(ref, r, uuid):
+    """ Append a vector of correlations to the decoding results store. """
+    save_decoding(ref.name, uuid, r, ref.labels.keys())
+
+
 @celery.task(base=NeurosynthTask)
 def decode_image(filename, reference, uuid, mask=None, drop_zeros=False,
                  **kwargs):
@@ -129,39 +223,107 @@ def decode_image(filename, reference, uuid, mask=None, drop_zeros=False,
         drop_zeros (bool): if True, only non-zero, non-NA voxels in the input
             map are used in the comparison.
     """
-    mm_dir = settings.MEMMAP_DIR
     try:
         ref = decode_image.references[reference]
 
-        # Load and standardize the target image
-        data = load_image(decode_image.masker, filename)
-        # Select voxels in sampling mask if it exists
-        if ref.is_subsampled:
-            index_file = join(mm_dir, ref.name + '_voxels.npy')
-            if exists(index_file):
-                voxels = np.load(index_file)
-                data = data[voxels]
-
-        # Drop voxels with zeros or NaN in input image
-        voxels = np.arange(len(data))
-        if drop_zeros:
-            voxels = np.where((data != 0) & np.isfinite(data))[0]
-            data = data[voxels]
-        # Otherwise we still need to replace NaNs or bad things happen
-        data = np.nan_to_num(data)
-
-        # standardize image and get correlation
-        data = (data - data.mean()) / data.std()
-        r = np.dot(ref.data[voxels].T, data) / ref.n_voxels
-        outfile = join(settings.DECODING_RESULTS_DIR, uuid + '.txt')
-        labels = list(ref.labels.keys())
-        pd.Series(r, index=labels).to_csv(outfile, sep='\t')
+        # Load the target image and get correlations
+        data = _load_reference_image(decode_image, ref, filename)
+        r = _correlate_image(ref, data, drop_zeros)
+        _save_decoding(ref, r, uuid)
         return True
     except Exception as e:
         print(traceback.format_exc())
         return False
 
 
+@celery.task(base=NeurosynthTask)
+def decode_images(filenames, reference, uuids, mask=None, drop_zeros=False,
+                  **kwargs):
+    """ Decode several image files against the same reference set. All images
+    in a batch are stacked into a single voxels x images matrix and correlated
+    with the reference memmap in one matrix product, so the memmap only needs
+    to be read once per batch rather than once per image.
+    Args:
+        filenames (list): local paths to the images
+        reference (str): the name of the memmapped image set to compare with
+        uuids (list): unique identifiers to use when writing results; must be
+            the same length as filenames.
+        mask (str): the name of an optional mask to use (e.g., 'subcortex')
+        drop_zeros (bool): if True, only non-zero, non-NA voxels in each input
+            map are used in the comparison.
+    Returns: A list of booleans indicating which images were decoded.
+    """
+    try:
+        ref = decode_images.references[reference]
+    except Exception as e:
+        print(traceback.format_exc())
+        return [False] * len(filenames)
+
+    results = []
+    batch_size = settings.DECODING_BATCH_SIZE
+    for start in range(0, len(filenames), batch_size):
+        batch = list(zip(filenames, uuids))[start:start + batch_size]
+
+        # Images that fail to load are skipped rather than failing the batch
+        data, voxels, decoded = [], [], []
+        for filename, uuid in batch:
+            try:
+                img = _load_reference_image(decode_images, ref, filename)
+                img, vox = _standardize_image(img, drop_zeros)
+                data.append(img)
+                voxels.append(vox)
+                decoded.append(uuid)
+            except Exception as e:
+                print(traceback.format_exc())
+
+        if decoded:
+            try:
+                # Blocks are only skipped if no image in the batch uses them
+                voxels = np.any(voxels, 0) if drop_zeros else None
+                r = correlate(ref.data, np.column_stack(data), ref.n_voxels,
+                              mask=voxels,
+                              chunk_size=settings.DECODING_CHUNK_SIZE,
+                              scale=ref.scale, offset=ref.offset)
+                for i, uuid in enumerate(decoded):
+                    _save_decoding(ref, r[:, i], uuid)
+            except Exception as e:
+                print(traceback.format_exc())
+                decoded = []
+
+        results.extend([uuid in decoded for (filename, uuid) in batch])
+    return results
+
+
+@celery.task(base=NeurosynthTask)
+def find_similar_images(filename, references=None, k=10):
+    """ Find the reference images (e.g., term, topic and gene maps) most
+    correlated with an image file, using each reference set's sketch index.
+    Args:
+        filename (str): the local path to the image
+        references (list): names of the memmapped image sets to search. If
+            None, uses SIMILARITY_REFERENCES from settings. Sets without a
+            sketch index are skipped.
+        k (int): number of images to return
+    Returns: A list of [reference, label, r] lists, most similar first.
+    """
+    try:
+        if references is None:
+            references = settings.SIMILARITY_REFERENCES
+        results = []
+        for name in references:
+            ref = find_similar_images.references.get(name)
+            if ref is None or ref.sketch is None:
+                continue
+            data = _load_reference_image(find_similar_images, ref, filename)
+            data = standardize(np.nan_to_num(data))
+            results.extend([[name, label, r]
+                            for (label, r) in find_similar(ref, data, k)])
+        return sorted(results, key=lambda x: -x[2])[:k]
+    except Exception:
+        print(traceback.format_exc())
+        return False
+
+
 @celery.task(base=NeurosynthTask)
 def get_voxel_data(reference, x, y, z, get_pp=True):
     """ Return a voxel slice through the specified memory mapped numpy array.
@@ -177,13 +339,13 @@ def get_voxel_data(reference, x, y, z, get_pp=True):
 
         ref = get_voxel_data.references[reference + '_full']
         labels = list(ref.labels.keys())
-        result = pd.Series(ref.data[ind, :].ravel(), index=labels, name='z')
+        result = pd.Series(ref.voxel(ind).ravel(), index=labels, name='z')
         result = result * ref.stats['std'].values + ref.stats['mean'].values
 
         # Can get posterior probs as well
         if get_pp:
             ref = get_voxel_data.references[reference + '_pp_unif']
-            _pp = pd.Series(ref.data[ind, :].ravel(), index=labels, name='pp')
+            _pp = pd.Series(ref.voxel(ind).ravel(), index=labels, name='pp')
             _pp = _pp * ref.stats['std'].values + ref.stats['mean'].values
             result = pd.concat([result, _pp], axis=1)
         return result.to_json()
@@ -195,17 +357,26 @@ def get_voxel_data(reference, x, y, z, get_pp=True):
 
 @celery.task(base=NeurosynthTask)
 def make_coactivation_map(x, y, z, r=6, min_studies=0.01):
-    """ Generate a coactivation map on-the-fly for the given seed voxel. """
+    """ Generate a coactivation map on-the-fly for the given seed voxel. The
+    result is identical to the association test map of a MetaAnalysis of all
+    studies with a peak within r mm of the seed. Returns True once the map is
+    saved, None if the location has no map (too few studies, or outside the
+    mask), and False on errors. """
     try:
-        dataset = make_coactivation_map.dataset
-        ids = dataset.get_studies(peaks=[[x, y, z]], r=r)
+        engine = make_coactivation_map.coactivation
+        ids = engine.get_studies([x, y, z], r)
         if len(ids) < 50:
-            return False
-        ma = meta.MetaAnalysis(dataset, ids, min_studies=min_studies)
-        outdir = join(settings.IMAGE_DIR, 'coactivation')
-        prefix = 'metaanalytic_coactivation_%s_%s_%s' % (
-            str(x), str(y), str(z))
-        ma.save_results(outdir, prefix, image_list=['association-test_z_FDR_0.01'])
+            return None
+        z_fdr = engine.association_test(ids, min_studies=min_studies)[1]
+        store = get_store('coactivation')
+        if store is None:
+            store = SeedStore.create(
+                join(settings.SEED_STORE_DIR, 'coactivation'),
+                make_coactivation_map.dataset.masker.volume)
+        seed = store.seed(x, y, z)
+        if seed < 0:
+            return None
+        store.put(seed, z_fdr)
         return True
     except Exception as e:
         print(traceback.format_exc())
@@ -240,7 +411,7 @@ def make_scatterplot(filename, analysis, base_id, reference='terms_full',
         x = load_image(make_scatterplot.masker, filename)
         # y = get_decoder_analysis_data(make_scatterplot.dd, analysis)
         ref = make_scatterplot.references[reference]
-        y = ref.data[:, ref.labels[analysis]]
+        y = ref.image(analysis)
 
         # Subsample random voxels
         if n_voxels is not None:
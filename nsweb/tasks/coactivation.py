@@ -0,0 +1,223 @@
+""" Meta-analytic coactivation maps computed directly from the sparse
+study x voxel activation matrix of a Neurosynth Dataset. For a seed, only the
+columns of the studies that activate near it are summed, and the
+association test (two-way chi-square with FDR correction) of
+neurosynth.analysis.meta.MetaAnalysis is evaluated for all voxels at once.
+Maps for the whole grid of seeds can be precomputed into a SeedStore. """
+from nsweb.tasks.seed_store import SeedStore
+import numpy as np
+from scipy import sparse, special
+from scipy.spatial import cKDTree
+from scipy.stats import norm
+from os.path import exists, join
+import multiprocessing
+
+
+def fdr(p, q=0.01):
+    """ Return the p-value threshold controlling the false discovery rate at
+    q (Benjamini-Hochberg), or -1 if no p-value survives. """
+    s = np.sort(p)
+    null = np.arange(1, len(s) + 1, dtype='float64') * q / len(s)
+    below = np.flatnonzero(s <= null)
+    return s[below[-1]] if len(below) else -1
+
+
+def p_to_z(p, sign):
+    """ Convert two-tailed p-values to signed z-scores. """
+    p = p / 2
+    p[p < 1e-240] = 1e-240  # Prevent underflow
+    z = np.abs(norm.ppf(p)) * sign
+    z[np.isinf(z)] = -norm.ppf(1e-240)
+    return z
+
+
+class CoactivationEngine(object):
+    """ Computes coactivation maps for arbitrary seeds.
+    Args:
+        data (sparse matrix): voxels x studies activation matrix (e.g., the
+            data of a Dataset's ImageTable).
+        ids (list): study IDs of the columns of data.
+        coords (array): optional n_peaks x 3 array of peak coordinates, used
+            to select the studies that activate near a seed.
+        peak_ids (array): study ID of each peak.
+    """
+
+    def __init__(self, data, ids, coords=None, peak_ids=None):
+        self.data = sparse.csc_matrix(data)
+        self.ids = np.asarray(ids)
+        self.columns = dict(zip(self.ids, range(len(self.ids))))
+        self.n_active = np.asarray(self.data.sum(1), dtype='float64').ravel()
+        self.tree = None
+        if coords is not None:
+            self.coords = np.asarray(coords, dtype='float64')
+            self.peak_ids = np.asarray(peak_ids)
+            self.tree = cKDTree(self.coords)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        table = dataset.image_table
+        peaks = dataset.activations
+        return cls(table.data, table.ids, peaks[['x', 'y', 'z']].values,
+                   peaks['id'].values)
+
+    def get_studies(self, xyz, r=6):
+        """ Return the IDs of all studies with a peak less than r mm from
+        xyz; equivalent to Dataset.get_studies(peaks=[xyz], r=r). """
+        xyz = np.asarray(xyz, dtype='float64')
+        return self._studies(xyz, self.tree.query_ball_point(xyz, r), r)
+
+    def _studies(self, xyz, peaks, r):
+        # The KD-tree includes peaks at exactly r mm; Dataset.get_studies
+        # doesn't.
+        peaks = np.asarray(peaks, dtype=int)
+        dists = np.sqrt(np.square(self.coords[peaks] - xyz).sum(1))
+        return np.unique(self.peak_ids[peaks[dists < r]])
+
+    def count_active(self, ids):
+        """ Return the number of selected studies (those in ids that are in
+        the activation matrix) and the number that activate each voxel. """
+        cols = [self.columns[i] for i in set(ids) if i in self.columns]
+        indptr = self.data.indptr
+        inds = np.concatenate([np.arange(indptr[c], indptr[c + 1])
+                               for c in cols] or [np.array([], dtype=int)])
+        counts = np.bincount(self.data.indices[inds],
+                             weights=self.data.data[inds],
+                             minlength=self.data.shape[0])
+        return len(cols), counts
+
+    def association_test(self, ids, q=0.01, min_studies=0.01):
+        """ Run the association test of a meta-analysis of the given studies
+        against all other studies.
+        Args:
+            ids (list): IDs of the selected studies.
+            q (float): false discovery rate.
+            min_studies (float): voxels activated by a smaller proportion
+                (or, if an int, number) of the selected studies are zeroed.
+        Returns: A tuple of (z, z_fdr) vectors, with z-scores for all voxels
+            and z-scores that survive FDR correction, respectively.
+        """
+        n_selected, a = self.count_active(ids)
+        return self._test(n_selected, a, q, min_studies)
+
+    def _test(self, n_selected, a, q, min_studies):
+        """ Association test given the number of selected studies and the
+        number of them that activate each voxel. """
+        n_ids = len(self.ids)
+        n_unselected = n_ids - n_selected
+        b = self.n_active - a  # Unselected studies that activate each voxel
+        c = n_selected - a
+        d = n_unselected - b
+
+        # Two-way chi-square test of independence of selection and activation
+        # for each voxel. As in neurosynth, cells with an expected count of
+        # zero contribute 1 to the statistic.
+        rows = [n_selected, n_unselected]
+        cols = [self.n_active, n_ids - self.n_active]
+        chi_sq = np.zeros(len(a))
+        for (i, j, obs) in [(0, 0, a), (0, 1, c), (1, 0, b), (1, 1, d)]:
+            exp = rows[i] * cols[j] / float(n_ids)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cell = np.square(obs - exp) / exp
+            chi_sq += np.where(exp == 0, 1.0, cell)
+        p = special.chdtrc(1, chi_sq)
+        p[p < 1e-240] = 1e-240
+
+        pAgF = a / n_selected
+        pAgU = b / n_unselected
+        z = p_to_z(p, np.sign(pAgF - pAgU))
+        z_fdr = np.where(p <= fdr(p, q), z, 0)
+
+        if min_studies > 0:
+            if isinstance(min_studies, int):
+                min_studies = float(min_studies) / n_selected
+            exclude = pAgF < min_studies
+            z[exclude] = 0
+            z_fdr[exclude] = 0
+        return z, z_fdr
+
+    def sweep(self, seeds, r=6, q=0.01, min_studies=0.01, min_count=50):
+        """ Yield the FDR-corrected coactivation map of each seed in turn, as
+        make_coactivation_map would compute it, or None for seeds with fewer
+        than min_count studies. Adjacent seeds select mostly the same
+        studies, so voxel counts are updated with the studies that enter or
+        leave the selection rather than recomputed; seeds are best passed in
+        the order the Masker returns voxels.
+        Args:
+            seeds (array): n_seeds x 3 array of seed coordinates.
+            r, q, min_studies: see get_studies and association_test.
+            min_count (int): minimum number of studies near a seed.
+        """
+        seeds = np.asarray(seeds, dtype='float64')
+        peaks = self.tree.query_ball_point(seeds, r)
+        selected = set()
+        counts = np.zeros(self.data.shape[0])
+        for xyz, p in zip(seeds, peaks):
+            ids = self._studies(xyz, p, r)
+            if len(ids) < min_count:
+                yield None
+                continue
+            ids = set(i for i in ids if i in self.columns)
+            added, removed = ids - selected, selected - ids
+            if len(added) + len(removed) < len(ids):
+                counts = counts + self.count_active(added)[1] - \
+                    self.count_active(removed)[1]
+            else:
+                counts = self.count_active(ids)[1]
+            selected = ids
+            yield self._test(len(ids), counts, q, min_studies)[1]
+
+
+_engine = None
+_store = None
+
+
+def _fill_chunk(args):
+    chunk, r, min_studies = args
+    seeds = _store.coords(_store.chunk_seeds(chunk))
+    maps = _engine.sweep(seeds, r, min_studies=min_studies)
+    _store.write_chunk(chunk, list(maps))
+    return chunk
+
+
+def precompute_coactivation_maps(dataset, directory, n_jobs=1, shard=(0, 1),
+                                 r=6, min_studies=0.01, chunk_size=256):
+    """ Compute the coactivation map of every seed in the dataset's mask
+    (i.e., every location the site normalizes coordinates to) into a
+    SeedStore. Finished chunks are skipped, so an interrupted run resumes
+    where it left off.
+    Args:
+        dataset: the Neurosynth Dataset.
+        directory (str): directory of the store; created if needed.
+        n_jobs (int): number of processes.
+        shard (tuple): (i, n) to only compute every n-th chunk starting at
+            the i-th, so that several machines can share the work.
+        r, min_studies: see make_coactivation_map.
+        chunk_size (int): number of seeds per chunk of a new store.
+    """
+    global _engine, _store
+    if exists(join(directory, 'metadata.json')):
+        _store = SeedStore(directory)
+    else:
+        _store = SeedStore.create(directory, dataset.masker.volume,
+                                  chunk_size=chunk_size)
+    # Set before the pool forks, so workers share the activation matrix
+    _engine = CoactivationEngine.from_dataset(dataset)
+
+    i, n = shard
+    chunks = [c for c in _store.missing_chunks() if c % n == i]
+    print("Computing %d of %d chunks of %d seeds..." % (
+        len(chunks), _store.n_chunks, _store.chunk_size))
+    args = [(c, r, min_studies) for c in chunks]
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        fill_chunks = pool.imap_unordered
+    else:
+        pool = None
+        fill_chunks = map
+    try:
+        for k, chunk in enumerate(fill_chunks(_fill_chunk, args)):
+            print("Chunk %d done (%d/%d)." % (chunk, k + 1, len(chunks)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,186 @@
+""" Numerical helpers for correlating input images with memory-mapped
+reference image sets. """
+import numpy as np
+
+
+def standardize(data):
+    """ Z-score one image (a 1D vector) or a set of images (voxels x images)
+    along the voxel axis. """
+    data = np.asarray(data, dtype='float32')
+    return (data - data.mean(0)) / data.std(0)
+
+
+def standardize_nonzero(data):
+    """ Z-score an image using only its non-zero, finite voxels.
+    Returns: A tuple of (data, mask), where data is a full-length vector with
+        standardized values in the retained voxels and zeros everywhere else,
+        and mask is a boolean vector marking the retained voxels. Because the
+        dropped voxels are zero, a plain dot product with the reference gives
+        the same result as first indexing the reference by the mask.
+    """
+    mask = (data != 0) & np.isfinite(data)
+    result = np.zeros(len(data), dtype='float32')
+    result[mask] = standardize(data[mask])
+    return result, mask
+
+
+def chunk_rows(n_cols, chunk_size, itemsize=4):
+    """ Number of rows of a memmap with n_cols columns that fit in
+    chunk_size MB. """
+    return max(1, int(chunk_size * 2 ** 20 // (n_cols * itemsize)))
+
+
+def quantize(data, dtype='int16'):
+    """ Quantize the columns of a voxels x images array of standardized data.
+    For int16, each column is mapped linearly onto the full int16 range using
+    its own scale and offset; float16 is a plain cast.
+    Returns: A tuple of (data, scale, offset, error), where error is the
+        maximum absolute difference between each dequantized column and the
+        original. Because input maps are standardized before decoding, error
+        is also an upper bound on the resulting error in each correlation.
+    """
+    data = np.asarray(data, dtype='float32')
+    n_images = data.shape[1]
+    if dtype == 'int16':
+        lo, hi = data.min(0), data.max(0)
+        offset = ((hi + lo) / 2).astype('float32')
+        scale = ((hi - lo) / (2 * 32767)).astype('float32')
+        scale[scale == 0] = 1
+        quantized = np.round((data - offset) / scale).astype('int16')
+    else:
+        quantized = data.astype(dtype)
+        scale = np.ones(n_images, dtype='float32')
+        offset = np.zeros(n_images, dtype='float32')
+    error = np.abs(dequantize(quantized, scale, offset) - data).max(0)
+    return quantized, scale, offset, error
+
+
+def dequantize(data, scale=None, offset=None):
+    """ Convert quantized reference data back to float32. Scale and offset
+    apply to the last axis (images). """
+    data = np.asarray(data, dtype='float32')
+    if scale is None:
+        return data
+    return data * scale + offset
+
+
+def _dequantize_dot(dot, data_sum, scale, offset):
+    """ Given the dot product of quantized reference data q and input data d,
+    return the dot product with the dequantized reference, using
+    (q * scale + offset) . d = scale * (q . d) + offset * sum(d). """
+    if scale is None:
+        return dot
+    shape = (-1,) + (1,) * (dot.ndim - 1)
+    return dot * scale.reshape(shape) + offset.reshape(shape) * data_sum
+
+
+def correlate(ref_data, data, n_voxels, mask=None, chunk_size=None,
+              scale=None, offset=None):
+    """ Correlate standardized input data with all images in a reference set.
+    The reference is read in contiguous blocks of rows and the dot product is
+    accumulated across blocks, so peak memory is bounded by the chunk size
+    rather than the size of the reference.
+    Args:
+        ref_data (array): a voxels x images array of standardized reference
+            images (typically a Reference memmap).
+        data (array): either a single standardized image (1D) or a voxels x
+            maps array of standardized images.
+        n_voxels (int): number of voxels to normalize the dot product by.
+        mask (array): optional boolean vector of voxels that contribute to the
+            correlation. Data must already be zero outside the mask; the mask
+            is only used to skip blocks that contain no retained voxels.
+        chunk_size (float): size of each block of the reference, in MB. If
+            None, the reference is processed in a single block.
+        scale, offset (array): per-image scale and offset of quantized
+            reference data (see quantize()).
+    Returns: An array of correlations, with one row per reference image and
+        (when data is 2D) one column per input map.
+    """
+    n_rows, n_images = ref_data.shape
+    step = n_rows if chunk_size is None else \
+        chunk_rows(n_images, chunk_size, ref_data.dtype.itemsize)
+    result = np.zeros((n_images,) + data.shape[1:], dtype='float64')
+    for start in range(0, n_rows, step):
+        stop = min(start + step, n_rows)
+        if mask is not None and not mask[start:stop].any():
+            continue
+        result += np.dot(ref_data[start:stop].T, data[start:stop])
+    result = _dequantize_dot(result, data.sum(0), scale, offset)
+    return result / n_voxels
+
+
+def is_sparse(data, threshold):
+    """ Whether at least a proportion threshold of voxels in data are zero
+    (or not finite). """
+    n_nonzero = np.count_nonzero(np.nan_to_num(data))
+    return n_nonzero <= (1 - threshold) * len(data)
+
+
+def dot_rows(ref_data, data, rows, chunk_size=None, scale=None,
+             offset=None):
+    """ Dot product of the reference and data restricted to the given rows.
+    Only the selected rows of the reference are read, in blocks of at most
+    chunk_size MB. Scale and offset dequantize the reference if needed. """
+    n_images = ref_data.shape[1]
+    step = max(len(rows), 1) if chunk_size is None else \
+        chunk_rows(n_images, chunk_size, ref_data.dtype.itemsize)
+    result = np.zeros(n_images, dtype='float64')
+    for start in range(0, len(rows), step):
+        block = rows[start:start + step]
+        result += np.dot(ref_data[block].T, data[block])
+    return _dequantize_dot(result, data[rows].sum(), scale, offset)
+
+
+def correlate_sparse(ref_data, data, n_voxels, col_sums, chunk_size=None,
+                     scale=None, offset=None):
+    """ Correlate a raw (unstandardized) image that is mostly zero with all
+    images in a reference set, reading only the reference rows where the image
+    is non-zero. Standardizing the image shifts every voxel by its mean, so the
+    contribution of the zero voxels is recovered from the precomputed column
+    sums of the reference:
+
+        sum_v ref[v] * (data[v] - m) / s
+            = (sum_{v: data[v] != 0} ref[v] * data[v] - m * sum_v ref[v]) / s
+
+    The result is identical to correlate(ref_data, standardize(data), ...).
+    Args:
+        ref_data (array): a voxels x images array of standardized reference
+            images.
+        data (array): a 1D image with no NaNs.
+        n_voxels (int): number of voxels to normalize the dot product by.
+        col_sums (array): sum of each column of ref_data.
+        chunk_size (float): maximum size of each block of rows read from the
+            reference, in MB.
+        scale, offset (array): per-image scale and offset of quantized
+            reference data (see quantize()).
+    """
+    data = np.asarray(data, dtype='float32')
+    mean, std = data.mean(dtype='float64'), data.std(dtype='float64')
+    rows = np.flatnonzero(data)
+    dot = dot_rows(ref_data, data, rows, chunk_size, scale, offset)
+    return (dot - mean * np.asarray(col_sums)) / (std * n_voxels)
+
+
+def top_k(values, k, sign='both'):
+    """ Return the indices of the k strongest values, strongest first, using a
+    partial sort. Non-finite values (e.g., NaNs from constant images) are
+    left out, so fewer than k indices may be returned.
+    Args:
+        values (array): a vector of correlations.
+        k (int): number of indices to return.
+        sign (str): 'pos' for the largest values, 'neg' for the smallest
+            (most negative), or 'both' for the largest absolute values.
+    """
+    values = np.asarray(values, dtype='float64')
+    if sign == 'pos':
+        scores = values
+    elif sign == 'neg':
+        scores = -values
+    else:
+        scores = np.abs(values)
+    finite = np.flatnonzero(np.isfinite(scores))
+    k = min(max(int(k), 0), len(finite))
+    if k == 0:
+        return np.array([], dtype=int)
+    inds = finite[np.argpartition(-scores[finite], k - 1)[:k]]
+    return inds[np.argsort(-scores[inds], kind='mergesort')]
@@ -0,0 +1,130 @@
+""" On-disk cache of masked image data. Reading a gzipped NIfTI image and
+masking it is slow, and the same images are masked over and over (decoding,
+scatterplots, region masks, memmap builds), so masked float32 vectors are
+stored as .npy files keyed by the path, size and modification time of the
+source image and by the mask used. The cache is bounded in size; the least
+recently used files are evicted first. Each process keeps a running count of
+the cache's size, so the directory is only scanned when the count crosses the
+limit, or every RECOUNT_INTERVAL writes to account for other processes. """
+from nsweb.initializers import settings
+import numpy as np
+from os.path import join, exists, abspath
+import hashlib
+import os
+
+
+_caches = {}
+
+# Number of writes after which a process recounts the size of the cache
+RECOUNT_INTERVAL = 100
+
+# Fraction of the maximum size the cache is pruned down to, so that a full
+# cache isn't scanned again on every write
+LOW_WATER = 0.9
+
+
+class MaskedImageCache(object):
+    """ A directory of cached masked images.
+    Args:
+        directory (str): where to store cached vectors.
+        max_size (float): maximum total size of the cache, in MB. If None,
+            the cache is never pruned.
+        mask_file (str): the mask applied to cached images; part of the key,
+            so caches of differently masked images can share a directory.
+    """
+
+    def __init__(self, directory, max_size=None, mask_file=''):
+        self.directory = directory
+        self.max_size = max_size
+        self.mask_file = mask_file
+        self._size = None  # In bytes, as of the last count plus our writes
+        self._writes = 0
+        if not exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, filename):
+        st = os.stat(filename)
+        key = '%s\t%d\t%f\t%s' % (abspath(filename), st.st_size, st.st_mtime,
+                                  self.mask_file)
+        key = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return join(self.directory, key + '.npy')
+
+    def get(self, filename, load):
+        """ Return the masked data for an image file, calling load(filename)
+        and caching the result on a miss. """
+        path = self._path(filename)
+        try:
+            data = np.load(path)
+            os.utime(path, None)  # Mark as recently used
+            return data
+        except (IOError, OSError, ValueError):
+            pass  # Missing, or evicted/being written by another process
+        data = np.asarray(load(filename), dtype='float32')
+        # The file may have been rewritten (e.g., resampled) while loading
+        path = self._path(filename)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, path)
+        self._added(os.path.getsize(path))
+        return data
+
+    def _added(self, size):
+        """ Count a newly written file of size bytes, pruning the cache if it
+        may have grown too large. """
+        if self.max_size is None:
+            return
+        self._writes += 1
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size * 2 ** 20 or \
+                self._writes % RECOUNT_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """ Count the size of the cache and, if it exceeds max_size MB, evict
+        least recently used files until it fits in LOW_WATER * max_size MB. """
+        if self.max_size is None:
+            return
+        files = []
+        for f in os.listdir(self.directory):
+            if not f.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(join(self.directory, f))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        total = sum(size for (mtime, size, f) in files)
+        if total > self.max_size * 2 ** 20:
+            limit = LOW_WATER * self.max_size * 2 ** 20
+            for (mtime, size, f) in sorted(files):
+                if total <= limit:
+                    break
+                try:
+                    os.unlink(join(self.directory, f))
+                except OSError:
+                    pass
+                total -= size
+        self._size = total
+
+
+def get_cache(mask_file):
+    """ Return the (shared) cache for images masked by mask_file, or None if
+    caching is disabled in settings. """
+    if settings.MASKED_IMAGE_CACHE_DIR is None:
+        return None
+    if mask_file not in _caches:
+        _caches[mask_file] = MaskedImageCache(
+            settings.MASKED_IMAGE_CACHE_DIR,
+            settings.MASKED_IMAGE_CACHE_SIZE, mask_file)
+    return _caches[mask_file]
+
+
+def cached_mask(mask_file, filename, load):
+    """ Return load(filename), from the cache of images masked by mask_file
+    when caching is enabled. """
+    cache = get_cache(mask_file)
+    if cache is None:
+        return load(filename)
+    return cache.get(filename, load)
@@ -0,0 +1,187 @@
+""" Reference image sets memory-mapped by DatabaseBuilder.memory_map_images,
+plus a process-wide store of them. When the store is loaded in the main Celery
+worker process before the pool forks, all pool processes inherit the same
+Reference objects and mapped pages. """
+from nsweb.initializers import settings
+from nsweb.initializers.build_version import get_build_version
+from nsweb.tasks.decoding import dequantize
+from nsweb.tasks.similarity import SketchIndex
+import numpy as np
+import pandas as pd
+from os.path import join, exists, getmtime
+from glob import glob
+from collections import OrderedDict
+import json
+import mmap
+import os
+import shutil
+
+
+_references = None
+# How the store was preloaded, and the build version it was loaded for
+_data_dir = None
+_prefault = False
+_version = None
+
+
+class Reference(object):
+
+    def __init__(self, name, n_voxels, n_images, is_subsampled,
+                 layouts=['voxel'], dtype='float32', data_dir=None,
+                 version=0, **kwargs):
+
+        self.name = name
+        self.n_voxels = n_voxels
+        self.n_images = n_images
+        self.is_subsampled = is_subsampled
+        self.dtype = dtype
+        # Incremented every time the memmap is (re)written, so processes can
+        # tell when to reload it (see get_references); other metadata (e.g.,
+        # the source file of each image) is only used when building
+        self.version = version
+
+        # Link to memmap data. The voxel-major (voxels x images) layout is
+        # always available; an image-major copy (images x voxels) is used for
+        # whole-image reads when it exists. The data files may live outside
+        # the memmap directory (e.g., when staged in shared memory).
+        if data_dir is None:
+            data_dir = settings.MEMMAP_DIR
+        mm_file = join(data_dir, name + '_images.dat')
+        self.data = np.memmap(mm_file, dtype=dtype, mode='r',
+                              shape=(n_voxels, n_images))
+        self.data_T = None
+        if 'image' in layouts:
+            mm_file = join(data_dir, name + '_images_T.dat')
+            self.data_T = np.memmap(mm_file, dtype=dtype, mode='r',
+                                    shape=(n_images, n_voxels))
+        # Link to labels
+        lab_file = join(settings.MEMMAP_DIR, name + '_labels.txt')
+        _labels = open(lab_file).read().splitlines()
+        self.labels = OrderedDict(zip(_labels, range(len(_labels))))
+
+        # Image stats
+        stat_file = join(settings.MEMMAP_DIR, name + '_stats.txt')
+        self.stats = pd.read_csv(stat_file, sep='\t')
+
+        # Per-image scale and offset used to dequantize int16 data
+        self.scale, self.offset = None, None
+        if dtype == 'int16':
+            self.scale = self.stats['scale'].values.astype('float32')
+            self.offset = self.stats['offset'].values.astype('float32')
+
+        # Column sums and sums of squares of the standardized data; used for
+        # sparse decoding. Missing for memmaps built by older versions.
+        mom_file = join(settings.MEMMAP_DIR, name + '_moments.txt')
+        self.moments = pd.read_csv(mom_file, sep='\t') \
+            if exists(mom_file) else None
+
+        # Optional index for approximate nearest-image search
+        sketch_file = join(settings.MEMMAP_DIR, name + '_sketch.npz')
+        self.sketch = SketchIndex.load(sketch_file) \
+            if exists(sketch_file) else None
+
+    def image(self, label):
+        """ Return all voxels of the named image. """
+        i = self.labels[label]
+        data = self.data_T[i] if self.data_T is not None else self.data[:, i]
+        if self.scale is None:
+            return dequantize(data)
+        return dequantize(data, self.scale[i], self.offset[i])
+
+    def images(self, inds):
+        """ Return all voxels of the images at the given (sorted) indices, as
+        an images x voxels array. """
+        if self.data_T is not None:
+            data = self.data_T[inds]
+        else:
+            data = self.data[:, inds].T
+        if self.scale is None:
+            return dequantize(data)
+        shape = (-1, 1)
+        return dequantize(data, self.scale[inds].reshape(shape),
+                          self.offset[inds].reshape(shape))
+
+    def voxel(self, ind):
+        """ Return the values of all images at the given voxel index (or
+        indices). """
+        return dequantize(self.data[ind, :], self.scale, self.offset)
+
+    def prefault(self):
+        """ Advise the kernel that all memmapped data will be needed, and
+        touch every page so it is mapped into this process. """
+        for data in [self.data, self.data_T]:
+            if data is None:
+                continue
+            mm = getattr(data, '_mmap', None)
+            if mm is not None and hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_WILLNEED)
+                # Only honored for shared memory (e.g., tmpfs) mappings
+                if hasattr(mmap, 'MADV_HUGEPAGE'):
+                    try:
+                        mm.madvise(mmap.MADV_HUGEPAGE)
+                    except OSError:
+                        pass
+            step = max(1, mmap.PAGESIZE // data.dtype.itemsize)
+            data.reshape(-1)[::step].sum()
+
+
+def _stage_data_files(name, data_dir):
+    """ Copy the memmapped data files of a reference set into data_dir (e.g.,
+    a directory under /dev/shm), unless an up-to-date copy exists. """
+    if not exists(data_dir):
+        os.makedirs(data_dir)
+    for f in glob(join(settings.MEMMAP_DIR, name + '_images*.dat')):
+        target = join(data_dir, os.path.basename(f))
+        if exists(target) and getmtime(target) >= getmtime(f):
+            continue
+        # Copy to a temporary file first so readers never see partial data;
+        # its name is unique to the process, as several may stage at once
+        tmp = join(data_dir, '.%d_%s' % (os.getpid(), os.path.basename(f)))
+        shutil.copyfile(f, tmp)
+        os.replace(tmp, target)
+
+
+def load_references(data_dir=None, current=None):
+    """ Return a dict of all memmapped reference sets, keyed by name.
+    Args:
+        data_dir (str): optional directory to stage the data files in and
+            map them from (e.g., a tmpfs directory under /dev/shm).
+        current (dict): reference sets loaded earlier; those that haven't
+            been rewritten since are reused rather than loaded again.
+    """
+    memmaps = {}
+    for f in glob(join(settings.MEMMAP_DIR, '*_metadata.json')):
+        md = json.load(open(f))
+        ref = (current or {}).get(md['name'])
+        if ref is not None and ref.version == md.get('version', 0):
+            memmaps[md['name']] = ref
+            continue
+        if data_dir is not None:
+            _stage_data_files(md['name'], data_dir)
+        memmaps[md['name']] = Reference(data_dir=data_dir, **md)
+    return memmaps
+
+
+def preload_references(data_dir=None, prefault=True):
+    """ Load all reference sets into the process-wide store, optionally
+    faulting in all of their pages. """
+    global _references, _data_dir, _prefault, _version
+    _data_dir, _prefault = data_dir, prefault
+    _version = get_build_version()
+    old = _references
+    _references = load_references(data_dir, old)
+    if prefault:
+        for ref in _references.values():
+            if ref is not (old or {}).get(ref.name):
+                ref.prefault()
+    return _references
+
+
+def get_references():
+    """ Return the process-wide reference store, loading it if needed.
+    When the data have been rebuilt since the store was loaded, reference
+    sets whose memmaps were rewritten are reloaded, so their data and stats
+    always match. """
+    if _references is None or get_build_version() != _version:
+        preload_references(_data_dir, _prefault)
+    return _references
@@ -0,0 +1,80 @@
+""" Nearest-neighbour resampling of uploaded images into the space of the
+anatomical template. Images from the same source (e.g., a NeuroVault
+collection) usually share a shape and affine, so the source voxel of every
+target voxel is computed once per distinct (shape, affine) pair and cached;
+resampling an image is then a single gather. """
+from nsweb.initializers import settings
+import nibabel as nb
+import numpy as np
+from os.path import join
+from collections import OrderedDict
+
+
+_resampler = None
+
+
+class Resampler(object):
+    """ Resamples images into a fixed target space.
+    Args:
+        target_affine (array): 4 x 4 affine of the target space.
+        target_shape (tuple): shape of the target space.
+        max_maps (int): number of index maps to keep, i.e., the number of
+            distinct (shape, affine) pairs that can be resampled without
+            recomputing the map. Each map takes 8 bytes per target voxel.
+    """
+
+    def __init__(self, target_affine, target_shape=(91, 109, 91),
+                 max_maps=32):
+        self.target_affine = np.asarray(target_affine, dtype='float64')
+        self.target_shape = tuple(target_shape)
+        self.max_maps = max_maps
+        self._maps = OrderedDict()
+
+    def index_map(self, shape, affine):
+        """ Return the flat (C-order) index of the nearest source voxel for
+        each target voxel, or -1 where it falls outside the source image. """
+        shape = tuple(shape[:3])
+        affine = np.asarray(affine, dtype='float64')
+        key = (shape, affine.round(6).tobytes())
+        if key in self._maps:
+            self._maps[key] = self._maps.pop(key)  # Mark as recently used
+            return self._maps[key]
+
+        # Map target voxel coordinates to source voxel coordinates
+        transform = np.linalg.solve(affine, self.target_affine)
+        ijk = np.indices(self.target_shape).reshape(3, -1)
+        coords = transform[:3, :3].dot(ijk) + transform[:3, 3:]
+        coords = np.floor(coords + 0.5).astype(int)
+        valid = np.all((coords >= 0) &
+                       (coords < np.array(shape).reshape(3, 1)), axis=0)
+        inds = np.full(coords.shape[1], -1, dtype='int64')
+        inds[valid] = np.ravel_multi_index(tuple(coords[:, valid]), shape)
+
+        self._maps[key] = inds
+        if len(self._maps) > self.max_maps:
+            self._maps.popitem(last=False)
+        return inds
+
+    def resample(self, img):
+        """ Resample a nibabel image into the target space. Any dimensions
+        beyond the first three (e.g., volumes) are kept. """
+        data = np.asarray(img.get_data())
+        inds = self.index_map(data.shape, img.get_affine())
+        extra = data.shape[3:]
+        data = data.reshape((-1,) + extra)
+        result = np.zeros((len(inds),) + extra, dtype=data.dtype)
+        valid = inds >= 0
+        result[valid] = data[inds[valid]]
+        result = result.reshape(self.target_shape + extra)
+        return nb.Nifti1Image(result, self.target_affine)
+
+
+def get_resampler():
+    """ Return the process-wide Resampler into the space of the anatomical
+    template. """
+    global _resampler
+    if _resampler is None:
+        anatomical = nb.load(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
+        _resampler = Resampler(anatomical.get_affine(),
+                               anatomical.shape[:3])
+    return _resampler
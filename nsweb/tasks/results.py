@@ -0,0 +1,138 @@
+""" Append-only storage of decoding results. All decodings against the same
+DecodingSet are stored as rows of a single float32 matrix, with one shared
+label vector, instead of one text file per decoding. An SQLite index maps
+each decoding UUID to its row, so reading a decoding is an index lookup plus a
+single small read. """
+from nsweb.initializers import settings
+import numpy as np
+import pandas as pd
+from os.path import join, exists
+import hashlib
+import sqlite3
+import os
+
+
+_stores = {}
+
+
+class DecodingStore(object):
+    """ Decoding results for a single DecodingSet.
+
+    Files (all in DECODING_RESULTS_DIR):
+        <name>_index.sqlite: maps the UUID of each decoding to its label
+            generation and row number.
+        <name>_<generation>.dat: the float32 results matrix for all decodings
+            that share a label vector.
+        <name>_<generation>_labels.txt: the shared label vector.
+
+    A new generation starts whenever the labels of the reference set change
+    (e.g., after the memmaps are rebuilt), so older rows remain readable.
+    """
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory or settings.DECODING_RESULTS_DIR
+        self.index_file = join(self.directory, name + '_index.sqlite')
+        self._conn = None
+        self._pid = None
+        self._labels = {}
+
+    def _files(self, generation):
+        prefix = join(self.directory, '%s_%s' % (self.name, generation))
+        return prefix + '.dat', prefix + '_labels.txt'
+
+    def _index(self):
+        """ Return the connection to the index, opening it in each process
+        (connections can't be shared across forks). """
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.index_file, timeout=60,
+                                   isolation_level=None)
+            # Let readers proceed while a decoding is being appended
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS decodings (uuid TEXT '
+                         'PRIMARY KEY, generation TEXT, row INTEGER)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _get_labels(self, generation):
+        if generation not in self._labels:
+            lab_file = self._files(generation)[1]
+            self._labels[generation] = open(lab_file).read().splitlines()
+        return self._labels[generation]
+
+    def append(self, uuid, values, labels):
+        """ Store a vector of decoding results. Safe to call concurrently from
+        multiple processes. """
+        labels = list(labels)
+        generation = hashlib.md5('\n'.join(labels).encode('utf-8')) \
+            .hexdigest()[:8]
+        data_file, lab_file = self._files(generation)
+        values = np.asarray(values, dtype='float32')
+        index = self._index()
+        # The write transaction serializes appends across processes
+        index.execute('BEGIN IMMEDIATE')
+        try:
+            if not exists(lab_file):
+                open(lab_file, 'w').write('\n'.join(labels))
+            with open(data_file, 'ab') as f:
+                size = f.tell()
+                if size % values.nbytes:
+                    # Drop the partial row left by a writer that crashed
+                    size -= size % values.nbytes
+                    f.truncate(size)
+                    f.seek(size)
+                row = size // values.nbytes
+                f.write(values.tobytes())
+            # Data are written before the index entry that points to them
+            index.execute('INSERT OR REPLACE INTO decodings VALUES (?, ?, ?)',
+                          (uuid, generation, row))
+            index.execute('COMMIT')
+        except BaseException:
+            index.execute('ROLLBACK')
+            raise
+        return row
+
+    def get(self, uuid):
+        """ Return the results of a decoding as a pandas Series indexed by
+        label, or None if the UUID isn't in the store. """
+        if not exists(self.index_file):
+            return None
+        found = self._index().execute(
+            'SELECT generation, row FROM decodings WHERE uuid = ?',
+            (uuid,)).fetchone()
+        if found is None:
+            return None
+        generation, row = found
+        labels = self._get_labels(generation)
+        n = len(labels)
+        data = np.fromfile(self._files(generation)[0], dtype='float32',
+                           count=n, offset=row * n * 4)
+        return pd.Series(data, index=labels)
+
+
+def get_store(name):
+    """ Return the (cached) DecodingStore for the named DecodingSet. """
+    if name not in _stores:
+        _stores[name] = DecodingStore(name)
+    return _stores[name]
+
+
+def save_decoding(name, uuid, values, labels):
+    """ Store the results of a decoding against the named DecodingSet. """
+    return get_store(name).append(uuid, values, labels)
+
+
+def load_decoding(name, uuid):
+    """ Return the results of a decoding as a pandas Series indexed by label,
+    or None if no results exist. Falls back on the per-decoding text files
+    written by earlier versions. """
+    results = get_store(name).get(uuid)
+    if results is not None:
+        return results
+    legacy_file = join(settings.DECODING_RESULTS_DIR, uuid + '.txt')
+    if not exists(legacy_file):
+        return None
+    data = open(legacy_file).read().splitlines()
+    data = [x.split('\t') for x in data]
+    data = [(f, float(v) if v.strip() else np.nan) for (f, v) in data if f]
+    return pd.Series([v for (f, v) in data], index=[f for (f, v) in data])
@@ -0,0 +1,369 @@
+""" Chunked storage of per-seed images, such as the coactivation map of every
+location. Seeds are the voxels of a mask, numbered in the order in which the
+Masker returns them, and each seed's image is stored as a compressed vector of
+masked voxel values. Consecutive seeds are grouped into chunk files with a
+table of offsets at the start, so any seed can be read with two small reads
+and without touching the rest of its chunk. Chunks are written whole and
+atomically; a chunk file that exists is complete. Images of single seeds made
+on demand are stored in their own files until their chunk is written.
+
+The web app keeps one store per kind of location image in
+settings.SEED_STORE_DIR. Location images refer to seed images by the path of a
+NIfTI file (see seed_image_file) that is only written when the image is
+downloaded; everything else reads the masked data from the store. Written
+NIfTI files are a cache, bounded to settings.SEED_NIFTI_CACHE_SIZE MB. """
+from nsweb.initializers import settings
+import nibabel as nb
+import numpy as np
+import json
+import zlib
+import re
+import os
+import multiprocessing
+from os.path import join, exists, dirname, basename
+
+
+class SeedStore(object):
+    """ A store of seed-indexed images.
+    Args:
+        directory (str): directory of a store made with SeedStore.create.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(join(directory, 'metadata.json')) as f:
+            meta = json.load(f)
+        self.name = meta['name']
+        self.chunk_size = meta['chunk_size']
+        self.dtype = np.dtype(meta['dtype'])
+        self.mask = nb.load(join(directory, 'mask.nii.gz'))
+        self.shape = self.mask.shape[:3]
+        self.affine = self.mask.get_affine()
+        self.voxels = np.flatnonzero(self.mask.get_data().ravel())
+        self.n_seeds = len(self.voxels)
+        self.n_chunks = -(-self.n_seeds // self.chunk_size)
+        # Seed index of every voxel in the volume, or -1 outside the mask
+        self.index = np.full(int(np.prod(self.shape)), -1, dtype='int64')
+        self.index[self.voxels] = np.arange(self.n_seeds)
+
+    @classmethod
+    def create(cls, directory, mask, name=None, chunk_size=256,
+               dtype='float16'):
+        """ Create an empty store.
+        Args:
+            directory (str): where to create the store.
+            mask: nibabel image whose non-zero voxels are both the seeds and
+                the voxels stored for each seed--e.g., the volume of the
+                Masker used to make the images.
+            name (str): optional name of the store.
+            chunk_size (int): number of seeds per chunk file.
+            dtype (str): data type images are stored in.
+        """
+        if not exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # Write both files atomically, with the metadata last, so a store is
+        # complete once its metadata exists and concurrent creation is safe
+        data = (mask.get_data() != 0).astype('uint8')
+        tmp = join(directory, '.%d_mask.nii.gz' % os.getpid())
+        nb.Nifti1Image(data, mask.get_affine()).to_filename(tmp)
+        os.replace(tmp, join(directory, 'mask.nii.gz'))
+        meta = {
+            'name': name or basename(directory.rstrip(os.sep)),
+            'chunk_size': chunk_size,
+            'dtype': str(np.dtype(dtype))
+        }
+        tmp = join(directory, '.%d_metadata.json' % os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, join(directory, 'metadata.json'))
+        return cls(directory)
+
+    def seed(self, x, y, z):
+        """ Return the seed index of the voxel at MNI coordinates (x, y, z), or
+        -1 if it is not in the mask. """
+        ijk = np.linalg.solve(self.affine, [x, y, z, 1])[:3]
+        ijk = np.floor(ijk + 0.5).astype(int)
+        if np.any(ijk < 0) or np.any(ijk >= self.shape):
+            return -1
+        return int(self.index[np.ravel_multi_index(tuple(ijk), self.shape)])
+
+    def coords(self, seeds):
+        """ Return the n_seeds x 3 array of MNI coordinates of seeds. """
+        ijk = np.array(np.unravel_index(self.voxels[seeds], self.shape))
+        xyz = self.affine[:3, :3].dot(ijk) + self.affine[:3, 3:]
+        return np.round(xyz.T).astype(int)
+
+    def chunk_seeds(self, chunk):
+        """ Return the indices of the seeds in a chunk. """
+        start = chunk * self.chunk_size
+        return np.arange(start, min(start + self.chunk_size, self.n_seeds))
+
+    def _chunk_file(self, chunk):
+        return join(self.directory, 'chunk_%05d.bin' % chunk)
+
+    def has_chunk(self, chunk):
+        return exists(self._chunk_file(chunk))
+
+    def _seed_file(self, seed):
+        return join(self.directory, 'seed_%07d.bin' % seed)
+
+    def _write(self, filename, data):
+        tmp = join(self.directory, '.%d_%s' % (os.getpid(),
+                                               basename(filename)))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def missing_chunks(self):
+        """ Return the chunks that haven't been written yet. """
+        return [c for c in range(self.n_chunks) if not self.has_chunk(c)]
+
+    def _compress(self, data):
+        if data is None:
+            return b''
+        data = np.asarray(data, dtype=self.dtype)
+        if data.shape != (self.n_seeds,):
+            raise ValueError("Expected an image of %d voxels, got shape %s." %
+                             (self.n_seeds, data.shape))
+        return zlib.compress(data.tobytes())
+
+    def _decompress(self, blob):
+        if not blob:
+            return None
+        data = np.frombuffer(zlib.decompress(blob), dtype=self.dtype)
+        return data.astype('float32')
+
+    def write_chunk(self, chunk, images):
+        """ Write the images of all seeds in a chunk, in seed order. Seeds
+        without an image are passed as None. """
+        n = len(self.chunk_seeds(chunk))
+        if len(images) != n:
+            raise ValueError("Chunk %d has %d seeds, got %d images." %
+                             (chunk, n, len(images)))
+        blobs = [self._compress(img) for img in images]
+        offsets = np.cumsum([8 * (n + 1)] + [len(b) for b in blobs])
+        self._write(self._chunk_file(chunk),
+                    offsets.astype('<i8').tobytes() + b''.join(blobs))
+        # The chunk supersedes images of single seeds
+        for seed in self.chunk_seeds(chunk):
+            if exists(self._seed_file(seed)):
+                os.remove(self._seed_file(seed))
+
+    def put(self, seed, data):
+        """ Store the image of a single seed, e.g., one made on demand. """
+        self._write(self._seed_file(seed), self._compress(data))
+
+    def has(self, seed):
+        """ Return whether a seed has an image, without reading it. """
+        if seed < 0 or seed >= self.n_seeds:
+            return False
+        chunk, i = divmod(int(seed), self.chunk_size)
+        if not self.has_chunk(chunk):
+            try:
+                return os.path.getsize(self._seed_file(seed)) > 0
+            except OSError:
+                if not self.has_chunk(chunk):
+                    return False
+        with open(self._chunk_file(chunk), 'rb') as f:
+            f.seek(8 * i)
+            start, end = np.frombuffer(f.read(16), dtype='<i8')
+        return bool(end > start)
+
+    def get(self, seed):
+        """ Return the image of a seed as a float32 vector of masked voxel
+        values, or None if the seed has no image (yet). """
+        if seed < 0 or seed >= self.n_seeds:
+            return None
+        chunk, i = divmod(int(seed), self.chunk_size)
+        if not self.has_chunk(chunk):
+            try:
+                with open(self._seed_file(seed), 'rb') as f:
+                    return self._decompress(f.read())
+            except IOError:
+                # Not made yet, or just superseded by its chunk
+                if not self.has_chunk(chunk):
+                    return None
+        with open(self._chunk_file(chunk), 'rb') as f:
+            f.seek(8 * i)
+            start, end = np.frombuffer(f.read(16), dtype='<i8')
+            f.seek(start)
+            return self._decompress(f.read(end - start))
+
+    def mask_image(self, img):
+        """ Return the masked voxel values of a nibabel image in the space of
+        the store. """
+        return np.asarray(img.get_data(), dtype='float32').ravel()[
+            self.voxels]
+
+    def unmask(self, data):
+        """ Return a nibabel image of a vector of masked voxel values. """
+        img = np.zeros(int(np.prod(self.shape)), dtype='float32')
+        img[self.voxels] = data
+        return nb.Nifti1Image(img.reshape(self.shape), self.affine)
+
+
+def _import_chunk(args):
+    directory, pattern, chunk = args
+    store = SeedStore(directory)
+    images = []
+    for xyz in store.coords(store.chunk_seeds(chunk)):
+        filename = pattern % tuple(xyz)
+        images.append(store.mask_image(nb.load(filename))
+                      if exists(filename) else None)
+    store.write_chunk(chunk, images)
+    return chunk
+
+
+def import_images(directory, pattern, mask, n_jobs=1, chunk_size=256):
+    """ Import per-seed NIfTI images (e.g., functional connectivity maps)
+    into a store. Chunks that already exist are skipped, so an interrupted
+    import resumes where it left off.
+    Args:
+        directory (str): directory of the store; created if needed.
+        pattern (str): path of the image of each seed, with three integer
+            placeholders for its x, y and z coordinates. Images must be in
+            the space of the mask.
+        mask: nibabel image of the seeds, used to create a new store.
+        n_jobs (int): number of processes.
+        chunk_size (int): number of seeds per chunk of a new store.
+    """
+    if exists(join(directory, 'metadata.json')):
+        store = SeedStore(directory)
+    else:
+        store = SeedStore.create(directory, mask, chunk_size=chunk_size)
+    chunks = store.missing_chunks()
+    print("Importing %d of %d chunks of %d seeds..." % (
+        len(chunks), store.n_chunks, store.chunk_size))
+    args = [(directory, pattern, c) for c in chunks]
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        import_chunks = pool.imap_unordered
+    else:
+        pool = None
+        import_chunks = map
+    try:
+        for k, chunk in enumerate(import_chunks(_import_chunk, args)):
+            print("Chunk %d done (%d/%d)." % (chunk, k + 1, len(chunks)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+_stores = {}
+
+# Number of NIfTI files written by this process; the NIfTI directories are
+# pruned every PRUNE_INTERVAL writes
+_nifti_writes = 0
+PRUNE_INTERVAL = 100
+
+
+def get_store(kind):
+    """ Return the SeedStore of a kind of location image (e.g.,
+    'coactivation'), or None if it hasn't been created. """
+    if kind not in _stores:
+        directory = join(settings.SEED_STORE_DIR, kind)
+        if not exists(join(directory, 'metadata.json')):
+            return None
+        _stores[kind] = SeedStore(directory)
+    return _stores[kind]
+
+
+def seed_image_file(kind, x, y, z):
+    """ Return the path of the NIfTI file of a seed image. """
+    return join(settings.SEED_STORE_DIR, kind, 'nifti',
+                '%s_%d_%d_%d.nii.gz' % (kind, x, y, z))
+
+
+def has_seed_image(kind, x, y, z):
+    """ Return whether the seed at (x, y, z) has an image of a kind. Cheaper
+    than get_seed_image, as the image isn't read. """
+    store = get_store(kind)
+    return store is not None and store.has(store.seed(x, y, z))
+
+
+def get_seed_image(kind, x, y, z):
+    """ Return the masked data of the image of a kind for the seed at
+    (x, y, z), or None if there is none. """
+    store = get_store(kind)
+    if store is None:
+        return None
+    return store.get(store.seed(x, y, z))
+
+
+def _parse_seed_image_file(filename):
+    """ Return the kind and coordinates of a seed_image_file, or None if
+    filename isn't one. """
+    m = re.match(r'(\w+?)_(-?\d+)_(-?\d+)_(-?\d+)\.nii\.gz$',
+                 basename(filename))
+    if m is None:
+        return None
+    kind, x, y, z = m.group(1), int(m.group(2)), int(m.group(3)), \
+        int(m.group(4))
+    if seed_image_file(kind, x, y, z) != filename:
+        return None
+    return kind, x, y, z
+
+
+def load_seed_image(filename):
+    """ Return a nibabel image of the seed image a seed_image_file refers
+    to, read from its store, or None if filename isn't a seed image file or
+    the image doesn't exist. """
+    seed = _parse_seed_image_file(filename)
+    if seed is None:
+        return None
+    kind, x, y, z = seed
+    data = get_seed_image(kind, x, y, z)
+    if data is None:
+        return None
+    return get_store(kind).unmask(data)
+
+
+def write_nifti(filename):
+    """ Make sure a NIfTI file exists for a seed image file, writing it from
+    the store if needed. Other filenames are left alone. """
+    global _nifti_writes
+    if _parse_seed_image_file(filename) is None:
+        return filename
+    if exists(filename):
+        try:
+            os.utime(filename, None)  # Mark as recently used
+            return filename
+        except OSError:
+            pass  # Just pruned by another process
+    img = load_seed_image(filename)
+    if img is not None:
+        os.makedirs(dirname(filename), exist_ok=True)
+        tmp = join(dirname(filename), '.%d_%s' % (os.getpid(),
+                                                  basename(filename)))
+        img.to_filename(tmp)
+        os.replace(tmp, filename)
+        _nifti_writes += 1
+        if _nifti_writes % PRUNE_INTERVAL == 0:
+            prune_nifti(dirname(filename), settings.SEED_NIFTI_CACHE_SIZE)
+    return filename
+
+
+def prune_nifti(directory, max_size):
+    """ Delete the least recently used NIfTI files in a directory until they
+    take up at most max_size MB. A max_size of None means no limit. """
+    if max_size is None:
+        return
+    files = []
+    for f in os.listdir(directory):
+        if not f.endswith('.nii.gz') or f.startswith('.'):
+            continue
+        try:
+            st = os.stat(join(directory, f))
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, f))
+    total = sum(size for (mtime, size, f) in files)
+    for (mtime, size, f) in sorted(files):
+        if total <= max_size * 2 ** 20:
+            break
+        try:
+            os.unlink(join(directory, f))
+        except OSError:
+            pass
+        total -= size
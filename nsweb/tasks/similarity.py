@@ -0,0 +1,88 @@
+""" Approximate nearest-image search over reference image sets. Each set's
+standardized images are compressed into short count-sketches (a sparse random
+projection); a query is sketched the same way, candidate images are ranked by
+their estimated correlation, and only the best candidates are re-ranked using
+the exact reference data. """
+from nsweb.tasks.decoding import chunk_rows, dequantize
+import numpy as np
+from scipy import sparse
+
+
+class SketchIndex(object):
+    """ Count-sketch index of the images in a reference set.
+    Args:
+        buckets (array): the sketch dimension each voxel is hashed into.
+        signs (array): the random sign (+1/-1) applied to each voxel.
+        sketches (array): an images x dimensions array of image sketches.
+    """
+
+    def __init__(self, buckets, signs, sketches):
+        self.buckets = buckets
+        self.signs = signs
+        self.sketches = sketches
+        n_dims = sketches.shape[1]
+        self.projection = sparse.csr_matrix(
+            (signs.astype('float32'), (buckets, np.arange(len(buckets)))),
+            shape=(n_dims, len(buckets)))
+
+    @classmethod
+    def build(cls, ref_data, n_dims=512, seed=0, chunk_size=64, scale=None,
+              offset=None):
+        """ Sketch all images in a voxels x images reference array, reading
+        it in blocks of chunk_size MB. Scale and offset dequantize the
+        reference if needed. """
+        n_voxels, n_images = ref_data.shape
+        rng = np.random.RandomState(seed)
+        buckets = rng.randint(0, n_dims, n_voxels).astype('int32')
+        signs = rng.choice([-1, 1], n_voxels).astype('int8')
+        index = cls(buckets, signs, np.zeros((n_images, n_dims), 'float32'))
+        step = chunk_rows(n_images, chunk_size, ref_data.dtype.itemsize)
+        projection = index.projection.tocsc()  # fast column slicing
+        sketches = np.zeros((n_dims, n_images), dtype='float64')
+        for start in range(0, n_voxels, step):
+            stop = min(start + step, n_voxels)
+            block = dequantize(ref_data[start:stop], scale, offset)
+            sketches += projection[:, start:stop].dot(block)
+        index.sketches = sketches.T.astype('float32')
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['buckets'], data['signs'], data['sketches'])
+
+    def save(self, filename):
+        np.savez(filename, buckets=self.buckets, signs=self.signs,
+                 sketches=self.sketches)
+
+    def estimate(self, data):
+        """ Estimate the dot products of a standardized image with all
+        images in the index. """
+        return self.sketches.dot(self.projection.dot(data))
+
+    def candidates(self, data, n):
+        """ Return the indices of the n images with the largest estimated
+        dot products with the input image. """
+        est = self.estimate(data)
+        n = min(n, len(est))
+        return np.argpartition(-est, n - 1)[:n]
+
+
+def find_similar(ref, data, k=10, oversample=5, min_candidates=50):
+    """ Find the images in a reference set most correlated with an input
+    image, using the reference's SketchIndex to select candidates and the
+    exact data to rank them.
+    Args:
+        ref (Reference): the reference set; must have a sketch index.
+        data (array): a standardized image in the reference's voxel space.
+        k (int): number of images to return.
+        oversample (int): number of candidates to re-rank per returned image.
+        min_candidates (int): minimum number of candidates to re-rank.
+    Returns: A list of (label, r) tuples, most similar first.
+    """
+    n = max(k * oversample, min_candidates)
+    cands = np.sort(ref.sketch.candidates(data, n))
+    r = ref.images(cands).dot(data) / ref.n_voxels
+    order = np.argsort(-r)[:k]
+    labels = list(ref.labels.keys())
+    return [(labels[cands[i]], float(r[i])) for i in order]
@@ -0,0 +1,103 @@
+""" Coalescing of identical Celery tasks. The first caller to submit a task
+with given arguments starts it; callers that submit the same task and
+arguments while it's running attach to the running job instead of starting
+their own. Running jobs are tracked in Redis, keyed by the task name and the
+normalized arguments. """
+from nsweb.initializers import settings
+from celery.result import AsyncResult
+import hashlib
+import json
+import uuid
+import redis
+
+
+_redis = None
+
+# Replace the job a key refers to, but only if it still refers to the given
+# (finished) job, so only one of several callers that saw it finish wins
+_REPLACE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return false
+"""
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.SINGLE_FLIGHT_REDIS_URL)
+    return _redis
+
+
+def _normalize(value):
+    """ Make equivalent arguments serialize identically--e.g., 2 and 2.0,
+    or tuples and lists. """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), _normalize(v)) for (k, v) in value.items())
+    return value
+
+
+def make_key(task, args=(), kwargs=None):
+    """ Return the Redis key identifying calls of a task with the given
+    arguments. """
+    call = [task.name, _normalize(args), _normalize(kwargs or {})]
+    call = json.dumps(call, sort_keys=True, default=str)
+    return 'nsweb:single_flight:' + \
+        hashlib.md5(call.encode('utf-8')).hexdigest()
+
+
+def current_job(task, args=(), kwargs=None, key=None):
+    """ Return the ID of the last job delay_once started for a task with the
+    given arguments, if that was at most SINGLE_FLIGHT_TIMEOUT seconds ago,
+    or None. """
+    if key is None:
+        key = make_key(task, args, kwargs)
+    try:
+        job_id = _get_redis().get(key)
+    except redis.RedisError:
+        return None
+    return job_id.decode('utf-8') if job_id is not None else None
+
+
+def delay_once(task, args=(), kwargs=None, key=None, task_id=None):
+    """ Start a task unless an identical one is already running, and return
+    the AsyncResult of the job that will produce the result.
+    Args:
+        task: the Celery task.
+        args, kwargs: arguments to the task.
+        key: the key identifying identical calls. Defaults to
+            make_key(task, args, kwargs); pass a custom key when arguments
+            include values unique to each call (e.g., output UUIDs).
+        task_id: ID of the job, if it is started by this call.
+    """
+    if key is None:
+        key = make_key(task, args, kwargs)
+    if task_id is None:
+        task_id = uuid.uuid4().hex
+    timeout = settings.SINGLE_FLIGHT_TIMEOUT
+    try:
+        r = _get_redis()
+        # Retry while other callers replace the key under us (if that keeps
+        # happening, run the task without coalescing)
+        for attempt in range(10):
+            running = r.get(key)
+            if running is None:
+                if r.set(key, task_id, nx=True, ex=timeout):
+                    break
+                continue
+            running = running.decode('utf-8')
+            result = AsyncResult(running, app=task.app)
+            if not result.ready():
+                return result
+            # The previous job has finished; start a new one, unless another
+            # caller already has
+            if r.eval(_REPLACE, 1, key, running, task_id, timeout):
+                break
+    except redis.RedisError:
+        pass  # Run the task without coalescing
+    return task.apply_async(args, kwargs or {}, task_id=task_id)
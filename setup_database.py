@@ -1,6 +1,7 @@
 from nsweb.core import create_app, db, app
 from nsweb.initializers import settings
 from nsweb.initializers import database_builder
+from nsweb.initializers.build_version import bump_build_version
 import pandas as pd
 import os
 
@@ -41,6 +42,9 @@ def main():
     else:
         builder.add_studies(analyses=analyses)
 
+    print("Indexing studies by location...")
+    builder.build_voxel_study_index()
+
     print("Adding feature-based meta-analysis images...")
     builder.generate_analysis_images(
         analyses=analyses, add_to_db=False, overwrite=True)
@@ -55,7 +59,17 @@ def main():
     builder.add_genes()
 
     print("Memory-mapping key image sets...")
-    builder.memory_map_images(include=['terms', 'topics', 'genes'], reset=True)
+    builder.memory_map_images(include=['terms', 'topics', 'genes'], reset=True,
+                              transpose=True)
+
+    print("Building similarity indexes...")
+    builder.build_similarity_indexes()
+
+    # Invalidate data derived from the previous build
+    bump_build_version()
+
+    print("Exporting studies...")
+    builder.export_studies()
 
 
 
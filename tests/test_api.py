@@ -3,6 +3,8 @@ from nsweb.initializers import settings
 import json
 import requests
 import re
+import time
+from requests.compat import urljoin
 
 root_url = settings.TEST_URL
 api_url = root_url + '/api/'
@@ -83,3 +85,24 @@ def test_decode_api():
     assert float(dec['id'])
     assert float(dec['neurovault_id'])
 
+
+
+def test_async_jobs_api():
+
+    url = api_url + '/decode'
+
+    # Decode in the background, then poll the job until it redirects to the
+    # finished decoding
+    r = requests.get(url + '?neurovault=4934&async=1', allow_redirects=False)
+    if r.status_code == 202:
+        job_url = urljoin(root_url, r.headers['Location'])
+        for i in range(60):
+            r = requests.get(job_url, allow_redirects=False)
+            if r.status_code != 200:
+                break
+            assert r.json()['data']['status'] in ['pending', 'running']
+            time.sleep(1)
+        assert r.status_code == 303
+        r = requests.get(urljoin(root_url, r.headers['Location']))
+    dec = r.json()['data']
+    assert len(dec['values']) > 100
@@ -0,0 +1,74 @@
+""" Test the coactivation engine against neurosynth's meta-analysis. """
+from nsweb.tasks.coactivation import CoactivationEngine, fdr, p_to_z
+from scipy import sparse, special
+import numpy as np
+
+
+def _association_test(data, ids, selected, q=0.01, min_studies=0.01):
+    """ The association test of neurosynth.analysis.meta.MetaAnalysis. """
+    sel = np.array([i in selected for i in ids])
+    n_sel, n_unsel = sel.sum(), (~sel).sum()
+    a = data.dot(sel.astype(float))
+    b = data.dot((~sel).astype(float))
+    pAgF, pAgU = a / n_sel, b / n_unsel
+    cells = np.squeeze(np.array([[a, b], [n_sel - a, n_unsel - b]]).T)
+    total = cells.sum((1, 2))
+    chi_sq = np.zeros(cells.shape)
+    for i in range(2):
+        for j in range(2):
+            exp = cells[:, i, :].sum(1) * cells[:, :, j].sum(1) / total
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chi_sq[:, i, j] = (cells[:, i, j] - exp) ** 2 / exp
+            chi_sq[exp == 0, i, j] = 1.0
+    p = special.chdtrc(1, chi_sq.sum((1, 2)))
+    p[p < 1e-240] = 1e-240
+    z = p_to_z(p, np.sign(pAgF - pAgU))
+    z_fdr = z * (p <= fdr(p, q))
+    z_fdr[pAgF < min_studies] = 0
+    return z_fdr
+
+
+def test_coactivation_matches_meta_analysis():
+    rng = np.random.RandomState(0)
+    n_voxels, n_studies = 2000, 300
+    data = sparse.random(n_voxels, n_studies, density=0.05, random_state=rng)
+    data.data[:] = 1
+    # Make a block of voxels coactivate with the first 40 studies
+    data = data.tolil()
+    data[:100, :40] = rng.uniform(size=(100, 40)) < 0.6
+    data = data.tocsr()
+    ids = np.arange(1000, 1000 + n_studies)
+    coords = rng.uniform(-60, 60, size=(3000, 3))
+    peak_ids = rng.choice(ids, 3000)
+
+    engine = CoactivationEngine(data, ids, coords, peak_ids)
+    selected = list(ids[:40]) + [1]  # IDs missing from the data are ignored
+    z_fdr = engine.association_test(selected)[1]
+    expected = _association_test(data.toarray(), ids, ids[:40])
+    assert np.allclose(z_fdr, expected)
+    assert (z_fdr[:100] > 0).mean() > 0.9
+
+    xyz = np.array([0, 14, 42])
+    dists = np.sqrt(np.square(coords - xyz).sum(1))
+    assert list(engine.get_studies(xyz, 20)) == \
+        sorted(set(peak_ids[dists < 20]))
+
+
+def test_sweep_matches_association_test():
+    rng = np.random.RandomState(1)
+    n_studies = 200
+    data = sparse.random(500, n_studies, density=0.1, random_state=rng)
+    data.data[:] = 1
+    ids = np.arange(n_studies)
+    coords = rng.uniform(-20, 20, size=(4000, 3))
+    peak_ids = rng.choice(ids, 4000)
+    engine = CoactivationEngine(data, ids, coords, peak_ids)
+
+    # A line of adjacent seeds, plus one far outside the peaks
+    seeds = [[0, 0, z] for z in range(-10, 12, 2)] + [[80, 80, 80]]
+    maps = list(engine.sweep(seeds, r=6, min_count=20))
+    assert maps[-1] is None
+    for xyz, z_fdr in zip(seeds[:-1], maps):
+        studies = engine.get_studies(xyz, 6)
+        assert len(studies) >= 20
+        assert np.allclose(z_fdr, engine.association_test(studies)[1])
@@ -0,0 +1,156 @@
+""" Test decoder numerics. """
+from nsweb.tasks.decoding import (standardize, standardize_nonzero, correlate,
+                                  correlate_sparse, dot_rows, is_sparse,
+                                  quantize, dequantize, top_k)
+from nsweb.tasks.results import DecodingStore
+from nsweb.tasks.similarity import SketchIndex, find_similar
+from collections import OrderedDict
+import numpy as np
+
+
+def _make_reference(n_voxels=500, n_images=20, seed=0):
+    rng = np.random.RandomState(seed)
+    return standardize(rng.normal(size=(n_voxels, n_images)))
+
+
+def test_batch_correlation_matches_single_images():
+    ref = _make_reference()
+    rng = np.random.RandomState(1)
+    maps = rng.normal(size=(500, 5))
+    batch = correlate(ref, standardize(maps), 500)
+    assert batch.shape == (20, 5)
+    for i in range(5):
+        single = correlate(ref, standardize(maps[:, i]), 500)
+        assert np.allclose(batch[:, i], single, atol=1e-5)
+
+
+def test_correlation_matches_pearson_r():
+    ref = _make_reference()
+    data = np.random.RandomState(2).normal(size=500)
+    r = correlate(ref, standardize(data), 500)
+    expected = [np.corrcoef(ref[:, i], data)[0, 1] for i in range(20)]
+    assert np.allclose(r, expected, atol=1e-5)
+
+
+def test_chunked_correlation_matches_single_block():
+    ref = _make_reference(n_voxels=5000, n_images=40)
+    data = standardize(np.random.RandomState(3).normal(size=5000))
+    full = correlate(ref, data, 5000)
+    # 0.05 MB blocks hold ~327 rows of 40 float32 columns
+    chunked = correlate(ref, data, 5000, chunk_size=0.05)
+    assert np.allclose(full, chunked, atol=1e-5)
+
+
+def test_drop_zeros_matches_fancy_indexing():
+    ref = _make_reference(n_voxels=5000, n_images=40)
+    data = np.random.RandomState(4).normal(size=5000)
+    data[:3000] = 0
+    data[3100] = np.nan
+    voxels = np.where((data != 0) & np.isfinite(data))[0]
+    expected = correlate(ref[voxels], standardize(data[voxels]), 5000)
+    masked, mask = standardize_nonzero(data)
+    r = correlate(ref, masked, 5000, mask=mask, chunk_size=0.05)
+    assert mask.sum() == len(voxels)
+    assert np.allclose(r, expected, atol=1e-5)
+
+
+def test_sparse_correlation_matches_dense():
+    ref = _make_reference(n_voxels=5000, n_images=40)
+    data = np.random.RandomState(5).normal(size=5000)
+    data[data < 1.5] = 0
+    assert is_sparse(data, 0.8)
+    dense = correlate(ref, standardize(data), 5000)
+    sparse = correlate_sparse(ref, data, 5000, ref.sum(0, dtype='float64'),
+                              chunk_size=0.01)
+    assert np.allclose(sparse, dense, atol=1e-5)
+
+
+def test_sparse_drop_zeros_matches_dense():
+    ref = _make_reference(n_voxels=5000, n_images=40)
+    data = np.random.RandomState(6).normal(size=5000)
+    data[data < 1.5] = 0
+    masked, mask = standardize_nonzero(data)
+    dense = correlate(ref, masked, 5000, mask=mask)
+    sparse = dot_rows(ref, masked, np.flatnonzero(mask), chunk_size=0.01)
+    assert np.allclose(sparse / 5000, dense, atol=1e-5)
+
+
+def test_quantized_correlation_error_is_bounded():
+    ref = _make_reference(n_voxels=5000, n_images=40)
+    data = standardize(np.random.RandomState(7).normal(size=5000))
+    expected = correlate(ref, data, 5000)
+    for dtype in ['int16', 'float16']:
+        q, scale, offset, error = quantize(ref, dtype)
+        assert q.dtype == dtype
+        assert np.allclose(dequantize(q, scale, offset), ref,
+                           atol=error.max())
+        if dtype == 'float16':
+            scale, offset = None, None
+        r = correlate(q, data, 5000, chunk_size=0.05, scale=scale,
+                      offset=offset)
+        assert np.all(np.abs(r - expected) <= error + 1e-6)
+
+
+def test_decoding_store_roundtrip(tmpdir):
+    store = DecodingStore('terms_20k', str(tmpdir))
+    labels = ['emotion', 'language', 'memory']
+    assert store.append('a' * 32, [0.1, -0.2, 0.3], labels) == 0
+    assert store.append('b' * 32, [0.4, 0.5, -0.6], labels) == 1
+    # A new label vector starts a new generation of the results matrix
+    assert store.append('c' * 32, [0.7], ['pain']) == 0
+
+    reader = DecodingStore('terms_20k', str(tmpdir))
+    result = reader.get('b' * 32)
+    assert list(result.index) == labels
+    assert np.allclose(result.values, [0.4, 0.5, -0.6])
+    assert reader.get('c' * 32).index[0] == 'pain'
+    assert reader.get('d' * 32) is None
+
+    # A partial row left by a crashed writer is dropped
+    data_file = store._files(reader._index().execute(
+        "SELECT generation FROM decodings WHERE uuid = ?",
+        ('a' * 32,)).fetchone()[0])[0]
+    with open(data_file, 'ab') as f:
+        f.write(b'\0' * 5)
+    assert store.append('d' * 32, [0.7, 0.8, 0.9], labels) == 2
+    assert np.allclose(reader.get('d' * 32).values, [0.7, 0.8, 0.9])
+
+
+def test_top_k_matches_full_sort():
+    r = np.random.RandomState(8).uniform(-1, 1, size=1000)
+    r[10] = np.nan
+    assert list(top_k(r, 5, 'pos')) == list(np.argsort(-np.nan_to_num(r))[:5])
+    assert list(top_k(r, 5, 'neg')) == list(np.argsort(np.nan_to_num(r))[:5])
+    expected = np.argsort(-np.abs(np.nan_to_num(r)))[:5]
+    assert list(top_k(r, 5)) == list(expected)
+    assert len(top_k(r, 5000)) == 999
+    assert len(top_k(r, 0)) == 0
+    # NaNs are never returned
+    assert len(top_k([np.nan] * 3, 2)) == 0
+    assert list(top_k([np.nan, 0.5, np.nan, -0.7], 3)) == [3, 1]
+
+
+class _FakeReference(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.n_voxels, n_images = data.shape
+        self.labels = OrderedDict(('img%d' % i, i) for i in range(n_images))
+        self.sketch = SketchIndex.build(data, n_dims=256, chunk_size=0.05)
+
+    def images(self, inds):
+        return self.data[:, inds].T
+
+
+def test_find_similar_matches_exact_ranking():
+    ref = _make_reference(n_voxels=5000, n_images=300)
+    rng = np.random.RandomState(9)
+    # Query is a noisy copy of one reference image, mixed with another
+    data = standardize(ref[:, 17] + 0.5 * ref[:, 42] +
+                       rng.normal(size=5000))
+    results = find_similar(_FakeReference(ref), data, k=5)
+    exact = correlate(ref, data, 5000)
+    # Strong matches are always found; returned correlations are exact
+    assert [label for (label, r) in results[:2]] == ['img17', 'img42']
+    inds = [int(label[3:]) for (label, r) in results]
+    assert np.allclose([r for (label, r) in results], exact[inds], atol=1e-5)
@@ -0,0 +1,32 @@
+""" Test the on-disk cache of masked images. """
+from nsweb.tasks.image_cache import MaskedImageCache
+import numpy as np
+import os
+
+
+def test_masked_image_cache(tmpdir):
+    cache = MaskedImageCache(str(tmpdir.mkdir('cache')), max_size=0.01)
+    img = str(tmpdir.join('img.npy'))
+    np.save(img, np.arange(1000))
+    loads = []
+
+    def load(filename):
+        loads.append(filename)
+        return np.load(filename)
+
+    assert np.allclose(cache.get(img, load), np.arange(1000))
+    assert cache.get(img, load).dtype == 'float32'
+    assert len(loads) == 1
+
+    # Changing the file invalidates its entry
+    np.save(img, np.arange(1000) * 2)
+    os.utime(img, (0, 0))
+    assert np.allclose(cache.get(img, load), np.arange(1000) * 2)
+    assert len(loads) == 2
+
+    # The cache holds at most ~10 KB, i.e., two 4 KB vectors
+    for i in range(3):
+        other = str(tmpdir.join('img%d.npy' % i))
+        np.save(other, np.zeros(1000))
+        cache.get(other, load)
+    assert len(os.listdir(cache.directory)) == 2
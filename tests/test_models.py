@@ -1,6 +1,7 @@
 """ Test model functionality. """
 from nsweb.models.studies import Study
 from nsweb.models.peaks import Peak
+import numpy as np
 
 def test_studies(db):
     study = Study(pmid=345345, title='test study',
@@ -12,3 +13,37 @@ def test_studies(db):
     db.session.commit()
     assert Peak.query.count() == 2
     assert Study.query.count() == 1
+
+
+def test_peak_index(db, tmpdir):
+    from nsweb.models.peaks import PeakIndex, VoxelStudyIndex
+    study = Study(pmid=1, title='test study')
+    study.peaks = [Peak(x=0, y=0, z=0), Peak(x=4, y=0, z=0),
+                   Peak(x=0, y=6, z=0), Peak(x=30, y=30, z=30)]
+    other = Study(pmid=2, title='other study')
+    other.peaks = [Peak(x=-2, y=-2, z=-2)]
+    db.session.add_all([study, other])
+    db.session.commit()
+    index = PeakIndex.load()
+    assert index.studies(6, 0, 0, 0) == [(1, 3), (2, 1)]
+    assert index.studies(6, 30, 32, 30) == [(1, 1)]
+    assert index.studies(6, -50, 0, 0) == []
+    # Same peaks as the SQL query
+    for (x, y, z, r) in [(2, 2, 0, 4), (0, 0, 2, 6), (28, 28, 28, 4)]:
+        peaks = Peak.closestPeaks(r, x, y, z).all()
+        assert sum(n for (pmid, n) in index.studies(r, x, y, z)) == \
+            len(peaks)
+
+    # Precomputed lookups agree with the KD-tree on the grid
+    affine = np.array([[-2, 0, 0, 40], [0, 2, 0, -40], [0, 0, 2, -40],
+                       [0, 0, 0, 1]], dtype='float64')
+    mask = np.ones((41, 41, 41), dtype=bool)
+    mask[0] = False
+    voxels = VoxelStudyIndex.build(index, str(tmpdir), mask, affine, [6])
+    assert voxels.fingerprint == index.fingerprint
+    for (x, y, z) in [(0, 0, 0), (2, 2, 0), (30, 32, 30), (-40, 40, 40)]:
+        assert voxels.studies(6, x, y, z) == index.studies(6, x, y, z)
+    assert voxels.studies(6, 1, 0, 0) is None
+    # Voxels outside the mask are left to the KD-tree
+    assert voxels.studies(6, 40, 0, 0) is None
+    assert voxels.studies(8, 0, 0, 0) is None
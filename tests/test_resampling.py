@@ -0,0 +1,28 @@
+""" Test resampling of uploaded images into MNI space. """
+from nsweb.tasks.resampling import Resampler
+import nibabel as nb
+import numpy as np
+
+
+MNI_AFFINE = np.array([[-2, 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72],
+                       [0, 0, 0, 1]])
+
+
+def test_resampling_matches_nearest_voxel():
+    resampler = Resampler(MNI_AFFINE)
+    # A 4mm image covering all but the top of the target space
+    affine = MNI_AFFINE.copy()
+    affine[:3, :3] *= 2
+    data = np.random.RandomState(0).normal(size=(46, 55, 40))
+    result = resampler.resample(nb.Nifti1Image(data, affine))
+    assert result.shape == (91, 109, 91)
+    assert np.allclose(result.get_data()[10, 21, 33], data[5, 11, 17])
+    # Target voxels outside the source image are zero
+    assert np.all(result.get_data()[:, :, 80:] == 0)
+
+    # Images in the target space are left unchanged, and index maps are reused
+    data = np.random.RandomState(1).normal(size=(91, 109, 91))
+    result = resampler.resample(nb.Nifti1Image(data, MNI_AFFINE))
+    assert np.allclose(result.get_data(), data)
+    resampler.resample(nb.Nifti1Image(data * 2, MNI_AFFINE))
+    assert len(resampler._maps) == 2
@@ -0,0 +1,40 @@
+""" Test the response cache and its keys. """
+from nsweb.initializers.response_cache import _LRU
+from nsweb.api.utils import cache_key
+from nsweb.core import app
+import time
+
+
+def test_lru():
+    lru = _LRU(2)
+    expires = time.time() + 60
+    lru.set('a', 1, expires)
+    lru.set('b', 2, expires)
+    assert lru.get('a') == 1
+
+    # 'b' is now the least recently used entry
+    lru.set('c', 3, expires)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+    # Expired entries are dropped
+    lru.set('d', 4, time.time() - 1)
+    assert lru.get('d') is None
+    assert len(lru.items) == 1
+
+
+def test_cache_key():
+    make_key = cache_key({'x': 0, 'y': 0, 'z': 0, 'r': 6})
+
+    def key(query):
+        with app.test_request_context('/api/locations/?' + query):
+            return make_key()
+
+    # Argument order, defaults and other arguments don't matter
+    assert key('x=2&y=4&z=6') == key('z=06&y=4&x=2&r=6&async=1&_=1')
+    assert key('x=2&y=4&z=6') != key('x=2&y=4&z=6&r=8')
+
+    # Required arguments aren't filled in, and limits are applied as views do
+    make_key = cache_key({'x': int, 'r': 6}, limits={'r': 20})
+    assert key('x=0') != key('')
+    assert key('x=02&r=30') == key('x=2&r=20')
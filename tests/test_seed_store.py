@@ -0,0 +1,48 @@
+""" Test the chunked store of per-seed images. """
+from nsweb.tasks.seed_store import SeedStore
+import nibabel as nb
+import numpy as np
+
+
+def test_seed_store(tmpdir):
+    affine = np.array([[-2, 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72],
+                       [0, 0, 0, 1]], dtype='float64')
+    mask = np.zeros((10, 12, 8))
+    mask[2:8, 3:9, 1:7] = 1
+    mask[4, 5, 3] = 0
+    store = SeedStore.create(str(tmpdir.join('test')),
+                             nb.Nifti1Image(mask, affine), chunk_size=50)
+    assert store.n_seeds == int(mask.sum())
+    assert store.n_chunks == 5
+
+    # Seeds map to and from coordinates
+    xyz = store.coords(np.arange(store.n_seeds))
+    assert all(store.seed(*c) == i for (i, c) in enumerate(xyz))
+    assert store.seed(90 - 8, -126 + 10, -72 + 6) == -1  # outside the mask
+
+    rng = np.random.RandomState(0)
+    images = rng.normal(size=(50, store.n_seeds))
+    images[images < 1] = 0
+    assert store.missing_chunks() == list(range(5))
+    assert store.get(3) is None
+    store.write_chunk(0, [images[i] if i % 7 else None for i in range(50)])
+    assert store.missing_chunks() == [1, 2, 3, 4]
+    assert store.has(3) and not store.has(0) and not store.has(60)
+
+    # Images are stored as float16
+    store = SeedStore(str(tmpdir.join('test')))
+    assert store.get(0) is None
+    assert np.allclose(store.get(3), images[3], rtol=1e-3)
+    assert np.allclose(store.get(48), images[48], rtol=1e-3)
+    img = store.unmask(store.get(3)).get_data()
+    assert np.allclose(img[mask > 0], store.get(3))
+    assert (img[mask == 0] == 0).all()
+
+    # Images of single seeds are kept until their chunk is written
+    store.put(60, images[0])
+    assert np.allclose(store.get(60), images[0], rtol=1e-3)
+    assert store.get(61) is None
+    assert store.has(60) and not store.has(61)
+    store.write_chunk(1, [None] * 50)
+    assert store.get(60) is None
+    assert not tmpdir.join('test', 'seed_0000060.bin').exists()
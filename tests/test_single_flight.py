@@ -0,0 +1,74 @@
+""" Test keys used to coalesce identical tasks. """
+from nsweb.tasks.single_flight import make_key
+
+
+class _Task(object):
+    name = 'nsweb.tasks.make_coactivation_map'
+
+
+def test_identical_calls_share_a_key():
+    task = _Task()
+    key = make_key(task, (0, 14, 42))
+    assert make_key(task, [0.0, 14, 42.0]) == key
+    assert make_key(task, (0, 14, 44)) != key
+    assert make_key(task, (1,), {'a': 1, 'b': 2}) == \
+        make_key(task, (1,), {'b': 2.0, 'a': 1})
+
+
+class _Redis(object):
+    """ Just enough of a Redis client for delay_once. on_get is called on the
+    first get, to let another caller in between reading and replacing. """
+
+    def __init__(self, on_get=None):
+        self.data = {}
+        self.on_get = on_get
+
+    def get(self, key):
+        value = self.data.get(key)
+        if self.on_get is not None:
+            on_get, self.on_get = self.on_get, None
+            on_get()
+        return value
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode('utf-8')
+        return True
+
+    def eval(self, script, n_keys, key, old, new, ex):
+        if self.data.get(key) != old.encode('utf-8'):
+            return None
+        return self.set(key, new)
+
+
+def test_racing_callers_start_one_job(monkeypatch):
+    from nsweb.tasks import single_flight
+
+    finished = {'old'}
+    started = []
+
+    class _Result(object):
+        def __init__(self, id, app=None):
+            self.id = id
+
+        def ready(self):
+            return self.id in finished
+
+    class _Job(_Task):
+        app = None
+
+        def apply_async(self, args, kwargs, task_id):
+            started.append(task_id)
+            return _Result(task_id)
+
+    task = _Job()
+    key = make_key(task, (1,))
+    # Both callers see the finished job before either replaces it
+    r = _Redis(on_get=lambda: single_flight.delay_once(task, (1,),
+                                                       task_id='b'))
+    r.data[key] = b'old'
+    monkeypatch.setattr(single_flight, '_redis', r)
+    monkeypatch.setattr(single_flight, 'AsyncResult', _Result)
+    assert single_flight.delay_once(task, (1,), task_id='a').id == 'b'
+    assert started == ['b']